@@ -4,14 +4,30 @@ import json
 import tempfile
 import subprocess
 import uuid
+import wave
+import signal
+import hashlib
+import shutil
+import socket
+import sqlite3
 import datetime as dt
+import re
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, jsonify
+from werkzeug.exceptions import BadRequest
 import boto3
 from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 import math
+import queue
 import random
-from threading import Thread
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import compress
+from contextlib import closing, contextmanager, nullcontext
+from threading import Thread, Lock, BoundedSemaphore, Event
 import logging
 import gspread
 from google.oauth2.service_account import Credentials
@@ -23,6 +39,7 @@ logger = logging.getLogger(__name__)
 MAX_DURATION = int(os.getenv('MAX_DURATION', '3600'))
 MAX_CONCURRENT = int(os.getenv('MAX_CONCURRENT', '5'))
 MAX_CLIPS = int(os.getenv('MAX_CLIPS', '40'))
+MIN_CLIPS = 5  # sotto questo numero di clip scaricate il job fallisce
 LOG_RATE = int(os.getenv('LOG_RATE', '100'))
 
 app = Flask(__name__)
@@ -34,11 +51,143 @@ R2_BUCKET_NAME = os.environ.get("R2_BUCKET_NAME")
 R2_PUBLIC_BASE_URL = os.environ.get("R2_PUBLIC_BASE_URL")
 R2_REGION = os.environ.get("R2_REGION", "auto")
 R2_ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID")
+R2_ENDPOINT_URL = os.environ.get("R2_ENDPOINT_URL")  # override endpoint (es. stand-in S3 locale)
+R2_ADDRESSING_STYLE = os.environ.get("R2_ADDRESSING_STYLE", "virtual")
+R2_MAX_POOL_CONNECTIONS = int(os.getenv('R2_MAX_POOL_CONNECTIONS', '20'))
+R2_MULTIPART_THRESHOLD_MB = int(os.getenv('R2_MULTIPART_THRESHOLD_MB', '16'))
+R2_MULTIPART_CHUNK_MB = int(os.getenv('R2_MULTIPART_CHUNK_MB', '16'))
+R2_UPLOAD_CONCURRENCY = int(os.getenv('R2_UPLOAD_CONCURRENCY', '8'))
+
+# 🗑️ Retention R2: indice locale dei video caricati, cancellazioni batch fuori dal path del job.
+# Un video resta se è tra gli ultimi KEEP_LAST oppure più giovane di MAX_AGE_DAYS (0 = disattivo):
+# con i default (1, 0) resta solo l'ultimo caricato, come la vecchia rotazione.
+R2_MANIFEST_PATH = os.getenv('R2_MANIFEST_PATH', os.path.join(tempfile.gettempdir(), 'r2_manifest.sqlite3'))
+R2_RETENTION_KEEP_LAST = int(os.getenv('R2_RETENTION_KEEP_LAST', '1'))
+R2_RETENTION_MAX_AGE_DAYS = float(os.getenv('R2_RETENTION_MAX_AGE_DAYS', '0'))
+R2_RETENTION_INTERVAL = float(os.getenv('R2_RETENTION_INTERVAL', '600'))
+R2_DELETE_BATCH = 1000
 
 # Pexels / Pixabay API
 PEXELS_API_KEY = os.environ.get("PEXELS_API_KEY")
 PIXABAY_API_KEY = os.environ.get("PIXABAY_API_KEY")
 GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON", "")
+SHEETS_FLUSH_INTERVAL = float(os.getenv('SHEETS_FLUSH_INTERVAL', '2'))
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+SHEETS_WAIT_TIMEOUT = float(os.getenv('SHEETS_WAIT_TIMEOUT', '60'))
+
+# ⚡ Acquisizione clip parallela (cap concorrenza + rate limit per provider)
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+PEXELS_CONCURRENCY = int(os.getenv('PEXELS_CONCURRENCY', '4'))
+PIXABAY_CONCURRENCY = int(os.getenv('PIXABAY_CONCURRENCY', '4'))
+PEXELS_RATE_PER_MIN = float(os.getenv('PEXELS_RATE_PER_MIN', '60'))
+PIXABAY_RATE_PER_MIN = float(os.getenv('PIXABAY_RATE_PER_MIN', '90'))
+PROVIDER_BURST = int(os.getenv('PROVIDER_BURST', '5'))
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '8'))  # download CDN per provider, separati dalle API
+PROVIDER_MAX_RETRIES = int(os.getenv('PROVIDER_MAX_RETRIES', '3'))
+PROVIDER_BACKOFF_BASE = float(os.getenv('PROVIDER_BACKOFF_BASE', '1.0'))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# 🌐 HTTP in uscita: una Session keep-alive per processo (pool per host), timeout (connect, read)
+# configurabili e URL dei provider sovrascrivibili (stub locali in test/benchmark)
+PEXELS_API_URL = os.getenv('PEXELS_API_URL', 'https://api.pexels.com/videos/search')
+PIXABAY_API_URL = os.getenv('PIXABAY_API_URL', 'https://pixabay.com/api/videos/')
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+SEARCH_READ_TIMEOUT = float(os.getenv('SEARCH_READ_TIMEOUT', '20'))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv('DOWNLOAD_READ_TIMEOUT', '30'))
+
+# 🔔 Webhook in background: retry con backoff, poi dead-letter JSONL
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '15'))
+WEBHOOK_MAX_RETRIES = int(os.getenv('WEBHOOK_MAX_RETRIES', '5'))
+WEBHOOK_DEAD_LETTER_PATH = os.getenv('WEBHOOK_DEAD_LETTER_PATH', os.path.join(tempfile.gettempdir(), 'webhook_dead_letter.jsonl'))
+# journal su disco dei webhook accodati e non ancora consegnati: un restart li riprende
+WEBHOOK_JOURNAL_DIR = os.getenv('WEBHOOK_JOURNAL_DIR', os.path.join(tempfile.gettempdir(), 'webhook_journal'))
+
+# 🧵 Pipeline clip: ogni clip passa download → normalize → probe appena disponibile,
+# con una coda limitata tra download e normalizzazione (backpressure sul disco)
+NORMALIZE_WORKERS = int(os.getenv('NORMALIZE_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+
+# ✂️ Trim per scena: si codifica solo il segmento centrale che la scena usa (CLIP_TRIM=0 = clip intere).
+# CLIP_RENDITION: "smallest" = rendition più piccola con larghezza >= MIN_CLIP_WIDTH, "first" = prima valida
+CLIP_TRIM = os.getenv('CLIP_TRIM', '1') == '1'
+CLIP_RENDITION = os.getenv('CLIP_RENDITION', 'smallest').lower()
+MIN_CLIP_WIDTH = 1280
+
+# 🗂️ Job store condiviso tra worker gunicorn e restart (sqlite | redis)
+JOB_STORE = os.getenv('JOB_STORE', 'sqlite').lower()
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(tempfile.gettempdir(), 'jobs.sqlite3'))
+REDIS_URL = os.getenv('REDIS_URL', '')
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+JOB_WORKERS_ENABLED = os.getenv('JOB_WORKERS_ENABLED', '1') == '1'
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# 🎙️ Upload audio in streaming (multipart / binario / audio_url) su disco condiviso tra worker
+AUDIO_UPLOAD_DIR = os.getenv('AUDIO_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'audio_uploads'))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_ORPHAN_GRACE = 600  # un upload senza job è orfano solo dopo 10 min (il job si crea a upload finito)
+BASE64_PLAIN_RE = re.compile(r"[A-Za-z0-9+/=]*")
+
+# 🧰 Workspace per job (file intermedi + manifest dei checkpoint, condiviso tra worker per il resume)
+JOB_WORKSPACE_DIR = os.getenv('JOB_WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'job_workspaces'))
+JOB_WORKSPACE_MAX_AGE = int(os.getenv('JOB_WORKSPACE_MAX_AGE', '21600'))
+JOB_WORKSPACE_MAX_MB = int(os.getenv('JOB_WORKSPACE_MAX_MB', '20480'))
+
+# 📦 /generate/batch: le righe condividono un pool di clip (query pianificate insieme, ogni clip
+# scaricata una volta per il batch). Con CLIP_TRIM la durata scena si arrotonda a BATCH_SEGMENT_STEP
+# secondi, così righe con audio simili riusano lo stesso encode
+BATCH_MAX_ROWS = int(os.getenv('BATCH_MAX_ROWS', '50'))
+BATCH_SEGMENT_STEP = int(os.getenv('BATCH_SEGMENT_STEP', '5'))
+BATCH_MAX_BODY_KB = int(os.getenv('BATCH_MAX_BODY_KB', '1024'))  # solo JSON: l'audio arriva da audio_url
+
+# 🚦 Scheduler: MAX_CONCURRENT job attivi in totale, MAX_QUEUE job in attesa prima del 429
+MAX_QUEUE = int(os.getenv('MAX_QUEUE', '20'))
+SHUTDOWN_GRACE = float(os.getenv('SHUTDOWN_GRACE', '20'))
+
+# 🔎 Cache risultati di ricerca Pexels/Pixabay (memoria LRU + SQLite su disco)
+SEARCH_CACHE_PATH = os.getenv('SEARCH_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'search_cache.sqlite3'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '21600'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '500'))
+
+# 💾 Cache locale clip stock (condivisa tra job/worker)
+CLIP_CACHE_DIR = os.getenv('CLIP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'clip_cache'))
+CLIP_CACHE_MAX_MB = int(os.getenv('CLIP_CACHE_MAX_MB', '4096'))
+
+# 🎞️ Cache clip normalizzate 1920x1080/30fps (una sola passata libx264 per clip sorgente)
+NORM_CACHE_DIR = os.getenv('NORM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'norm_cache'))
+NORM_CACHE_MAX_MB = int(os.getenv('NORM_CACHE_MAX_MB', '8192'))
+NORM_CACHE_VERIFY = os.getenv('NORM_CACHE_VERIFY', '1') == '1'
+NORMALIZE_FPS = 30
+NORMALIZE_VF = f"scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,fps={NORMALIZE_FPS},format=yuv420p"
+# profilo H.264 uniforme per tutte le clip: il concat in stream copy le unisce senza ri-codifica.
+# GOP fisso (keyframe ogni secondo, niente scene-cut) e niente B-frame: ordine di decodifica =
+# ordine di presentazione, quindi l'`outpoint` dell'ultima entry taglia al frame esatto
+NORMALIZE_GOP_ARGS = ["-profile:v", "high", "-level:v", "4.1",
+                      "-g", str(NORMALIZE_FPS), "-keyint_min", str(NORMALIZE_FPS), "-sc_threshold", "0", "-bf", "0"]
+
+# ⚙️ Profili libx264 scelti per richiesta (`encoder_profile`), default ENCODER_PROFILE
+ENCODER_PROFILES = {
+    "draft": {"preset": "veryfast", "crf": "28"},
+    "standard": {"preset": "fast", "crf": "23"},
+    "archive": {"preset": "slow", "crf": "18"},
+}
+ENCODER_PROFILE = os.getenv('ENCODER_PROFILE', 'standard').lower()
+
+# 🧮 Budget thread ffmpeg: FFMPEG_CPU_BUDGET core divisi tra i job attivi (e gli encode paralleli
+# di ciascun job) invece di lasciare che ogni ffmpeg usi tutti i core
+FFMPEG_CPU_BUDGET = int(os.getenv('FFMPEG_CPU_BUDGET', str(os.cpu_count() or 1)))
+FFMPEG_ADAPTIVE_THREADS = os.getenv('FFMPEG_ADAPTIVE_THREADS', '1') == '1'
+
+# 🎬 Render finale: "single" = clip codificate una volta sola (concat in stream copy + mux audio),
+# "legacy" = vecchia pipeline normalize → concat ri-codificato → mux ri-codificato (per confronto)
+RENDER_MODE = os.getenv('RENDER_MODE', 'single').lower()
+MAX_CONCAT_ENTRIES = int(os.getenv('MAX_CONCAT_ENTRIES', '2000'))  # limite di sicurezza, il loop si ferma sulla durata
+
+# 🧩 Regole keyword (query visive + filtro metadata), riusabili da altri canali
+KEYWORD_RULES_PATH = os.getenv('KEYWORD_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keyword_rules.json'))
 
 # ✅ ID FISSO SIGNIFICATO DEI SOGNI (SOSTITUISCI CON TUO SPREADSHEET_ID!)
 SPREADSHEET_ID = "1okc3JU-dhnmHHFwuW39NClBNbvEeADOE4pzw1SE3HA4"
@@ -46,8 +195,1019 @@ SPREADSHEET_ID = "1okc3JU-dhnmHHFwuW39NClBNbvEeADOE4pzw1SE3HA4"
 # 🔔 Webhook flusso 2 (Significato dei Sogni)
 N8N_WEBHOOK_URL_FLUSSO2 = os.environ.get("N8N_WEBHOOK_URL_SIGNIFICATO_DEI_SOGNI_FLUSSO2", "https://andreas84.app.n8n.cloud/webhook/Significato-dei-sogni-flusso-2-workflow-b")
 
-jobs = {}
-MAX_JOBS = 50
+TERMINAL_STATUSES = ("completed", "failed")
+
+class SQLiteJobStore:
+    """Job store su SQLite (default): un file condiviso da tutti i worker e dai restart.
+
+    Stati: queued → processing → completed | failed; le righe di un batch partono `waiting` (non
+    reclamabili) finché il job di piano non le rilascia in coda. Un job in processing ha un lease
+    (`lease_expires`) rinnovato dal worker: se il worker muore il lease scade e il job
+    torna reclamabile. I job terminati scadono dopo JOB_TTL secondi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._conn()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    created_ts REAL NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    expires_at REAL,
+                    payload TEXT NOT NULL
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "priority" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_ts)")
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def _record(row):
+        record = json.loads(row[5])
+        record.update({"status": row[0], "attempts": row[1], "lease_owner": row[2],
+                       "lease_expires": row[3], "expires_at": row[4]})
+        return record
+
+    def create(self, job_id, record, priority=0):
+        record = dict(record, job_id=job_id, priority=priority)
+        status = record.pop("status", "queued")
+        with closing(self._conn()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, created_ts, priority, payload) VALUES (?, ?, ?, ?, ?)",
+                (job_id, status, time.time(), priority, json.dumps(record)),
+            )
+
+    def get(self, job_id):
+        with closing(self._conn()) as conn:
+            row = conn.execute(
+                "SELECT status, attempts, lease_owner, lease_expires, expires_at, payload FROM jobs "
+                "WHERE job_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (job_id, time.time()),
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def update(self, job_id, worker_id=None, **fields):
+        """Aggiorna il job; con `worker_id` solo se quel worker ne ha ancora il lease (False se perso)."""
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT status, payload, lease_owner FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if not row or (worker_id is not None and (row[0] != "processing" or row[2] != worker_id)):
+                conn.execute("ROLLBACK")
+                return False
+            payload = json.loads(row[1])
+            status = fields.pop("status", row[0])
+            payload.update(fields)
+            if status in TERMINAL_STATUSES:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, payload = ?, lease_owner = NULL, lease_expires = NULL, "
+                    "expires_at = ? WHERE job_id = ?",
+                    (status, json.dumps(payload), time.time() + JOB_TTL, job_id),
+                )
+            else:
+                conn.execute("UPDATE jobs SET status = ?, payload = ? WHERE job_id = ?",
+                             (status, json.dumps(payload), job_id))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def claim(self, worker_id, max_active=None):
+        """Prende il job queued a priorità più alta (poi più vecchio), o uno in processing con lease
+        scaduto (worker crashato). Con `max_active` non supera quel numero di job attivi in totale."""
+        now = time.time()
+        conn = self._conn()
+        try:
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                if max_active is not None:
+                    active = conn.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE status = 'processing' AND lease_expires >= ?", (now,)
+                    ).fetchone()[0]
+                    if active >= max_active:
+                        conn.execute("COMMIT")
+                        return None
+                row = conn.execute(
+                    "SELECT job_id, attempts FROM jobs WHERE status = 'queued' "
+                    "OR (status = 'processing' AND lease_expires < ?) ORDER BY priority DESC, created_ts LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if not row:
+                    conn.execute("COMMIT")
+                    return None
+                job_id, attempts = row
+                if attempts >= JOB_MAX_ATTEMPTS:
+                    payload = json.loads(conn.execute("SELECT payload FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0])
+                    payload["error"] = f"Job abbandonato dopo {attempts} tentativi"
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', payload = ?, lease_owner = NULL, lease_expires = NULL, "
+                        "expires_at = ? WHERE job_id = ?",
+                        (json.dumps(payload), now + JOB_TTL, job_id),
+                    )
+                    conn.execute("COMMIT")
+                    discard_job_upload(payload)
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET status = 'processing', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE job_id = ?",
+                    (worker_id, now + JOB_LEASE_SECONDS, job_id),
+                )
+                conn.execute("COMMIT")
+                return self.get(job_id)
+        finally:
+            conn.close()
+
+    def renew(self, job_id, worker_id):
+        with closing(self._conn()) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND lease_owner = ? AND status = 'processing'",
+                (time.time() + JOB_LEASE_SECONDS, job_id, worker_id),
+            )
+        return cur.rowcount == 1
+
+    def requeue(self, job_id, worker_id):
+        """Rimette in coda un job interrotto da shutdown senza consumare un tentativo."""
+        with closing(self._conn()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires = NULL, "
+                "attempts = MAX(attempts - 1, 0) WHERE job_id = ? AND lease_owner = ? AND status = 'processing'",
+                (job_id, worker_id),
+            )
+
+    def release(self, job_id):
+        """waiting → queued (riga di un batch pronta); no-op se il job è già stato rilasciato."""
+        with closing(self._conn()) as conn:
+            cur = conn.execute("UPDATE jobs SET status = 'queued' WHERE job_id = ? AND status = 'waiting'", (job_id,))
+        return cur.rowcount == 1
+
+    def waiting_count(self):
+        with closing(self._conn()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'waiting'").fetchone()[0]
+
+    def waiting_jobs(self):
+        with closing(self._conn()) as conn:
+            rows = conn.execute(
+                "SELECT status, attempts, lease_owner, lease_expires, expires_at, payload FROM jobs WHERE status = 'waiting'"
+            ).fetchall()
+        return [self._record(row) for row in rows]
+
+    def queue_depth(self):
+        with closing(self._conn()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def active_count(self):
+        with closing(self._conn()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'processing' AND lease_expires >= ?", (time.time(),)
+            ).fetchone()[0]
+
+    def queue_position(self, job_id):
+        """Posizione 1-based nella coda (None se il job non è in coda)."""
+        with closing(self._conn()) as conn:
+            row = conn.execute(
+                "SELECT priority, created_ts FROM jobs WHERE job_id = ? AND status = 'queued'", (job_id,)
+            ).fetchone()
+            if not row:
+                return None
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                "(priority > ? OR (priority = ? AND created_ts < ?))",
+                (row[0], row[0], row[1]),
+            ).fetchone()[0] + 1
+
+    def purge_expired(self):
+        with closing(self._conn()) as conn:
+            conn.execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def count(self):
+        with closing(self._conn()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+class RedisJobStore:
+    """Job store su Redis (o qualunque client compatibile, es. fakeredis nei test).
+
+    Record JSON in `jobs:job:<id>`, coda in ZSET `jobs:queue` (score = creazione, anticipata
+    dalla priorità), lease in ZSET `jobs:leases` (score = scadenza). Controllo del lease owner
+    e scrittura avvengono in WATCH/MULTI/EXEC, quindi un job viene preso da un solo worker e un
+    worker che ha perso il lease non può sovrascriverlo. La scadenza dei job terminati usa
+    il TTL nativo di Redis.
+    """
+
+    def __init__(self, client, prefix="jobs"):
+        self.client = client
+        self.prefix = prefix
+        self.queue_key = f"{prefix}:queue"
+        self.lease_key = f"{prefix}:leases"
+        self.waiting_key = f"{prefix}:waiting"
+
+    def _key(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    @staticmethod
+    def _queue_score(priority, created_ts):
+        return created_ts - priority * 1e10
+
+    def create(self, job_id, record, priority=0):
+        created_ts = time.time()
+        record = dict(record, job_id=job_id, attempts=0, priority=priority, created_ts=created_ts)
+        record.setdefault("status", "queued")
+        self.client.set(self._key(job_id), json.dumps(record))
+        if record["status"] == "waiting":
+            self.client.sadd(self.waiting_key, job_id)
+        else:
+            self.client.zadd(self.queue_key, {job_id: self._queue_score(priority, created_ts)})
+
+    def get(self, job_id):
+        raw = self.client.get(self._key(job_id))
+        return json.loads(raw) if raw else None
+
+    def _transaction(self, func, *watches):
+        """WATCH/MULTI/EXEC: `func(pipe)` legge in immediato, poi `pipe.multi()` e scrive; se un
+        altro processo tocca una chiave osservata prima di EXEC, `func` riparte da capo."""
+        return self.client.transaction(func, *watches, value_from_callable=True)
+
+    def update(self, job_id, worker_id=None, **fields):
+        key = self._key(job_id)
+
+        def apply(pipe):
+            raw = pipe.get(key)
+            if raw is None:
+                return False
+            record = json.loads(raw)
+            if worker_id is not None and (record.get("status") != "processing" or record.get("lease_owner") != worker_id):
+                return False
+            record.update(fields)
+            pipe.multi()
+            if record.get("status") in TERMINAL_STATUSES:
+                record["lease_owner"] = None
+                pipe.zrem(self.lease_key, job_id)
+                pipe.set(key, json.dumps(record), ex=JOB_TTL)
+            else:
+                pipe.set(key, json.dumps(record))
+            return True
+
+        return self._transaction(apply, key)
+
+    def claim(self, worker_id, max_active=None):
+        """Conteggio dei lease attivi, scelta del job e presa del lease in un'unica transazione su
+        coda e lease: due worker non superano insieme `max_active` né prendono lo stesso job."""
+        abandoned = []
+
+        def take(pipe):
+            now = time.time()
+            if max_active is not None and pipe.zcount(self.lease_key, now, "+inf") >= max_active:
+                return None
+            expired = pipe.zrangebyscore(self.lease_key, "-inf", now, start=0, num=1)
+            candidates = expired or pipe.zrange(self.queue_key, 0, 0)
+            if not candidates:
+                return None
+            job_id = candidates[0].decode() if isinstance(candidates[0], bytes) else candidates[0]
+            key = self._key(job_id)
+            pipe.watch(key)
+            raw = pipe.get(key)
+            record = json.loads(raw) if raw else None
+            pipe.multi()
+            pipe.zrem(self.queue_key, job_id)
+            if record is None:
+                pipe.zrem(self.lease_key, job_id)
+                return False
+            attempts = int(record.get("attempts") or 0)
+            if attempts >= JOB_MAX_ATTEMPTS:
+                pipe.zrem(self.lease_key, job_id)
+                record.update(status="failed", lease_owner=None, error=f"Job abbandonato dopo {attempts} tentativi")
+                pipe.set(key, json.dumps(record), ex=JOB_TTL)
+                abandoned.append(record)
+                return False
+            pipe.zadd(self.lease_key, {job_id: now + JOB_LEASE_SECONDS})
+            record.update(status="processing", lease_owner=worker_id, attempts=attempts + 1)
+            pipe.set(key, json.dumps(record))
+            return record
+
+        while True:
+            abandoned.clear()
+            record = self._transaction(take, self.lease_key, self.queue_key)
+            for dropped in abandoned:
+                discard_job_upload(dropped)
+            if record is not False:
+                return record
+
+    def renew(self, job_id, worker_id):
+        key = self._key(job_id)
+
+        def extend(pipe):
+            raw = pipe.get(key)
+            record = json.loads(raw) if raw else None
+            if not record or record.get("lease_owner") != worker_id or record.get("status") != "processing":
+                return False
+            pipe.multi()
+            pipe.zadd(self.lease_key, {job_id: time.time() + JOB_LEASE_SECONDS})
+            return True
+
+        return self._transaction(extend, key)
+
+    def requeue(self, job_id, worker_id):
+        key = self._key(job_id)
+
+        def put_back(pipe):
+            raw = pipe.get(key)
+            record = json.loads(raw) if raw else None
+            if not record or record.get("lease_owner") != worker_id or record.get("status") != "processing":
+                return
+            record.update(status="queued", lease_owner=None, attempts=max(int(record.get("attempts") or 1) - 1, 0))
+            pipe.multi()
+            pipe.zrem(self.lease_key, job_id)
+            pipe.set(key, json.dumps(record))
+            pipe.zadd(self.queue_key, {job_id: self._queue_score(record.get("priority", 0), record.get("created_ts", time.time()))})
+
+        self._transaction(put_back, key)
+
+    def release(self, job_id):
+        if self.client.srem(self.waiting_key, job_id) != 1:
+            return False
+        record = self.get(job_id)
+        if not record or record.get("status") != "waiting":
+            return False
+        record["status"] = "queued"
+        self.client.set(self._key(job_id), json.dumps(record))
+        self.client.zadd(self.queue_key, {job_id: self._queue_score(record.get("priority", 0), record.get("created_ts", time.time()))})
+        return True
+
+    def waiting_count(self):
+        return self.client.scard(self.waiting_key)
+
+    def waiting_jobs(self):
+        records = (self.get(job_id.decode() if isinstance(job_id, bytes) else job_id)
+                   for job_id in self.client.smembers(self.waiting_key))
+        return [r for r in records if r]
+
+    def queue_depth(self):
+        return self.client.zcard(self.queue_key)
+
+    def active_count(self):
+        return self.client.zcount(self.lease_key, time.time(), "+inf")
+
+    def queue_position(self, job_id):
+        rank = self.client.zrank(self.queue_key, job_id)
+        return None if rank is None else rank + 1
+
+    def purge_expired(self):
+        pass
+
+    def count(self):
+        return sum(1 for _ in self.client.scan_iter(match=self._key("*")))
+
+def create_job_store():
+    if JOB_STORE == "redis":
+        import redis
+        if not REDIS_URL:
+            raise RuntimeError("JOB_STORE=redis richiede REDIS_URL")
+        return RedisJobStore(redis.Redis.from_url(REDIS_URL))
+    return SQLiteJobStore(JOB_DB_PATH)
+
+job_store = create_job_store()
+
+class LeaseLost(Exception):
+    """Il lease del job è passato a un altro worker: questo deve fermarsi senza scrivere nulla."""
+
+class JobLease:
+    """Lease di un job reclamato da `worker_id`.
+
+    Gli aggiornamenti passano da `update` (condizionati al lease) e prima di ogni effetto
+    esterno (upload R2, Sheets, webhook) `check` lo rinnova: se un altro worker ha ripreso
+    il job dopo la scadenza, questo si ferma invece di produrre un duplicato.
+    """
+
+    def __init__(self, job_id, worker_id):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lost = Event()
+
+    def renew(self):
+        if not self.lost.is_set() and job_store.renew(self.job_id, self.worker_id):
+            return True
+        self.lost.set()
+        return False
+
+    def check(self):
+        if not self.renew():
+            raise LeaseLost(f"lease del job {self.job_id} perso")
+
+    def update(self, **fields):
+        if self.lost.is_set() or not job_store.update(self.job_id, worker_id=self.worker_id, **fields):
+            self.lost.set()
+            raise LeaseLost(f"lease del job {self.job_id} perso")
+
+# -------------------------------------------------
+# Metriche: timer per fase sul job + istogrammi aggregati per /metrics (formato Prometheus)
+# -------------------------------------------------
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# i valori vivono nella memoria del processo: con più worker gunicorn ogni scrape colpisce un
+# processo diverso, quindi ogni serie porta l'etichetta `worker` (sum by in Prometheus)
+WORKER_LABEL = f'worker="{WORKER_ID}"'
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.series.get(labels, ([0] * len(self.buckets), [0.0, 0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            total[0] += value
+            total[1] += 1
+            self.series[labels] = (counts, total)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.series.items()):
+                base = [WORKER_LABEL] + [f'{n}="{v}"' for n, v in zip(self.label_names, labels)]
+                for bound, count in list(zip(self.buckets, counts)) + [("+Inf", total[1])]:
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{{{','.join(base + [le])}}} {count}")
+                suffix = f"{{{','.join(base)}}}"
+                lines.append(f"{self.name}_sum{suffix} {total[0]:.6f}")
+                lines.append(f"{self.name}_count{suffix} {total[1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                base = ",".join([WORKER_LABEL] + [f'{n}="{v}"' for n, v in zip(self.label_names, labels)])
+                lines.append(f"{self.name}{{{base}}} {value}")
+        return lines
+
+STAGE_SECONDS = Histogram("video_stage_seconds", "Durata delle fasi di process_video_async", ("stage",))
+FFMPEG_SECONDS = Histogram("video_ffmpeg_seconds", "Durata delle chiamate ffmpeg/ffprobe", ("step",))
+DOWNLOAD_SECONDS = Histogram("video_clip_download_seconds", "Durata download clip stock", ("provider",))
+DOWNLOAD_BYTES = Counter("video_clip_download_bytes_total", "Byte scaricati dai provider", ("provider",))
+JOBS_TOTAL = Counter("video_jobs_total", "Job terminati per esito", ("status",))
+UPLOAD_SECONDS = Histogram("video_r2_upload_seconds", "Durata upload video finale su R2")
+UPLOAD_MBPS = Histogram("video_r2_upload_mbytes_per_second", "Throughput upload R2 (MB/s)",
+                        buckets=(1, 5, 10, 25, 50, 100, 250))
+UPLOAD_BYTES = Counter("video_r2_upload_bytes_total", "Byte caricati su R2")
+MEDIA_DURATIONS = Counter("video_media_durations_total",
+                          "Durate media per sorgente (provider/ffmpeg/header/cache/ffprobe)", ("source",))
+METRICS = [STAGE_SECONDS, FFMPEG_SECONDS, DOWNLOAD_SECONDS, DOWNLOAD_BYTES, JOBS_TOTAL,
+           UPLOAD_SECONDS, UPLOAD_MBPS, UPLOAD_BYTES, MEDIA_DURATIONS]
+
+def should_log_sample():
+    """Log per-clip campionati: LOG_RATE = percentuale di righe stampate (100 = tutte)."""
+    return LOG_RATE >= 100 or random.random() * 100 < LOG_RATE
+
+def log_sampled(message):
+    if should_log_sample():
+        print(message, flush=True)
+
+class JobMetrics:
+    """Tempi di un singolo job: fasi, clip (byte/secondi) e ogni chiamata ffmpeg."""
+
+    def __init__(self, on_stage=None):
+        self.stages = {}
+        self.clips = []
+        self.ffmpeg = []
+        self.uploads = []
+        self.lock = Lock()
+        self.on_stage = on_stage
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.stages[name] = round(self.stages.get(name, 0.0) + elapsed, 3)
+            STAGE_SECONDS.observe(elapsed, name)
+            if self.on_stage:
+                try:
+                    self.on_stage(self)
+                except Exception:
+                    pass
+
+    def record_clip(self, **info):
+        with self.lock:
+            self.clips.append(info)
+
+    def record_upload(self, **info):
+        with self.lock:
+            self.uploads.append(info)
+
+    def record_ffmpeg(self, step, seconds, ok, output_bytes=None):
+        with self.lock:
+            self.ffmpeg.append({"step": step, "seconds": round(seconds, 3), "ok": ok, "bytes": output_bytes})
+
+    def snapshot(self):
+        with self.lock:
+            ffmpeg_totals = {}
+            for call in self.ffmpeg:
+                total = ffmpeg_totals.setdefault(call["step"], {"calls": 0, "seconds": 0.0, "bytes": 0})
+                total["calls"] += 1
+                total["seconds"] = round(total["seconds"] + call["seconds"], 3)
+                total["bytes"] += call["bytes"] or 0
+            return {
+                "stages": dict(self.stages),
+                "ffmpeg": ffmpeg_totals,
+                "clips": [dict(c) for c in self.clips],
+                "uploads": [dict(u) for u in self.uploads],
+            }
+
+def run_ffmpeg(args, step, metrics=None, **kwargs):
+    """subprocess.run cronometrato (ffmpeg/ffprobe): tempo sul job e nell'istogramma FFMPEG_SECONDS."""
+    started = time.monotonic()
+    ok = False
+    try:
+        result = subprocess.run(args, **kwargs)
+        ok = result.returncode == 0
+        return result
+    finally:
+        elapsed = time.monotonic() - started
+        FFMPEG_SECONDS.observe(elapsed, step)
+        if metrics:
+            output_bytes = None
+            if args[0] == "ffmpeg" and ok and os.path.isfile(args[-1]):
+                output_bytes = os.path.getsize(args[-1])
+            metrics.record_ffmpeg(step, elapsed, ok, output_bytes)
+
+def resolve_encoder_profile(name=None):
+    """Nome profilo valido: quello richiesto, altrimenti ENCODER_PROFILE, altrimenti "standard"."""
+    for candidate in (str(name or "").lower(), ENCODER_PROFILE):
+        if candidate in ENCODER_PROFILES:
+            return candidate
+    return "standard"
+
+def encoder_args(profile=None):
+    settings = ENCODER_PROFILES[resolve_encoder_profile(profile)]
+    return ["-c:v", "libx264", "-preset", settings["preset"], "-crf", settings["crf"]]
+
+def normalize_codec_args(profile=None):
+    """Argomenti di codifica delle clip normalizzate (fanno parte della chiave della norm cache)."""
+    return encoder_args(profile) + NORMALIZE_GOP_ARGS + ["-an"]
+
+def ffmpeg_thread_count(parallel=1):
+    """Thread per una chiamata ffmpeg: FFMPEG_CPU_BUDGET diviso per job attivi × `parallel`
+    (encode concorrenti dello stesso job), minimo 1. None = decide ffmpeg (budget disattivato)."""
+    if not FFMPEG_ADAPTIVE_THREADS:
+        return None
+    try:
+        active = job_store.active_count()
+    except Exception:
+        active = 0
+    active = max(1, active, len(active_jobs))
+    return max(1, FFMPEG_CPU_BUDGET // (active * max(1, parallel)))
+
+def thread_args(threads, filter_option="-filter_threads"):
+    """(opzioni globali, opzioni di output) per limitare filtri ed encoder a `threads`."""
+    if not threads:
+        return [], []
+    return [filter_option, str(threads)], ["-threads", str(threads)]
+
+class TokenBucket:
+    """Token bucket thread-safe: `rate_per_min` richieste/minuto, burst massimo `capacity`."""
+
+    def __init__(self, rate_per_min, capacity):
+        self.rate = rate_per_min / 60.0
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# "semaphore" limita le chiamate API di ricerca, "downloads" i download delle clip dalla CDN:
+# un download lento non deve togliere slot alle ricerche degli altri job
+PROVIDER_LIMITS = {
+    "pexels": {
+        "semaphore": BoundedSemaphore(max(1, PEXELS_CONCURRENCY)),
+        "downloads": BoundedSemaphore(max(1, DOWNLOAD_CONCURRENCY)),
+        "bucket": TokenBucket(PEXELS_RATE_PER_MIN, PROVIDER_BURST),
+    },
+    "pixabay": {
+        "semaphore": BoundedSemaphore(max(1, PIXABAY_CONCURRENCY)),
+        "downloads": BoundedSemaphore(max(1, DOWNLOAD_CONCURRENCY)),
+        "bucket": TokenBucket(PIXABAY_RATE_PER_MIN, PROVIDER_BURST),
+    },
+}
+
+class FileCache:
+    """Cache su disco condivisa tra job e worker gunicorn.
+
+    Ogni entry è un sidecar `<key>.json` che nomina il file dati `<key>.<token><suffix>`
+    e ne riporta la size attesa. Il file dati non viene mai sovrascritto: lo store lo scrive
+    con un nome nuovo e poi sostituisce il sidecar con os.replace, unico punto di commit,
+    così un lookup concorrente vede la coppia vecchia o quella nuova, mai un misto. L'LRU
+    usa l'mtime del file dati (aggiornato a ogni hit) e l'eviction rimuove le entry meno
+    recenti oltre `max_bytes`.
+    """
+
+    def __init__(self, name, directory, max_bytes, suffix=".mp4", validator=None):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.validator = validator
+        self.lock = Lock()
+        self.inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def key_for(*parts):
+        return hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    def data_path_for(self, key, meta):
+        """File dati dell'entry; i sidecar scritti prima dei token puntano a `<key><suffix>`."""
+        return os.path.join(self.directory, os.path.basename(meta.get("file") or key + self.suffix))
+
+    def meta_path_for(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def read_meta(self, key):
+        try:
+            with open(self.meta_path_for(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, key):
+        """Path dell'entry se presente e integra, altrimenti None."""
+        meta = self.read_meta(key)
+        path = self.data_path_for(key, meta) if meta is not None else None
+        try:
+            ok = meta is not None and os.path.getsize(path) == meta.get("size")
+            if ok and self.validator:
+                ok = self.validator(path, meta)
+        except OSError:
+            ok = False
+        if not ok:
+            if meta is not None:
+                self.discard(key, meta)
+            self._count("misses")
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return path
+
+    @contextmanager
+    def filling(self, key):
+        """Un solo riempimento per chiave nel processo: chi arriva mentre un altro job sta
+        riempiendo la stessa entry aspetta e poi la trova con `lookup`."""
+        with self.lock:
+            entry = self.inflight.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.inflight[key]
+
+    def store(self, key, src_path, meta=None):
+        """Copia `src_path` in cache (hard link se possibile) e pubblica l'entry con il solo
+        replace del sidecar. Errori non bloccanti."""
+        token = uuid.uuid4().hex
+        path = os.path.join(self.directory, f"{key}.{token}{self.suffix}")
+        meta_tmp = f"{self.meta_path_for(key)}.{token}.tmp"
+        previous = self.read_meta(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                os.link(src_path, path)
+            except OSError:
+                shutil.copyfile(src_path, path)
+            meta = dict(meta or {}, file=os.path.basename(path), size=os.path.getsize(path), stored_at=time.time())
+            with open(meta_tmp, "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_tmp, self.meta_path_for(key))
+            self._count("stores")
+        except Exception as e:
+            print(f"⚠️ Cache {self.name}: store fallito ({e})", flush=True)
+            for p in (path, meta_tmp):
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+            return None
+        if previous is not None and self.data_path_for(key, previous) != path:
+            try:
+                os.unlink(self.data_path_for(key, previous))
+            except OSError:
+                pass
+        self.evict()
+        return path
+
+    def discard(self, key, meta=None):
+        """Rimuove l'entry. Con `meta` solo se il sidecar è ancora quello letto: un lookup che ha
+        visto un'entry appena sostituita non cancella quella nuova."""
+        current = self.read_meta(key)
+        if current is None or (meta is not None and current != meta):
+            return
+        for p in (self.meta_path_for(key), self.data_path_for(key, current)):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+    def link_out(self, path, suffix=None, workdir=None):
+        """Copia privata per il job (hard link se possibile): l'eviction non tocca i file in uso."""
+        out_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix or self.suffix, dir=workdir)
+        out_tmp.close()
+        os.unlink(out_tmp.name)
+        try:
+            os.link(path, out_tmp.name)
+        except OSError:
+            shutil.copyfile(path, out_tmp.name)
+        return out_tmp.name
+
+    def evict(self):
+        """Rimuove le entry meno recenti finché la cache sta sotto `max_bytes`, più i file
+        temporanei e i file dati orfani (nessun sidecar li nomina) più vecchi di un'ora."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        entries = []
+        referenced = set()
+        total = 0
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            meta = self.read_meta(key)
+            if meta is None:
+                continue
+            path = self.data_path_for(key, meta)
+            referenced.add(os.path.basename(path))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+            total += st.st_size
+        now = time.time()
+        for name in names:
+            if name in referenced or not (name.endswith(".tmp") or name.endswith(self.suffix)):
+                continue
+            full = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(full).st_mtime > 3600:
+                    os.unlink(full)
+            except OSError:
+                pass
+        if total <= self.max_bytes:
+            return
+        for _mtime, size, key in sorted(entries):
+            self.discard(key)
+            total -= size
+            self._count("evictions")
+            if total <= self.max_bytes:
+                break
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def verify_normalized_entry(path, meta):
+    """Entry normalizzata valida solo se durata nota e checksum coincide (niente file troncati)."""
+    if not meta.get("duration"):
+        return False
+    return not NORM_CACHE_VERIFY or file_sha256(path) == meta.get("sha256")
+
+clip_cache = FileCache("clips", CLIP_CACHE_DIR, CLIP_CACHE_MAX_MB * 1024 * 1024)
+norm_cache = FileCache("normalized", NORM_CACHE_DIR, NORM_CACHE_MAX_MB * 1024 * 1024,
+                       validator=verify_normalized_entry)
+
+class SearchCache:
+    """Risultati di ricerca per (provider, query, pagina, filtri) con TTL.
+
+    LRU in memoria limitata a `max_entries` davanti a una tabella SQLite condivisa tra worker
+    e restart. `get_or_fetch` fa single-flight per chiave: le scene parallele con la stessa
+    query aspettano la prima ricerca invece di ripeterla.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        self.key_locks = {}
+        self.stats = {"hits": 0, "misses": 0}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._conn()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    key TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def key_for(provider, query, page, filters):
+        return FileCache.key_for(provider, query, page, json.dumps(filters, sort_keys=True))
+
+    def _remember(self, key, expires_at, payload):
+        with self.lock:
+            self.memory[key] = (expires_at, payload)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[0] > now:
+                self.memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+        with closing(self._conn()) as conn:
+            row = conn.execute("SELECT expires_at, payload FROM search_cache WHERE key = ? AND expires_at > ?",
+                               (key, now)).fetchone()
+        if row:
+            payload = json.loads(row[1])
+            self._remember(key, row[0], payload)
+            with self.lock:
+                self.stats["hits"] += 1
+            return payload
+        return None
+
+    def put(self, key, payload):
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, payload)
+        with closing(self._conn()) as conn:
+            conn.execute("INSERT OR REPLACE INTO search_cache (key, expires_at, payload) VALUES (?, ?, ?)",
+                         (key, expires_at, json.dumps(payload)))
+            if random.random() < 0.05:
+                conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),))
+
+    def get_or_fetch(self, provider, query, page, filters, fetch):
+        """Risultati dalla cache o da `fetch()` (None = errore, non messo in cache)."""
+        key = self.key_for(provider, query, page, filters)
+        payload = self.get(key)
+        if payload is not None:
+            return payload
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+        with key_lock:
+            with self.lock:
+                entry = self.memory.get(key)
+                if entry and entry[0] > time.time():
+                    self.stats["hits"] += 1
+                    return entry[1]
+                self.stats["misses"] += 1
+            payload = fetch()
+            if payload is not None:
+                self.put(key, payload)
+        with self.lock:
+            self.key_locks.pop(key, None)
+        return payload
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.memory))
+
+search_cache = SearchCache(SEARCH_CACHE_PATH, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+class ClipPicker:
+    """Clip già usate nel job: le scene ripetute pescano clip diverse dallo stesso risultato in cache.
+
+    Anche la pagina di ricerca casuale si sceglie una volta per (provider, query) nel job, così le
+    scene con la stessa query riusano la stessa pagina in cache invece di cercarne altre.
+    """
+
+    def __init__(self):
+        self.used = set()
+        self.pages = {}
+        self.lock = Lock()
+
+    def page(self, provider, query, pages=3):
+        with self.lock:
+            return self.pages.setdefault((provider, query), random.randint(1, pages))
+
+    def pick(self, provider, candidates, randomize=True):
+        with self.lock:
+            fresh = [c for c in candidates if (provider, c.get("id")) not in self.used]
+            pool = fresh or candidates
+            if not pool:
+                return None
+            choice = random.choice(pool) if randomize else pool[0]
+            self.used.add((provider, choice.get("id")))
+            return choice
+
+_http_session = None
+_http_session_lock = Lock()
+
+def get_http_session():
+    """requests.Session di processo: connessioni keep-alive riusate verso provider, CDN e n8n.
+
+    Il pool per host (HTTP_POOL_SIZE) deve coprire i FETCH_WORKERS di tutti i job concorrenti;
+    i retry restano nei chiamanti (token bucket + Retry-After), l'adapter non ritenta.
+    """
+    global _http_session
+    if _http_session is not None:
+        return _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(HTTP_POOL_SIZE, FETCH_WORKERS))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+    return _http_session
+
+def backoff_delay(attempt, resp=None):
+    """Attesa prima del retry: Retry-After se presente, altrimenti esponenziale con jitter."""
+    if resp is not None:
+        retry_after = resp.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+    return PROVIDER_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, PROVIDER_BACKOFF_BASE)
+
+def provider_get(provider, url, **kwargs):
+    """GET di ricerca verso Pexels/Pixabay con token bucket, cap concorrenza e retry su 429/5xx."""
+    limits = PROVIDER_LIMITS[provider]
+    for attempt in range(PROVIDER_MAX_RETRIES + 1):
+        limits["bucket"].acquire()
+        resp = None
+        try:
+            with limits["semaphore"]:
+                resp = get_http_session().get(url, **kwargs)
+            if resp.status_code not in RETRY_STATUS:
+                return resp
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= PROVIDER_MAX_RETRIES:
+                raise
+        if attempt >= PROVIDER_MAX_RETRIES:
+            return resp
+        delay = backoff_delay(attempt, resp)
+        print(f"⏳ {provider} {resp.status_code if resp is not None else 'errore rete'}: retry {attempt + 1}/{PROVIDER_MAX_RETRIES} tra {delay:.1f}s", flush=True)
+        time.sleep(delay)
 
 def get_gspread_client():
     """Client Google Sheets per update Video_URL"""
@@ -62,212 +1222,967 @@ def get_gspread_client():
         logger.error(f"Google Sheets client error: {e}")
         return None
 
+def default_worksheet_factory():
+    gc = get_gspread_client()
+    if gc is None:
+        raise RuntimeError("Client Google Sheets non disponibile")
+    return gc.open_by_key(SPREADSHEET_ID).sheet1
+
+class PendingWrite:
+    """Esito di un update accodato: `wait()` ritorna True quando il batch che lo contiene è scritto."""
+
+    def __init__(self):
+        self.done = Event()
+        self.error = None
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout) and self.error is None
+
+class SheetsWriter:
+    """Writer Google Sheets di processo: un solo client (token rinnovato da google-auth) e
+    update di più job coalescenti in un `batch_update` ogni SHEETS_FLUSH_INTERVAL secondi.
+
+    `worksheet_factory` restituisce il worksheet (in test: un fake con `batch_update(data, ...)`);
+    viene richiamata per riaprirlo dopo un errore non di quota.
+    """
+
+    def __init__(self, worksheet_factory, flush_interval=SHEETS_FLUSH_INTERVAL, max_retries=SHEETS_MAX_RETRIES):
+        self.worksheet_factory = worksheet_factory
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.worksheet = None
+        self.pending = {}
+        self.waiters = []
+        self.lock = Lock()
+        self.wake = Event()
+        self.thread = None
+
+    def enqueue(self, row, values):
+        """Accoda {colonna: valore} per la riga `row`; l'ultimo valore per cella vince."""
+        waiter = PendingWrite()
+        with self.lock:
+            for col, value in values.items():
+                self.pending[(row, col)] = value
+            self.waiters.append((waiter, {(row, col) for col in values}))
+            if self.thread is None:
+                self.thread = Thread(target=self._loop, name="sheets-writer", daemon=True)
+                self.thread.start()
+        self.wake.set()
+        return waiter
+
+    def _loop(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.flush_interval)  # finestra di coalescenza
+            self.wake.clear()
+            self.flush()
+
+    @staticmethod
+    def _is_quota_error(error):
+        return getattr(getattr(error, "response", None), "status_code", None) in (429, 500, 502, 503, 504)
+
+    def _write(self, pending):
+        """Un `batch_update` delle celle `pending`, ritentato solo sugli errori di quota.
+        Un altro errore riapre il worksheet e ritorna subito: lo gestisce `flush`."""
+        data = [{"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}
+                for (row, col), value in sorted(pending.items())]
+        error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.worksheet is None:
+                    self.worksheet = self.worksheet_factory()
+                self.worksheet.batch_update(data, value_input_option="USER_ENTERED")
+                return None
+            except Exception as e:
+                error = e
+                if not self._is_quota_error(e):
+                    self.worksheet = None
+                    return error
+                if attempt < self.max_retries:
+                    delay = min(60.0, 2 ** attempt + random.uniform(0, 1))
+                    print(f"⏳ Sheets batch ({len(data)} celle) errore {e.response.status_code}: retry tra {delay:.1f}s", flush=True)
+                    time.sleep(delay)
+        return error
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            waiters, self.waiters = self.waiters, []
+        if not pending:
+            for waiter, _cells in waiters:
+                waiter.done.set()
+            return
+        error = self._write(pending)
+        if error is None:
+            print(f"📊 Sheets batch_update: {len(pending)} celle, {len(waiters)} job", flush=True)
+            for waiter, _cells in waiters:
+                waiter.done.set()
+            return
+        if self._is_quota_error(error):
+            print(f"❌ Sheets batch_update fallito ({len(pending)} celle): {error}", flush=True)
+            for waiter, _cells in waiters:
+                waiter.error = error
+                waiter.done.set()
+            return
+        # errore non di quota (range/riga non valida, token): ogni job riprova da solo, così una
+        # riga sbagliata non fa perdere il PRODOTTO anti-loop alle righe degli altri job
+        print(f"⚠️ Sheets batch_update fallito ({len(pending)} celle): {error}; riprovo job per job", flush=True)
+        for waiter, cells in waiters:
+            own = {cell: pending[cell] for cell in cells}
+            waiter.error = self._write(own) if own else None
+            if waiter.error is not None:
+                print(f"❌ Sheets update fallito ({len(own)} celle): {waiter.error}", flush=True)
+            waiter.done.set()
+
+sheets_writer = SheetsWriter(default_worksheet_factory) if GOOGLE_CREDENTIALS_JSON else None
+
+_s3_client = None
+_s3_client_lock = Lock()
+
+R2_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=R2_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=R2_MULTIPART_CHUNK_MB * 1024 * 1024,
+    max_concurrency=R2_UPLOAD_CONCURRENCY,
+    use_threads=True,
+)
+
 def get_s3_client():
-    """Client S3 configurato per Cloudflare R2"""
-    if R2_ACCOUNT_ID:
+    """Client S3 configurato per Cloudflare R2 (uno per processo, thread-safe, connessioni riusate)"""
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
+    if R2_ENDPOINT_URL:
+        endpoint_url = R2_ENDPOINT_URL
+    elif R2_ACCOUNT_ID:
         endpoint_url = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
     else:
         endpoint_url = None
     if endpoint_url is None:
         raise RuntimeError("Endpoint R2 non configurato: imposta R2_ACCOUNT_ID in Railway")
     
-    session = boto3.session.Session()
-    s3_client = session.client(
-        service_name="s3",
-        region_name=R2_REGION,
-        endpoint_url=endpoint_url,
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=Config(s3={"addressing_style": "virtual"}),
+    with _s3_client_lock:
+        if _s3_client is None:
+            session = boto3.session.Session()
+            _s3_client = session.client(
+                service_name="s3",
+                region_name=R2_REGION,
+                endpoint_url=endpoint_url,
+                aws_access_key_id=R2_ACCESS_KEY_ID,
+                aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                config=Config(
+                    s3={"addressing_style": R2_ADDRESSING_STYLE},
+                    # il pool deve coprire i thread del multipart di tutti i job concorrenti
+                    max_pool_connections=max(R2_MAX_POOL_CONNECTIONS, R2_UPLOAD_CONCURRENCY),
+                    retries={"max_attempts": 5, "mode": "adaptive"},
+                    tcp_keepalive=True,
+                ),
+            )
+    return _s3_client
+
+def upload_video(s3_client, path, object_key, metrics=None):
+    """Upload multipart parallelo (R2_TRANSFER_CONFIG) con metriche di throughput."""
+    size = os.path.getsize(path)
+    started = time.monotonic()
+    s3_client.upload_file(
+        Filename=path,
+        Bucket=R2_BUCKET_NAME,
+        Key=object_key,
+        ExtraArgs={"ContentType": "video/mp4"},
+        Config=R2_TRANSFER_CONFIG,
     )
-    return s3_client
+    elapsed = max(time.monotonic() - started, 1e-6)
+    mbps = size / elapsed / (1024 * 1024)
+    UPLOAD_SECONDS.observe(elapsed)
+    UPLOAD_MBPS.observe(mbps)
+    UPLOAD_BYTES.inc(size)
+    if metrics:
+        metrics.record_upload(bytes=size, seconds=round(elapsed, 3), mbytes_per_second=round(mbps, 2))
+    print(f"☁️ Upload R2: {size / (1024 * 1024):.1f}MB in {elapsed:.1f}s ({mbps:.1f}MB/s)", flush=True)
+    return size
+
+class RetentionManifest:
+    """Indice SQLite dei video caricati su R2: la retention non deve più listare tutto il bucket."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._conn()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    key TEXT PRIMARY KEY,
+                    uploaded_ts REAL NOT NULL,
+                    size INTEGER,
+                    job_id TEXT
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def _conn(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def record(self, key, size=None, job_id=None, uploaded_ts=None, replace=True):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with closing(self._conn()) as conn:
+            conn.execute(
+                f"{verb} INTO uploads (key, uploaded_ts, size, job_id) VALUES (?, ?, ?, ?)",
+                (key, uploaded_ts or time.time(), size, job_id),
+            )
+
+    def is_bootstrapped(self):
+        with closing(self._conn()) as conn:
+            return conn.execute("SELECT 1 FROM meta WHERE name = 'bootstrapped'").fetchone() is not None
+
+    def mark_bootstrapped(self):
+        with closing(self._conn()) as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('bootstrapped', ?)", (str(time.time()),))
+
+    def expired_keys(self, keep_last, max_age_days):
+        """Chiavi da cancellare secondo la policy (più vecchie prima). L'ultimo video caricato resta
+        sempre, anche con `keep_last=0`: è quello che il job appena finito ha consegnato a n8n."""
+        keep_last = max(1, keep_last)
+        with closing(self._conn()) as conn:
+            rows = conn.execute("SELECT key, uploaded_ts FROM uploads ORDER BY uploaded_ts DESC, rowid DESC").fetchall()
+        min_ts = time.time() - max_age_days * 86400 if max_age_days > 0 else None
+        return [key for i, (key, ts) in enumerate(rows)
+                if i >= keep_last and (min_ts is None or ts < min_ts)][::-1]
+
+    def forget(self, keys):
+        with closing(self._conn()) as conn:
+            conn.executemany("DELETE FROM uploads WHERE key = ?", [(k,) for k in keys])
+
+    def count(self):
+        with closing(self._conn()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+retention_manifest = RetentionManifest(R2_MANIFEST_PATH)
+retention_event = Event()
+
+def bootstrap_retention_manifest(s3_client):
+    """Unica scansione completa di `videos/`: importa nell'indice i video caricati prima del manifest."""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    imported = 0
+    for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix="videos/"):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".mp4"):
+                retention_manifest.record(obj["Key"], obj.get("Size"), None, obj["LastModified"].timestamp(),
+                                          replace=False)
+                imported += 1
+    retention_manifest.mark_bootstrapped()
+    print(f"🗂️ Manifest R2 inizializzato: {imported} video esistenti", flush=True)
+
+def apply_retention(s3_client):
+    """Cancella in batch (delete_objects, max 1000 chiavi) i video fuori policy. Ritorna il numero cancellato."""
+    if not retention_manifest.is_bootstrapped():
+        bootstrap_retention_manifest(s3_client)
+    expired = retention_manifest.expired_keys(R2_RETENTION_KEEP_LAST, R2_RETENTION_MAX_AGE_DAYS)
+    deleted_total = 0
+    for start in range(0, len(expired), R2_DELETE_BATCH):
+        batch = expired[start:start + R2_DELETE_BATCH]
+        resp = s3_client.delete_objects(
+            Bucket=R2_BUCKET_NAME,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+        failed = {err["Key"] for err in resp.get("Errors", [])}
+        for err in resp.get("Errors", [])[:5]:
+            print(f"⚠️ Retention: {err.get('Key')} non cancellato ({err.get('Code')})", flush=True)
+        deleted = [k for k in batch if k not in failed]
+        retention_manifest.forget(deleted)
+        deleted_total += len(deleted)
+    if deleted_total:
+        print(f"✅ Rotazione completata: {deleted_total} video vecchi rimossi", flush=True)
+    return deleted_total
+
+def retention_loop():
+    """Retention periodica (R2_RETENTION_INTERVAL) o anticipata da un upload, fuori dal path dei job."""
+    while not shutdown_event.is_set():
+        retention_event.wait(R2_RETENTION_INTERVAL)
+        retention_event.clear()
+        if shutdown_event.is_set():
+            return
+        try:
+            apply_retention(get_s3_client())
+        except Exception as e:
+            print(f"⚠️ Errore rotazione R2 (video vecchi restano): {str(e)}", flush=True)
+
+class WebhookDispatcher:
+    """Consegna webhook fuori dal path del job: coda di processo servita da un thread.
+
+    POST sulla Session condivisa; errori di rete, 429 e 5xx si ritentano con backoff (Retry-After
+    se presente) fino a `max_retries`, gli altri 4xx no. Le consegne fallite finiscono come riga
+    JSON in `dead_letter_path` per il replay manuale.
+
+    Con `journal_dir` ogni webhook è scritto su disco (`<pid>-<id>.json`) prima di entrare in
+    coda e rimosso quando è consegnato o in dead-letter: `replay` all'avvio rimette in coda
+    quelli rimasti da un processo morto (crash, OOM, shutdown oltre il grace).
+    """
+
+    def __init__(self, dead_letter_path, max_retries=WEBHOOK_MAX_RETRIES, timeout=WEBHOOK_TIMEOUT, journal_dir=None):
+        self.dead_letter_path = dead_letter_path
+        self.journal_dir = journal_dir
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.lock = Lock()
+        self.thread = None
+        self.stats = {"delivered": 0, "retries": 0, "dead_lettered": 0}
+
+    def enqueue(self, name, url, payload):
+        item = {"id": uuid.uuid4().hex, "name": name, "url": url, "payload": payload, "enqueued_at": time.time()}
+        self.journal(item)
+        self._put(item)
+
+    def _put(self, item):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._loop, name="webhook-dispatcher", daemon=True)
+                self.thread.start()
+        self.queue.put(item)
+
+    def journal_path(self, item_id, pid=None):
+        return os.path.join(self.journal_dir, f"{pid or os.getpid()}-{item_id}.json")
+
+    def journal(self, item):
+        """Scrive il webhook nel journal (tmp + os.replace). Errori non bloccanti: resta in memoria."""
+        if not self.journal_dir:
+            return
+        path = self.journal_path(item["id"])
+        tmp_path = f"{path}.tmp"
+        try:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(item, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Journal webhook non scritto ({e}), consegna solo in memoria", flush=True)
+
+    def settle(self, item):
+        """Consegnato o in dead-letter: fuori dal journal."""
+        if not self.journal_dir or "id" not in item:
+            return
+        try:
+            os.unlink(self.journal_path(item["id"]))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _process_alive(pid):
+        if pid == os.getpid():
+            return False  # replay all'avvio: i nostri file sono di un processo precedente con lo stesso pid
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    def replay(self):
+        """Rimette in coda i webhook nel journal di processi non più vivi. Ritorna quanti."""
+        if not self.journal_dir:
+            return 0
+        try:
+            names = os.listdir(self.journal_dir)
+        except OSError:
+            return 0
+        replayed = 0
+        for name in sorted(names):
+            pid, _, rest = name.partition("-")
+            if not name.endswith(".json") or not pid.isdigit() or self._process_alive(int(pid)):
+                continue
+            item_id = rest[:-len(".json")]
+            claimed = self.journal_path(item_id)
+            try:
+                os.rename(os.path.join(self.journal_dir, name), claimed)  # un solo worker vince
+                with open(claimed) as f:
+                    item = json.load(f)
+            except OSError:
+                continue
+            except ValueError:
+                os.unlink(claimed)
+                continue
+            self._put(dict(item, id=item_id))
+            replayed += 1
+        if replayed:
+            print(f"🔔 Webhook ripresi dal journal: {replayed}", flush=True)
+        return replayed
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.deliver(item)
+            except Exception as e:
+                print(f"⚠️ Webhook {item['name']}: {e}", flush=True)
+            finally:
+                self.settle(item)
+                self.queue.task_done()
+
+    def deliver(self, item):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            resp = None
+            try:
+                resp = get_http_session().post(item["url"], json=item["payload"],
+                                               timeout=(HTTP_CONNECT_TIMEOUT, self.timeout))
+                print(f"🔔 Webhook {item['name']} status={resp.status_code}", flush=True)
+                if resp.status_code < 400:
+                    self._count("delivered")
+                    return True
+                error = f"HTTP {resp.status_code}"
+                if resp.status_code not in RETRY_STATUS:
+                    break
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < self.max_retries:
+                self._count("retries")
+                time.sleep(backoff_delay(attempt, resp))
+        self.dead_letter(item, error, attempt + 1)
+        return False
+
+    def dead_letter(self, item, error, attempts):
+        print(f"❌ Webhook {item['name']} in dead-letter dopo {attempts} tentativi: {error}", flush=True)
+        self._count("dead_lettered")
+        line = json.dumps(dict(item, error=error, attempts=attempts, failed_at=time.time()))
+        try:
+            os.makedirs(os.path.dirname(self.dead_letter_path) or ".", exist_ok=True)
+            with self.lock, open(self.dead_letter_path, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"⚠️ Dead-letter webhook non scritto ({e}): {line}", flush=True)
+
+    def flush(self, timeout):
+        """Aspetta fino a `timeout` secondi che la coda si svuoti (shutdown). True se vuota."""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return not self.queue.unfinished_tasks
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, queued=self.queue.unfinished_tasks)
+
+webhook_dispatcher = WebhookDispatcher(WEBHOOK_DEAD_LETTER_PATH, journal_dir=WEBHOOK_JOURNAL_DIR)
+
+def notify_n8n_flusso2(job):
+    """Accoda il webhook n8n del job completato (consegna in background, vedi WebhookDispatcher)."""
+    if not N8N_WEBHOOK_URL_FLUSSO2:
+        print("⚠️ N8N_WEBHOOK_URL_SIGNIFICATO_DEI_SOGNI_FLUSSO2 non configurata, skip webhook", flush=True)
+        return
+
+    payload = {
+        "job_id": job.get("job_id"),
+        "video_url": job.get("video_url"),
+        "duration": job.get("duration"),
+        "clips_used": job.get("clips_used"),
+        "title": job.get("data", {}).get("title"),
+        "description_pro": job.get("data", {}).get("description_pro"),
+        "row_id": job.get("row_number") or job.get("data", {}).get("row_id"),
+        "keywords": job.get("data", {}).get("keywords"),
+        "playlist": job.get("data", {}).get("playlist"),
+        "channel": "significato_sogni",
+    }
+    webhook_dispatcher.enqueue("n8n flusso2", N8N_WEBHOOK_URL_FLUSSO2, payload)
+
+# -------------------------------------------------
+# Workspace per job: file intermedi in una directory + manifest dei checkpoint per il resume
+# -------------------------------------------------
+class JobWorkspace:
+    """Directory JOB_WORKSPACE_DIR/<job_id> con tutti i file intermedi del job e un manifest.json.
+
+    Il manifest registra le fasi completate (audio, clip normalizzate una per una, render,
+    upload, sheets) con i file relativi alla directory: un job ripreso dopo un crash o un
+    redeploy riparte dall'ultimo checkpoint valido. A fine job, o dal janitor se abbandonata,
+    si elimina la directory intera.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, job_id, root=JOB_WORKSPACE_DIR):
+        self.job_id = job_id
+        self.dir = os.path.join(root, job_id)
+        self.lock = Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        self.manifest = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path(self.MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest.setdefault("job_id", self.job_id)
+        manifest.setdefault("stages", {})
+        manifest.setdefault("clips", {})
+        return manifest
+
+    def _save(self):
+        self.manifest["updated_at"] = time.time()
+        tmp_path = self.path(f"{self.MANIFEST}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.path(self.MANIFEST))
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def checkpoint(self, stage, **info):
+        """Fase completata; i valori `*_file` sono path dentro la workspace (salvati relativi)."""
+        info = {k: os.path.basename(v) if k.endswith("_file") and v else v for k, v in info.items()}
+        with self.lock:
+            self.manifest["stages"][stage] = info
+            self._save()
+
+    def stage(self, stage):
+        """Info del checkpoint, None se assente o se uno dei suoi file non esiste più."""
+        with self.lock:
+            info = self.manifest["stages"].get(stage)
+        if info is None:
+            return None
+        info = {k: self.path(v) if k.endswith("_file") and v else v for k, v in info.items()}
+        if not all(os.path.exists(v) for k, v in info.items() if k.endswith("_file") and v):
+            return None
+        return info
+
+    def record_clip(self, scene, path, duration):
+        with self.lock:
+            self.manifest["clips"][str(scene)] = {"file": os.path.basename(path), "duration": duration}
+            self._save()
+
+    def clips(self):
+        """{scena: (path, durata)} delle clip normalizzate ancora presenti su disco."""
+        with self.lock:
+            clips = dict(self.manifest["clips"])
+        done = {}
+        for scene, info in clips.items():
+            path = self.path(info["file"])
+            if os.path.exists(path):
+                media_metadata.remember(path, info["duration"], "cache")
+                done[int(scene)] = (path, info["duration"])
+        return done
 
-def cleanup_old_videos(s3_client, current_key):
-    """Cancella tutti i video MP4 in R2 TRANNE quello appena caricato"""
-    try:
-        paginator = s3_client.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix="videos/")
-        deleted_count = 0
-        for page in pages:
-            if "Contents" not in page:
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def dir_size(path, seen=None):
+    """Byte sotto `path`; con `seen` (set di inode) i file hard-linked si contano una volta sola."""
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
                 continue
-            for obj in page["Contents"]:
-                key = obj["Key"]
-                if key.endswith(".mp4") and key != current_key:
-                    s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=key)
-                    deleted_count += 1
-                    print(f"🗑️ Cancellato vecchio video: {key}", flush=True)
-        if deleted_count > 0:
-            print(f"✅ Rotazione completata: {deleted_count} video vecchi rimossi", flush=True)
-        else:
-            print("✅ Nessun video vecchio da rimuovere", flush=True)
-    except Exception as e:
-        print(f"⚠️ Errore rotazione R2 (video vecchi restano): {str(e)}", flush=True)
+            if seen is not None:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
 
-def notify_n8n_flusso2(job):
-    """Invia webhook a n8n quando il job è completato."""
-    if not N8N_WEBHOOK_URL_FLUSSO2:
-        print("⚠️ N8N_WEBHOOK_URL_SIGNIFICATO_DEI_SOGNI_FLUSSO2 non configurata, skip webhook", flush=True)
-        return
+def reap_workspaces(now=None):
+    """Elimina le workspace abbandonate e tiene il totale sotto JOB_WORKSPACE_MAX_MB.
 
+    Via subito quelle di job terminati/scaduti dallo store o, se il job non è in processing (lease
+    di un worker, anche di un altro processo), ferme da più di JOB_WORKSPACE_MAX_AGE;
+    oltre il budget poi cadono le più vecchie dei job non in esecuzione (un job in coda perde
+    solo il resume); le righe waiting di un batch il cui piano è ancora attivo non si toccano.
+    Le clip hard-linked tra workspace (stessa clip in più righe) contano una volta sola.
+    """
+    now = now or time.time()
     try:
-        payload = {
-            "job_id": job.get("job_id"),
-            "video_url": job.get("video_url"),
-            "duration": job.get("duration"),
-            "clips_used": job.get("clips_used"),
-            "title": job.get("data", {}).get("title"),
-            "description_pro": job.get("data", {}).get("description_pro"),
-            "row_id": job.get("row_number") or job.get("data", {}).get("row_id"),
-            "keywords": job.get("data", {}).get("keywords"),
-            "playlist": job.get("data", {}).get("playlist"),
-            "channel": "significato_sogni",
-        }
-        resp = requests.post(N8N_WEBHOOK_URL_FLUSSO2, json=payload, timeout=15)
-        print(f"🔔 Webhook n8n flusso2 status={resp.status_code}", flush=True)
-    except Exception as e:
-        print(f"⚠️ Errore invio webhook n8n flusso2: {e}", flush=True)
+        names = os.listdir(JOB_WORKSPACE_DIR)
+    except OSError:
+        return 0
+    removed = 0
+    candidates = []
+    total = 0
+    seen = set()
+    with active_jobs_lock:
+        running = set(active_jobs)
+    # prima le workspace in esecuzione: i file condivisi restano attribuiti a loro
+    for name in sorted(names, key=lambda n: n not in running):
+        workdir = os.path.join(JOB_WORKSPACE_DIR, name)
+        if not os.path.isdir(workdir):
+            continue
+        if name in running:
+            total += dir_size(workdir, seen)
+            continue
+        try:
+            mtime = os.path.getmtime(os.path.join(workdir, JobWorkspace.MANIFEST))
+        except OSError:
+            mtime = os.path.getmtime(workdir)
+        record = job_store.get(name)
+        status = record.get("status") if record else None
+        stale = status != "processing" and now - mtime > JOB_WORKSPACE_MAX_AGE
+        if status is None or status in TERMINAL_STATUSES or stale:
+            shutil.rmtree(workdir, ignore_errors=True)
+            removed += 1
+            continue
+        size = dir_size(workdir, seen)
+        total += size
+        if status == "waiting":
+            plan = job_store.get(record.get("batch_id") or "")
+            if plan and plan.get("status") not in TERMINAL_STATUSES:
+                continue
+        if status != "processing":
+            candidates.append((mtime, size, workdir))
+    budget = JOB_WORKSPACE_MAX_MB * 1024 * 1024
+    for _mtime, size, workdir in sorted(candidates):
+        if total <= budget:
+            break
+        shutil.rmtree(workdir, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
 # -------------------------------------------------
-# Mapping SCENA → QUERY visiva (canale SIGNIFICATO DEI SOGNI)
+# Mapping SCENA → QUERY visiva (canale SIGNIFICATO DEI SOGNI, regole in keyword_rules.json)
 # -------------------------------------------------
+class KeywordMatcher:
+    """Classificatore keyword precompilato una volta all'import da un file di regole (riusabile da altri canali).
+
+    Le regole diventano tuple piatte scandite con `map(str.__contains__, ...)`: una sola passata in C
+    per scena invece di 17 generatori `any(w in ctx ...)`. Le alternation regex (anche con lookahead
+    per gli overlap) su stringhe così corte sono risultate 2-5x più lente: vedi
+    benchmarks/bench_keywords.py. I match restano sottostringhe, come prima.
+    """
+
+    def __init__(self, rules):
+        self.channel = rules.get("channel", "")
+        self.default_query = rules["default_query"]
+        self.keywords_query_template = rules["keywords_query_template"]
+        self.scene_queries = tuple(rule["query"] for rule in rules["scene_rules"])
+        # termini di tutte le regole in ordine di priorità + indice della regola di ciascun termine
+        self.scene_terms = tuple(t.lower() for rule in rules["scene_rules"] for t in rule["terms"])
+        self.scene_term_rule = tuple(i for i, rule in enumerate(rules["scene_rules"]) for _t in rule["terms"])
+        self.dream_terms = tuple(dict.fromkeys(t.lower() for t in rules["dream_keywords"]))
+        self.banned_terms = tuple(dict.fromkeys(t.lower() for t in rules["banned_keywords"]))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def scene_rule_index(self, ctx):
+        """Indice della prima regola con un termine contenuto in `ctx` (None se nessuna)."""
+        return next(compress(self.scene_term_rule, map(ctx.__contains__, self.scene_terms)), None)
+
+    def pick_query(self, context, keywords_text=""):
+        ctx = (context or "").lower()
+        kw = (keywords_text or "").lower()
+        index = self.scene_rule_index(ctx)
+        if index is not None:
+            return self.scene_queries[index]
+        if kw and kw != "none":
+            return self.keywords_query_template.format(keywords=kw)
+        return self.default_query
+
+    def is_banned(self, text):
+        return any(map(text.__contains__, self.banned_terms))
+
+    def dream_count(self, text):
+        return sum(map(text.__contains__, self.dream_terms))
+
+    def classify(self, text):
+        """(dream_count, has_banned) su testo già in minuscolo."""
+        return self.dream_count(text), self.is_banned(text)
+
+keyword_matcher = KeywordMatcher.from_file(KEYWORD_RULES_PATH)
+
 def pick_visual_query(context: str, keywords_text: str = "") -> str:
     """Query ottimizzate per B-roll SOGNI: atmosfera onirica, simboli, introspezione psicologica."""
-    ctx = (context or "").lower()
-    kw = (keywords_text or "").lower()
-    
-    base = "dreamlike night sky surreal clouds moonlight abstract shapes introspective person thinking"
-    
-    if any(w in ctx for w in ["ricorrent", "sempre lo stesso", "ripet", "loop"]):
-        return "repeating corridor endless hallway looping doors abstract repetition surreal pattern"
-    if any(w in ctx for w in ["ansia", "paura", "terror", "incubo", "angoscia", "panico"]):
-        return "dark corridor shadowy figure dramatic lighting person stressed surreal nightmare atmosphere"
-    if any(w in ctx for w in ["ex", "relazione", "amore", "partner", "fidanzat"]):
-        return "couple silhouette at night distant people city lights person looking old photos emotional"
-    if any(w in ctx for w in ["famiglia", "genitori", "madre", "padre", "figli", "bambin"]):
-        return "family silhouettes warm home interior parents with child soft light nostalgic atmosphere"
-    if any(w in ctx for w in ["morte", "lutto", "perdita", "funerale", "addio"]):
-        return "lonely person cemetery sunset field person sitting alone bench reflective grief mood"
-    if any(w in ctx for w in ["volare", "volo", "libertà", "libero"]):
-        return "person on mountain top arms open birds in sky clouds airplane window wide open sky"
-    if any(w in ctx for w in ["cadere", "vuoto", "precipitar", "crollo"]):
-        return "view from high building down abstract falling shapes person looking down height dramatic"
-    if any(w in ctx for w in ["inseguit", "scappare", "fuga", "scappando"]):
-        return "person running at night dark alley light at end blurred motion tense chase atmosphere"
-    if any(w in ctx for w in ["nudo", "nuda", "vergogna", "imbarazz", "esposto"]):
-        return "person covering with blanket spotlight on stage crowd blurred shame concept"
-    if any(w in ctx for w in ["mare", "acqua", "oceano", "onda", "tsunami", "pioggia"]):
-        return "ocean waves slow motion underwater light rays rain on window calm stormy sea"
-    if any(w in ctx for w in ["casa", "stanza", "porta", "corridoio", "scalinata"]):
-        return "mysterious door light behind long corridor house interior shadows stairs low light"
-    if any(w in ctx for w in ["cane", "gatto", "serpente", "animale", "leone", "ragno"]):
-        return "animal silhouette fog close up eye animal surreal environment symbolic wildlife"
-    if any(w in ctx for w in ["esame", "scuola", "università", "lavoro", "colloquio", "licenziato"]):
-        return "student classroom stressed person office desk night alarm clock papers books"
-    if any(w in ctx for w in ["sogno lucido", "lucidi", "controllo sogno", "consapevole"]):
-        return "person floating space surreal landscape glowing moon mountains abstract geometric dream world"
-    if any(w in ctx for w in ["trauma", "incident", "shock", "attacco"]):
-        return "broken glass slow motion person sitting floor dark room dramatic shadow lighting"
-    if any(w in ctx for w in ["archetipo", "jung", "ombra", "inconscio", "psiche"]):
-        return "surreal human silhouette galaxy inside split face light shadow abstract psychological art"
-    if any(w in ctx for w in ["premonit", "spiritual", "segnale", "universo", "destino"]):
-        return "starry night sky person looking stars galaxy timelapse light beams from sky"
-    
-    if kw and kw != "none":
-        return f"{kw}, dreamy night sky, surreal atmosphere, symbolic visuals, introspective person"
-    
-    return base
+    return keyword_matcher.pick_query(context, keywords_text)
 
 def is_sogni_video_metadata(video_data, source):
     """🔧 Filtro SOGNI - NO banned (sport/cucina/gaming/business) + atmosfera onirica"""
-    dream_keywords = ["dream", "night", "sky", "clouds", "moon", "stars", "surreal", "abstract", 
-                      "person", "thinking", "silhouette", "shadow", "light", "emotional", "reflective",
-                      "water", "ocean", "corridor", "dark", "mysterious", "spiritual", "cosmic"]
-    banned = ["football", "soccer", "basketball", "tennis", "sport", "workout", "gym", "fitness",
-              "kitchen", "cooking", "recipe", "food", "restaurant", "party", "festival", "concert",
-              "videogame", "gaming", "esports", "business", "stock market", "money", "dollar", "finance"]
-    
     if source == "pexels":
         text = (video_data.get("description", "") + " " + " ".join(video_data.get("tags", []))).lower()
     else:
         text = " ".join(video_data.get("tags", [])).lower()
     
-    dream_count = sum(1 for kw in dream_keywords if kw in text)
-    has_banned = any(kw in text for kw in banned)
+    has_banned = keyword_matcher.is_banned(text)
     
-    if has_banned:
-        status = "❌ BANNED"
-    elif dream_count >= 1:
-        status = f"✅ DREAM({dream_count})"
-    else:
-        status = f"⚠️ NEUTRAL(dream:{dream_count})"
-    
-    print(f"🔍 [{source}] '{text[:60]}...' → {status}", flush=True)
+    # il conteggio dream serve solo al log: calcolato solo per le righe campionate
+    if should_log_sample():
+        dream_count = keyword_matcher.dream_count(text)
+        if has_banned:
+            status = "❌ BANNED"
+        elif dream_count >= 1:
+            status = f"✅ DREAM({dream_count})"
+        else:
+            status = f"⚠️ NEUTRAL(dream:{dream_count})"
+        print(f"🔍 [{source}] '{text[:60]}...' → {status}", flush=True)
     return not has_banned
 
-def download_file(url: str) -> str:
-    tmp_clip = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    clip_resp = requests.get(url, stream=True, timeout=30)
-    clip_resp.raise_for_status()
-    for chunk in clip_resp.iter_content(chunk_size=1024 * 1024):
-        if chunk:
-            tmp_clip.write(chunk)
-    tmp_clip.close()
-    return tmp_clip.name
-
-def fetch_clip_for_scene(scene_number: int, query: str, avg_scene_duration: float):
-    """🎯 Canale SOGNI: B-roll onirico. Fallback Pixabay se Pexels 0."""
-    target_duration = min(4.0, avg_scene_duration)
+def stream_to_file(stream, path):
+    """Copia uno stream su disco a blocchi da UPLOAD_CHUNK_SIZE senza tenerlo in memoria."""
+    written = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                f.write(chunk)
+                written += len(chunk)
+    except Exception:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        raise
+    return written
+
+def write_base64_to_file(b64_text, path):
+    """Decodifica base64 su file a blocchi (multipli di 4 caratteri) invece di un unico b64decode.
+    Su base64 non valido (binascii.Error, un ValueError) il file parziale si elimina."""
+    try:
+        if not BASE64_PLAIN_RE.fullmatch(b64_text):
+            # whitespace/caratteri extra: b64decode li scarta, lo spezzettamento non sarebbe allineato
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(b64_text))
+            return
+        step = UPLOAD_CHUNK_SIZE * 4
+        with open(path, "wb") as f:
+            for start in range(0, len(b64_text), step):
+                f.write(base64.b64decode(b64_text[start:start + step]))
+    except Exception:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        raise
+
+def upload_path_for(job_id, suffix=".bin"):
+    os.makedirs(AUDIO_UPLOAD_DIR, exist_ok=True)
+    return os.path.join(AUDIO_UPLOAD_DIR, f"{job_id}{suffix}")
+
+def discard_job_upload(record):
+    """Elimina l'audio caricato di un job che non girerà più (es. abbandonato da claim)."""
+    audio_path = (record.get("data") or {}).get("audio_path")
+    if audio_path:
+        try:
+            os.unlink(audio_path)
+        except OSError:
+            pass
+
+def reap_uploads(now=None):
+    """Elimina da AUDIO_UPLOAD_DIR gli upload di job terminati o spariti dallo store."""
+    now = now or time.time()
+    try:
+        names = os.listdir(AUDIO_UPLOAD_DIR)
+    except OSError:
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(AUDIO_UPLOAD_DIR, name)
+        job_id = name.split(".", 1)[0]
+        try:
+            if now - os.path.getmtime(path) < UPLOAD_ORPHAN_GRACE:
+                continue
+        except OSError:
+            continue
+        record = job_store.get(job_id)
+        if record is None or record.get("status") in TERMINAL_STATUSES:
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def read_generate_request(job_id):
+    """Parametri del job da /generate, con l'audio già scritto su disco (`audio_path`).
+
+    - multipart/form-data: file `audio` + campi del form (opzionale `metadata` JSON)
+    - audio/* o application/octet-stream: body = audio, parametri in query string
+    - JSON: `audio_url` (scaricato dal worker) oppure `audio_base64` legacy, decodificato su
+      disco e rimosso dal payload salvato nel job store
+
+    Input malformato (metadata JSON, base64) solleva ValueError: /generate risponde 400.
+    """
+    mimetype = request.mimetype or ""
+    if mimetype == "multipart/form-data":
+        data = {k: v for k, v in request.form.items() if k != "metadata"}
+        if request.form.get("metadata"):
+            data.update(json.loads(request.form["metadata"]))
+        audio = request.files.get("audio")
+        if audio:
+            suffix = os.path.splitext(audio.filename or "")[1] or ".bin"
+            data["audio_path"] = upload_path_for(job_id, suffix)
+            stream_to_file(audio.stream, data["audio_path"])
+        return data
+    if mimetype.startswith("audio/") or mimetype == "application/octet-stream":
+        data = {k: v for k, v in request.args.items() if k != "metadata"}
+        if request.args.get("metadata"):
+            data.update(json.loads(request.args["metadata"]))
+        data["audio_path"] = upload_path_for(job_id)
+        stream_to_file(request.stream, data["audio_path"])
+        return data
+    return spool_base64_audio(job_id, request.get_json(force=True) or {})
+
+def spool_base64_audio(job_id, data):
+    """Sposta l'`audio_base64` legacy dal payload JSON a un file su disco (`audio_path`)."""
+    audiobase64 = data.pop("audio_base64", None) or data.pop("audiobase64", None)
+    if audiobase64 and not data.get("audio_url"):
+        data["audio_path"] = upload_path_for(job_id)
+        write_base64_to_file(audiobase64, data["audio_path"])
+    return data
+
+def download_file(url: str, provider: str = None, metrics: "JobMetrics" = None, workdir: str = None) -> str:
+    """Scarica una clip su file temporaneo (in `workdir` se dato). Con `provider` rispetta il cap di
+    download CDN del provider (non quello delle API di ricerca) e fa retry su 429/5xx e sugli
+    errori di rete, anche a metà body (connessione chiusa, chunk troncato): si riparte da zero."""
+    started = time.monotonic()
+    slot = PROVIDER_LIMITS[provider]["downloads"] if provider else nullcontext()
+    for attempt in range(PROVIDER_MAX_RETRIES + 1):
+        resp = None
+        try:
+            with slot:
+                resp = get_http_session().get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT))
+                if resp.status_code not in RETRY_STATUS:
+                    resp.raise_for_status()
+                    tmp_clip = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=workdir)
+                    try:
+                        for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                            if chunk:
+                                tmp_clip.write(chunk)
+                    except Exception:
+                        resp.close()
+                        tmp_clip.close()
+                        os.unlink(tmp_clip.name)
+                        raise
+                    tmp_clip.close()
+                    size = os.path.getsize(tmp_clip.name)
+                    elapsed = time.monotonic() - started
+                    DOWNLOAD_SECONDS.observe(elapsed, provider or "other")
+                    DOWNLOAD_BYTES.inc(size, provider or "other")
+                    if metrics:
+                        metrics.record_clip(kind="download", provider=provider or "other",
+                                            bytes=size, seconds=round(elapsed, 3), attempts=attempt + 1)
+                    return tmp_clip.name
+                resp.close()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt >= PROVIDER_MAX_RETRIES:
+                raise
+            print(f"⚠️ Download interrotto ({type(e).__name__}), retry {attempt + 1}/{PROVIDER_MAX_RETRIES}", flush=True)
+        if attempt >= PROVIDER_MAX_RETRIES:
+            resp.raise_for_status()
+        time.sleep(backoff_delay(attempt, resp))
+
+def cached_download(provider: str, video_id, url: str, metrics: "JobMetrics" = None,
+                    duration: float = None, workdir: str = None) -> str:
+    """download_file con cache locale: chiave = provider + ID video + URL della rendition.
+
+    `duration` (metadata del provider) finisce nel sidecar della cache e in media_metadata.
+    Job concorrenti che chiedono la stessa clip aspettano un unico download e usano la cache.
+    """
+    key = FileCache.key_for(provider, video_id, url)
+    with clip_cache.filling(key):
+        cached = clip_cache.lookup(key)
+        if cached:
+            try:
+                path = clip_cache.link_out(cached, workdir=workdir)
+                if metrics:
+                    metrics.record_clip(kind="cache_hit", provider=provider, bytes=os.path.getsize(path), seconds=0.0)
+                media_metadata.remember(path, (clip_cache.read_meta(key) or {}).get("duration") or duration, "cache")
+                return path
+            except OSError:
+                pass
+        path = download_file(url, provider=provider, metrics=metrics, workdir=workdir)
+        clip_cache.store(key, path, {"provider": provider, "video_id": video_id, "url": url, "duration": duration})
+    media_metadata.remember(path, duration, "provider")
+    return path
+
+def pick_rendition(files):
+    """URL della rendition da scaricare tra `files` = [(larghezza, url), ...] in ordine del provider."""
+    wide = [(width, url) for width, url in files if width >= MIN_CLIP_WIDTH]
+    if not wide:
+        return None
+    if CLIP_RENDITION == "smallest":
+        return min(wide, key=lambda f: f[0])[1]
+    return wide[0][1]
+
+def ceil_to_frame(seconds):
+    """`seconds` arrotondati per eccesso al frame successivo a NORMALIZE_FPS."""
+    return math.ceil(round(seconds * NORMALIZE_FPS, 6)) / NORMALIZE_FPS
+
+def fetch_clip_for_scene(scene_number: int, query: str, avg_scene_duration: float,
+                         metrics: "JobMetrics" = None, picker: ClipPicker = None, workdir: str = None):
+    """🎯 Canale SOGNI: B-roll onirico. Fallback Pixabay se Pexels 0.
+
+    Ritorna (path, secondi da usare): con CLIP_TRIM la scena occupa avg_scene_duration arrotondata
+    al frame successivo e normalize_clip codifica solo quel segmento; None = clip intera.
+    """
+    target_duration = ceil_to_frame(avg_scene_duration) if CLIP_TRIM else None
+    scene_started = time.monotonic()
+    picker = picker or ClipPicker()
+    
+    def cached_search(provider, url, page, filters, params, headers=None, results_field="videos"):
+        def fetch():
+            search_started = time.monotonic()
+            resp = provider_get(provider, url, headers=headers, params=params,
+                                timeout=(HTTP_CONNECT_TIMEOUT, SEARCH_READ_TIMEOUT))
+            if metrics:
+                metrics.record_clip(kind="search", provider=provider, scene=scene_number,
+                                    seconds=round(time.monotonic() - search_started, 3), status=resp.status_code)
+            if resp.status_code != 200:
+                return None
+            return resp.json().get(results_field, [])
+        return search_cache.get_or_fetch(provider, query, page, filters, fetch)
     
     def try_pexels():
         if not PEXELS_API_KEY:
             return None
         headers = {"Authorization": PEXELS_API_KEY}
-        params = {
-            "query": f"{query} dreamy night surreal abstract psychology",
-            "orientation": "landscape",
-            "per_page": 25,
-            "page": random.randint(1, 3),
-        }
-        resp = requests.get("https://api.pexels.com/videos/search", headers=headers, params=params, timeout=20)
-        if resp.status_code != 200:
+        filters = {"orientation": "landscape", "per_page": 25}
+        page = picker.page("pexels", query)
+        params = dict(filters, query=f"{query} dreamy night surreal abstract psychology", page=page)
+        videos = cached_search("pexels", PEXELS_API_URL, page, filters, params, headers=headers)
+        if videos is None:
             return None
-        videos = resp.json().get("videos", [])
         dream_videos = [v for v in videos if is_sogni_video_metadata(v, "pexels")]
-        print(f"🎯 Pexels: {len(videos)} totali → {len(dream_videos)} OK (no banned)", flush=True)
-        if dream_videos:
-            video = random.choice(dream_videos)
-            for vf in video.get("video_files", []):
-                if vf.get("width", 0) >= 1280:
-                    return download_file(vf["link"])
+        log_sampled(f"🎯 Pexels: {len(videos)} totali → {len(dream_videos)} OK (no banned)")
+        video = picker.pick("pexels", dream_videos)
+        if video:
+            url = pick_rendition([(vf.get("width") or 0, vf["link"]) for vf in video.get("video_files", []) if vf.get("link")])
+            if url:
+                return cached_download("pexels", video.get("id"), url, metrics=metrics,
+                                       duration=video.get("duration"), workdir=workdir)
         return None
     
     def try_pixabay():
         if not PIXABAY_API_KEY:
             return None
-        params = {
-            "key": PIXABAY_API_KEY,
-            "q": f"{query} dreamy night surreal abstract psychology",
-            "per_page": 25,
-            "safesearch": "true",
-            "min_width": 1280,
-        }
-        resp = requests.get("https://pixabay.com/api/videos/", params=params, timeout=20)
-        if resp.status_code != 200:
+        filters = {"per_page": 25, "safesearch": "true", "min_width": 1280}
+        params = dict(filters, key=PIXABAY_API_KEY, q=f"{query} dreamy night surreal abstract psychology")
+        hits = cached_search("pixabay", PIXABAY_API_URL, 1, filters, params, results_field="hits")
+        if hits is None:
             return None
-        hits = resp.json().get("hits", [])
-        for hit in hits:
-            if is_sogni_video_metadata(hit, "pixabay"):
-                videos = hit.get("videos", {})
-                for quality in ["large", "medium", "small"]:
-                    if quality in videos and "url" in videos[quality]:
-                        return download_file(videos[quality]["url"])
+        candidates = [
+            hit for hit in hits
+            if is_sogni_video_metadata(hit, "pixabay")
+            and any("url" in hit.get("videos", {}).get(q, {}) for q in ("large", "medium", "small"))
+        ]
+        hit = picker.pick("pixabay", candidates, randomize=False)
+        if hit:
+            videos = hit.get("videos", {})
+            files = [(videos[q].get("width") or 0, videos[q]["url"])
+                     for q in ("large", "medium", "small") if "url" in videos.get(q, {})]
+            # la ricerca filtra già min_width: se le larghezze mancano vale la prima disponibile
+            url = pick_rendition(files) or files[0][1]
+            return cached_download("pixabay", hit.get("id"), url, metrics=metrics,
+                                   duration=hit.get("duration"), workdir=workdir)
         return None
     
     for source_name, func in [("Pexels", try_pexels), ("Pixabay", try_pixabay)]:
         try:
             path = func()
             if path:
-                print(f"🎥 Scena {scene_number}: '{query[:40]}...' → {source_name} ✓", flush=True)
+                log_sampled(f"🎥 Scena {scene_number}: '{query[:40]}...' → {source_name} ✓ "
+                            f"({time.monotonic() - scene_started:.1f}s)")
                 return path, target_duration
         except Exception as e:
             print(f"⚠️ {source_name}: {e}", flush=True)
@@ -275,9 +2190,372 @@ def fetch_clip_for_scene(scene_number: int, query: str, avg_scene_duration: floa
     print(f"⚠️ NO CLIP per scena {scene_number}: '{query}'", flush=True)
     return None, None
 
+def run_clip_pipeline(scene_assignments, avg_scene_duration, metrics=None, workspace=None, profile=None):
+    """Download → normalize → probe per clip, senza barriere tra le fasi.
+
+    FETCH_WORKERS thread scaricano e mettono le clip in una coda di PIPELINE_QUEUE_SIZE posti,
+    NORMALIZE_WORKERS thread le normalizzano (e ne leggono la durata) appena arrivano: la rete
+    lavora mentre ffmpeg codifica. Con la coda piena i download aspettano, così su disco restano
+    al massimo FETCH_WORKERS + PIPELINE_QUEUE_SIZE + NORMALIZE_WORKERS sorgenti.
+    Con `workspace` ogni clip normalizzata è un checkpoint: le scene già pronte non si rifanno.
+    Ritorna ([(clip_normalizzata, durata), ...] in ordine di scena, numero di clip scaricate).
+    """
+    downloaded = queue.Queue(maxsize=max(1, PIPELINE_QUEUE_SIZE))
+    results = [None] * len(scene_assignments)
+    fetched = []
+    picker = ClipPicker()
+    workdir = workspace.dir if workspace else None
+    done = workspace.clips() if workspace else {}
+    for i, scene in enumerate(scene_assignments):
+        if scene["scene"] in done:
+            results[i] = done[scene["scene"]]
+            fetched.append(i)
+    pending = [i for i in range(len(scene_assignments)) if results[i] is None]
+    
+    def download(i):
+        scene = scene_assignments[i]
+        try:
+            path, segment = fetch_clip_for_scene(scene["scene"], scene["query"], avg_scene_duration, metrics, picker, workdir)
+        except Exception as e:
+            print(f"⚠️ Scena {scene['scene']}: {e}", flush=True)
+            return
+        if path:
+            fetched.append(i)
+            downloaded.put((i, path, segment, time.monotonic()))
+    
+    def normalize_one(i, clip_path, segment, queued_at):
+        started = time.monotonic()
+        try:
+            results[i] = normalize_clip(clip_path, metrics, segment, workdir, profile)
+            if workspace:
+                workspace.record_clip(scene_assignments[i]["scene"], *results[i])
+            if metrics:
+                metrics.record_clip(kind="normalize", scene=scene_assignments[i]["scene"],
+                                    queue_wait=round(started - queued_at, 3),
+                                    seconds=round(time.monotonic() - started, 3))
+        except Exception as e:
+            print(f"⚠️ Normalizzazione clip scena {scene_assignments[i]['scene']} fallita: {e}", flush=True)
+        finally:
+            # la sorgente è una copia privata (la cache clip tiene l'originale): non serve più
+            media_metadata.forget(clip_path)
+            try:
+                os.unlink(clip_path)
+            except OSError:
+                pass
+    
+    def normalize_worker():
+        # il consumer non deve mai uscire prima del sentinel, o i download resterebbero bloccati sulla coda
+        while True:
+            item = downloaded.get()
+            if item is None:
+                return
+            try:
+                normalize_one(*item)
+            except Exception:
+                pass
+    
+    normalizers = [Thread(target=normalize_worker, name=f"normalize-{n}", daemon=True)
+                   for n in range(max(1, NORMALIZE_WORKERS))]
+    for t in normalizers:
+        t.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS), thread_name_prefix="fetch") as pool:
+            for fut in [pool.submit(download, i) for i in pending]:
+                fut.result()
+    finally:
+        for _ in normalizers:
+            downloaded.put(None)
+        for t in normalizers:
+            t.join()
+    return [r for r in results if r], len(fetched)
+
+def probe_video_duration(path, metrics=None):
+    """Durata di un file con stream video decodificabile, None se assente/illeggibile."""
+    try:
+        out = run_ffmpeg([
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=codec_type:format=duration",
+            "-of", "json", path
+        ], "probe", metrics, stdout=subprocess.PIPE, text=True, timeout=10).stdout
+        info = json.loads(out or "{}")
+        if not info.get("streams"):
+            return None
+        duration = float(info.get("format", {}).get("duration") or 0)
+    except Exception:
+        return None
+    return duration if duration > 0 else None
+
+def probe_duration(path, metrics=None):
+    """Durata del container via ffprobe (qualsiasi tipo di media), None se illeggibile."""
+    try:
+        out = run_ffmpeg([
+            "ffprobe", "-v", "error", "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1", path
+        ], "probe", metrics, stdout=subprocess.PIPE, text=True, timeout=10).stdout.strip()
+        duration = float(out or 0)
+    except Exception:
+        return None
+    return duration if duration > 0 else None
+
+def ffmpeg_progress_duration(progress_text, fps=None):
+    """Durata dell'output dall'ultimo blocco `-progress` di ffmpeg, None se nessun frame/tempo valido.
+
+    Con `fps` (output a frame rate costante) usa frame/fps, identico alla durata del container;
+    altrimenti `out_time_us` (o `out_time_ms`, che nonostante il nome è in microsecondi).
+    """
+    info = {}
+    for line in (progress_text or "").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            info[key.strip()] = value.strip()
+    try:
+        if fps:
+            frames = int(info.get("frame") or 0)
+            return frames / fps if frames > 0 else None
+        out_time_us = int(info.get("out_time_us") or info.get("out_time_ms") or 0)
+    except ValueError:
+        return None
+    return out_time_us / 1e6 if out_time_us > 0 else None
+
+def wav_duration(path):
+    """Durata di un WAV PCM letta dall'header (nessun subprocess)."""
+    try:
+        with wave.open(path, "rb") as w:
+            rate = w.getframerate()
+            return w.getnframes() / rate if rate and w.getnframes() else None
+    except (OSError, EOFError, wave.Error):
+        return None
+
+class MediaMetadata:
+    """Durate note dei file media del processo: ffprobe solo quando nessun'altra fonte le conosce.
+
+    Le durate arrivano dai metadata Pexels/Pixabay, dal `-progress` dell'ffmpeg che ha scritto il
+    file, dall'header WAV o dal sidecar della cache su disco. Le chiavi sono path temporanei dei
+    job, quindi la mappa è una LRU limitata.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.durations = OrderedDict()
+        self.lock = Lock()
+
+    def remember(self, path, duration, source):
+        if not duration or duration <= 0:
+            return
+        MEDIA_DURATIONS.inc(1, source)
+        with self.lock:
+            self.durations[path] = (float(duration), source)
+            self.durations.move_to_end(path)
+            while len(self.durations) > self.max_entries:
+                self.durations.popitem(last=False)
+
+    def known(self, path):
+        with self.lock:
+            entry = self.durations.get(path)
+        return entry[0] if entry else None
+
+    def duration(self, path, metrics=None, probe=probe_duration):
+        """Durata nota, altrimenti `probe` (ffprobe) e memorizzata; None se illeggibile."""
+        known = self.known(path)
+        if known:
+            return known
+        duration = probe(path, metrics)
+        self.remember(path, duration, "ffprobe")
+        return duration
+
+    def forget(self, path):
+        with self.lock:
+            self.durations.pop(path, None)
+
+media_metadata = MediaMetadata()
+
+def clip_segment(clip_path, length):
+    """Argomenti di input seeking per il segmento centrale di `length` secondi ([] = clip intera).
+
+    Il centro si calcola dalla durata nota della sorgente (metadata provider); se è ignota si
+    parte da 0. Una clip già più corta del segmento si usa intera.
+    """
+    if not length:
+        return []
+    source_duration = media_metadata.known(clip_path)
+    if source_duration and source_duration <= length:
+        return []
+    start = (source_duration - length) / 2 if source_duration else 0.0
+    return ["-ss", f"{start:.3f}", "-t", f"{length:.3f}"]
+
+def normalize_clip(clip_path, metrics=None, segment=None, workdir=None, profile=None):
+    """Normalizza una clip a 1920x1080/30fps, riusando la cache se la stessa sorgente è già stata codificata.
+
+    Con `segment` (secondi) codifica solo il segmento centrale, con `-ss`/`-t` prima di `-i`
+    (input seeking: i frame scartati non vengono decodificati).
+    Ritorna (path_normalizzato, durata): la durata è frame/NORMALIZE_FPS dal `-progress` dello
+    stesso encode (o dal sidecar della cache); ffprobe solo se ffmpeg non l'ha riportata.
+    Job concorrenti sulla stessa sorgente e segmento aspettano un unico encode.
+    """
+    trim_args = clip_segment(clip_path, segment)
+    codec_args = normalize_codec_args(profile)
+    key = FileCache.key_for(file_sha256(clip_path), NORMALIZE_VF, *codec_args, *trim_args)
+    # un solo encode per chiave: chi arriva durante l'encode di un altro job trova poi l'entry in cache
+    with norm_cache.filling(key):
+        cached = norm_cache.lookup(key)
+        if cached:
+            duration = (norm_cache.read_meta(key) or {}).get("duration")
+            try:
+                if duration:
+                    path = norm_cache.link_out(cached, workdir=workdir)
+                    media_metadata.remember(path, duration, "cache")
+                    return path, duration
+            except OSError:
+                pass
+        normalized_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=workdir)
+        normalized_path = normalized_tmp.name
+        normalized_tmp.close()
+        try:
+            global_threads, output_threads = thread_args(ffmpeg_thread_count(NORMALIZE_WORKERS))
+            result = run_ffmpeg([
+                "ffmpeg", "-y", "-loglevel", "error", *global_threads, "-nostats", "-progress", "pipe:1",
+                *trim_args, "-i", clip_path,
+                "-vf", NORMALIZE_VF, *codec_args, *output_threads, normalized_path
+            ], "normalize", metrics, stdout=subprocess.PIPE, text=True, timeout=MAX_DURATION, check=True)
+            duration = ffmpeg_progress_duration(result.stdout, NORMALIZE_FPS)
+            if duration:
+                media_metadata.remember(normalized_path, duration, "ffmpeg")
+            else:
+                duration = media_metadata.duration(normalized_path, metrics, probe=probe_video_duration)
+            if not duration:
+                raise RuntimeError("output normalizzato non valido")
+        except Exception:
+            try:
+                os.unlink(normalized_path)
+            except OSError:
+                pass
+            raise
+        norm_cache.store(key, normalized_path, {"duration": duration, "sha256": file_sha256(normalized_path)})
+        return normalized_path, duration
+
+def build_timeline(clips, real_duration):
+    """Sequenza [(path, outpoint)] che copre `real_duration` ciclando le clip normalizzate.
+
+    Ogni clip unica è codificata una volta sola: il loop è solo una lista di riferimenti per il
+    concat in stream copy. L'ultima entry ha `outpoint` = secondi residui arrotondati al frame
+    successivo (None = clip intera); il mux finale taglia comunque a `-t real_duration`.
+    Le clip senza durata si saltano; un residuo sotto il mezzo frame non apre una nuova entry.
+    """
+    clips = [(path, duration) for path, duration in clips if duration and duration > 0]
+    epsilon = 0.5 / NORMALIZE_FPS
+    timeline = []
+    covered = 0.0
+    while clips and real_duration - covered > epsilon and len(timeline) < MAX_CONCAT_ENTRIES:
+        for path, duration in clips:
+            remaining = real_duration - covered
+            if remaining <= epsilon or len(timeline) >= MAX_CONCAT_ENTRIES:
+                break
+            if duration > remaining + epsilon:
+                timeline.append((path, ceil_to_frame(remaining)))
+                covered = real_duration
+            else:
+                timeline.append((path, None))
+                covered += duration
+    return timeline
+
+def write_concat_list(timeline, workdir=None):
+    """Lista per il concat demuxer dalla timeline di build_timeline."""
+    concat_list_tmp = tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".txt", dir=workdir)
+    for path, outpoint in timeline:
+        concat_list_tmp.write(f"file '{path}'\n")
+        if outpoint is not None:
+            concat_list_tmp.write(f"outpoint {outpoint:.6f}\n")
+    concat_list_tmp.close()
+    return concat_list_tmp.name
+
+def render_video_single(concat_list_path, audiopath, real_duration, metrics=None, workdir=None):
+    """Concat in stream copy delle clip già normalizzate + mux AAC: nessuna ri-codifica video."""
+    final_video_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=workdir)
+    final_video_path = final_video_tmp.name
+    final_video_tmp.close()
+    
+    try:
+        run_ffmpeg([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", concat_list_path, "-i", audiopath,
+            "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy",
+            "-c:a", "aac", "-b:a", "192k", "-t", str(real_duration), "-shortest",
+            "-movflags", "+faststart", final_video_path
+        ], "concat_mux", metrics, timeout=MAX_DURATION, check=True)
+    except Exception:
+        os.unlink(final_video_path)
+        raise
+    return final_video_path
+
+def render_video_legacy(concat_list_path, audiopath, real_duration, metrics=None, workdir=None, profile=None):
+    """Vecchia pipeline: concat ri-codificato + mux con scale/crop ri-codificato. Ritorna (finale, intermedio)."""
+    threads = ffmpeg_thread_count()
+    video_looped_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=workdir)
+    video_looped_path = video_looped_tmp.name
+    video_looped_tmp.close()
+    
+    global_threads, output_threads = thread_args(threads)
+    run_ffmpeg([
+        "ffmpeg", "-y", "-loglevel", "error", *global_threads,
+        "-f", "concat", "-safe", "0", "-i", concat_list_path,
+        "-vf", "fps=30,format=yuv420p", *encoder_args(profile), *output_threads,
+        "-t", str(real_duration), video_looped_path
+    ], "concat", metrics, timeout=MAX_DURATION, check=True)
+    
+    final_video_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=workdir)
+    final_video_path = final_video_tmp.name
+    final_video_tmp.close()
+    
+    global_threads, output_threads = thread_args(threads, "-filter_complex_threads")
+    run_ffmpeg([
+        "ffmpeg", "-y", "-loglevel", "error", *global_threads,
+        "-i", video_looped_path, "-i", audiopath,
+        "-filter_complex", "[0:v]scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,format=yuv420p[v]",
+        "-map", "[v]", "-map", "1:a", *encoder_args(profile), *output_threads,
+        "-c:a", "aac", "-b:a", "192k", "-shortest", final_video_path
+    ], "mux", metrics, timeout=MAX_DURATION, check=True)
+    return final_video_path, video_looped_path
+
+def render_video(concat_list_path, audiopath, real_duration, render_mode, metrics=None, workdir=None, profile=None):
+    """Render nel modo richiesto; se il single-encode fallisce ripiega sul legacy. Ritorna (finale, modo usato)."""
+    if render_mode == "legacy":
+        final_video_path, _looped = render_video_legacy(concat_list_path, audiopath, real_duration, metrics, workdir, profile)
+        return final_video_path, "legacy"
+    try:
+        return render_video_single(concat_list_path, audiopath, real_duration, metrics, workdir), "single"
+    except subprocess.CalledProcessError as e:
+        print(f"⚠️ Render single-encode fallito ({e}), fallback legacy", flush=True)
+        final_video_path, _looped = render_video_legacy(concat_list_path, audiopath, real_duration, metrics, workdir, profile)
+        return final_video_path, "legacy"
+
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "healthy", "jobs": len(jobs)})
+    return jsonify({
+        "status": "healthy",
+        "jobs": job_store.count(),
+        "queue_depth": job_store.queue_depth(),
+        "active_jobs": job_store.active_count(),
+        "max_concurrent": MAX_CONCURRENT,
+        "worker_active_jobs": len(active_jobs),
+        "clip_cache": clip_cache.snapshot(),
+        "norm_cache": norm_cache.snapshot(),
+        "search_cache": search_cache.snapshot(),
+        "webhooks": webhook_dispatcher.snapshot(),
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Metriche Prometheus di questo worker (istogrammi fasi/ffmpeg/download + cache, etichettati
+    `worker`) e della coda condivisa (dal job store, uguali da ogni worker: senza etichetta)."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for cache in (clip_cache, norm_cache):
+        for stat, value in cache.snapshot().items():
+            lines.append(f'video_cache_{stat}_total{{{WORKER_LABEL},cache="{cache.name}"}} {value}')
+    lines.append(f"video_queue_depth {job_store.queue_depth()}")
+    lines.append(f"video_active_jobs {job_store.active_count()}")
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 @app.route("/ffmpeg-test", methods=["GET"])
 def ffmpeg_test():
@@ -287,45 +2565,143 @@ def ffmpeg_test():
 
 @app.route("/status/<job_id>", methods=["GET"])
 def get_status(job_id):
-    job = jobs.get(job_id)
+    job = job_store.get(job_id)
     if not job:
         return jsonify({"error": "Job not found"}), 404
     
     response = {
         "job_id": job_id,
         "status": job["status"],
-        "created_at": job.get("created_at")
+        "created_at": job.get("created_at"),
+        "attempts": job.get("attempts")
     }
-    if job['status'] == 'completed':
+    if job.get('batch_id'):
+        response['batch_id'] = job['batch_id']
+    if job.get('kind') == 'batch_plan':
+        rows = [job_store.get(row_id) for row_id in (job.get('data') or {}).get('rows', [])]
+        response['rows'] = [{"job_id": r["job_id"], "status": r["status"], "row_number": (r.get("data") or {}).get("row_number")}
+                            for r in rows if r]
+        for field in ('rows_planned', 'scenes', 'unique_clips', 'clips_ready'):
+            if job.get(field) is not None:
+                response[field] = job[field]
+    if job['status'] == 'queued':
+        response['queue_position'] = job_store.queue_position(job_id)
+        response['queue_depth'] = job_store.queue_depth()
+    elif job['status'] == 'completed' and job.get('kind') != 'batch_plan':
         response['video_url'] = job.get('video_url')
         response['duration'] = job.get('duration')
         response['clips_used'] = job.get('clips_used')
+        response['render_mode'] = job.get('render_mode')
+        response['render_seconds'] = job.get('render_seconds')
+        response['timeline_entries'] = job.get('timeline_entries')
+        response['encoder_profile'] = job.get('encoder_profile')
     elif job['status'] == 'failed':
         response['error'] = job.get('error')
+    if job.get('timings'):
+        response['timings'] = job['timings']
     
     return jsonify(response)
-def process_video_async(job_id, data):
-    """Processa video in background thread"""
-    job = jobs[job_id]
-    job["status"] = "processing"
-    job["job_id"] = job_id
-    job["data"] = data
+def script_and_keywords(data):
+    """Script e keyword del foglio dai campi della richiesta (stringhe o liste)."""
+    raw_script = (data.get("script") or data.get("script_chunk") or data.get("script_audio") or data.get("script_completo") or "")
+    script = (" ".join(str(p).strip() for p in raw_script) if isinstance(raw_script, list) else str(raw_script).strip())
+    raw_keywords = data.get("keywords", "")
+    sheet_keywords = (", ".join(str(k).strip() for k in raw_keywords) if isinstance(raw_keywords, list) else str(raw_keywords).strip())
+    return script, sheet_keywords
+
+def prepare_audio(data, workspace, metrics=None):
+    """Audio del job decodificato in WAV nella workspace (checkpoint "audio"). Ritorna (wav, durata)."""
+    resumed = workspace.stage("audio")
+    if resumed:
+        media_metadata.remember(resumed["wav_file"], resumed["duration"], "cache")
+        return resumed["wav_file"], resumed["duration"]
+    workdir = workspace.dir
+    audiobase64 = data.get("audio_base64") or data.get("audiobase64")
+    if data.get("audio_path"):
+        audiopath_tmp = data["audio_path"]
+        if not os.path.exists(audiopath_tmp):
+            raise RuntimeError("Audio caricato non trovato")
+    elif data.get("audio_url"):
+        audiopath_tmp = download_file(data["audio_url"], workdir=workdir)
+    elif audiobase64:
+        audio_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".bin", dir=workdir)
+        audio_tmp.close()
+        audiopath_tmp = audio_tmp.name
+        write_base64_to_file(audiobase64, audiopath_tmp)
+    else:
+        raise RuntimeError("Audio mancante: usa upload multipart, audio_url o audio_base64")
+    
+    audio_wav_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav", dir=workdir)
+    audio_wav_path = audio_wav_tmp.name
+    audio_wav_tmp.close()
     
-    audiopath = None
-    audio_wav_path = None
-    video_looped_path = None
-    final_video_path = None
-    scene_paths = []
+    run_ffmpeg([
+        "ffmpeg", "-y", "-loglevel", "error", "-i", audiopath_tmp,
+        "-acodec", "pcm_s16le", "-ar", "48000", audio_wav_path
+    ], "audio_decode", metrics, timeout=MAX_DURATION, check=True)
+    if audiopath_tmp != data.get("audio_path"):
+        os.unlink(audiopath_tmp)
+    
+    media_metadata.remember(audio_wav_path, wav_duration(audio_wav_path), "header")
+    real_duration = media_metadata.duration(audio_wav_path, metrics) or 720.0
+    workspace.checkpoint("audio", wav_file=audio_wav_path, duration=real_duration)
+    return audio_wav_path, real_duration
+
+def plan_scenes(script, sheet_keywords, real_duration, scene_duration=None):
+    """Scene a intervalli regolari, query visiva dal tratto di script corrispondente.
+
+    Di default MAX_CLIPS scene da real_duration / MAX_CLIPS secondi; con `scene_duration` (durata
+    arrotondata delle righe di un batch) solo le scene che servono a coprire l'audio, ognuna al
+    suo timestamp reale; se sono meno di MIN_CLIPS la scena si accorcia (al frame) perché
+    MIN_CLIPS scene coprano l'audio. Ritorna (scene, durata scena).
+    """
+    script_words = script.lower().split()
+    words_per_second = (len(script_words) / real_duration if real_duration > 0 else 2.5)
+    if scene_duration:
+        num_scenes = min(MAX_CLIPS, math.ceil(real_duration / scene_duration))
+        avg_scene_duration = scene_duration
+        if num_scenes < MIN_CLIPS:
+            num_scenes = MIN_CLIPS
+            avg_scene_duration = ceil_to_frame(real_duration / MIN_CLIPS)
+    else:
+        num_scenes = MAX_CLIPS
+        avg_scene_duration = real_duration / num_scenes
+    scene_assignments = []
+
+    for i in range(num_scenes):
+        if i % 10 == 0:
+            print(f"🔧 Clip {i}/{num_scenes}", flush=True)
+        timestamp = i * avg_scene_duration
+        word_index = int(timestamp * words_per_second)
+        scene_context = " ".join(script_words[word_index: word_index + 7]) if word_index < len(script_words) else "dreamlike night sky surreal clouds moonlight"
+        scene_query = pick_visual_query(scene_context, sheet_keywords)
+        scene_assignments.append({
+            "scene": i + 1, "timestamp": round(timestamp, 1),
+            "context": scene_context[:60], "query": scene_query[:80]
+        })
+    return scene_assignments, avg_scene_duration
+
+def process_video_async(job_id, data, lease=None):
+    """Processa video in background thread (job già reclamato dal dispatcher, con il suo `lease`)"""
+    job = {"job_id": job_id, "data": data, "status": "processing"}
+    save = lease.update if lease else (lambda **fields: job_store.update(job_id, **fields))
+    check_lease = lease.check if lease else (lambda: None)
+    # a job terminato il lease non c'è più: i tempi finali li scrive l'ultimo update non condizionato
+    metrics = JobMetrics(on_stage=lambda m: job["status"] == "processing" and save(timings=m.snapshot()))
+    workspace = None
     
     try:
         if not all([R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_PUBLIC_BASE_URL]):
             raise RuntimeError("Config R2 mancante")
         
-        audiobase64 = data.get("audio_base64") or data.get("audiobase64")
-        raw_script = (data.get("script") or data.get("script_chunk") or data.get("script_audio") or data.get("script_completo") or "")
-        script = (" ".join(str(p).strip() for p in raw_script) if isinstance(raw_script, list) else str(raw_script).strip())
-        raw_keywords = data.get("keywords", "")
-        sheet_keywords = (", ".join(str(k).strip() for k in raw_keywords) if isinstance(raw_keywords, list) else str(raw_keywords).strip())
+        # file intermedi nella workspace del job: un retry riparte dall'ultimo checkpoint
+        workspace = JobWorkspace(job_id)
+        workdir = workspace.dir
+        if workspace.manifest["stages"] or workspace.manifest["clips"]:
+            print(f"♻️ Job {job_id}: ripresa da checkpoint {sorted(workspace.manifest['stages'])}, "
+                  f"{len(workspace.manifest['clips'])} clip pronte", flush=True)
+        
+        script, sheet_keywords = script_and_keywords(data)
         
         row_number_raw = data.get("row_number")
         if isinstance(row_number_raw, dict):
@@ -341,162 +2717,83 @@ def process_video_async(job_id, data):
         print(f"✨ START SIGNIFICATO DEI SOGNI: {len(script)} char script, keywords: '{sheet_keywords}', row: {row_number}", flush=True)
         print(f"🔍 DEBUG row_number RAW: '{row_number_raw}' → PARSED: '{row_number}'", flush=True)
         
-        if not audiobase64:
-            raise RuntimeError("audiobase64 mancante")
-        
-        audio_bytes = base64.b64decode(audiobase64)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".bin") as f:
-            f.write(audio_bytes)
-        audiopath_tmp = f.name
-        
-        audio_wav_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        audio_wav_path = audio_wav_tmp.name
-        audio_wav_tmp.close()
-        
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error", "-i", audiopath_tmp,
-            "-acodec", "pcm_s16le", "-ar", "48000", audio_wav_path
-        ], timeout=MAX_DURATION, check=True)
-        os.unlink(audiopath_tmp)
-        audiopath = audio_wav_path
-        
-        probe = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", audiopath
-        ], stdout=subprocess.PIPE, text=True, timeout=10)
-        real_duration = float(probe.stdout.strip() or 720.0)
+        with metrics.stage("audio"):
+            audiopath, real_duration = prepare_audio(data, workspace, metrics)
         print(f"⏱️ Durata audio: {real_duration/60:.1f}min ({real_duration:.0f}s)", flush=True)
         
-        script_words = script.lower().split()
-        words_per_second = (len(script_words) / real_duration if real_duration > 0 else 2.5)
-        num_scenes = MAX_CLIPS
-        avg_scene_duration = real_duration / num_scenes
-        scene_assignments = []
-        
-        for i in range(num_scenes):
-            if i % 10 == 0:
-                print(f"🔧 Clip {i}/{num_scenes}", flush=True)
-            timestamp = i * avg_scene_duration
-            word_index = int(timestamp * words_per_second)
-            scene_context = " ".join(script_words[word_index: word_index + 7]) if word_index < len(script_words) else "dreamlike night sky surreal clouds moonlight"
-            scene_query = pick_visual_query(scene_context, sheet_keywords)
-            scene_assignments.append({
-                "scene": i + 1, "timestamp": round(timestamp, 1),
-                "context": scene_context[:60], "query": scene_query[:80]
-            })
+        encoder_profile = resolve_encoder_profile(data.get("encoder_profile"))
+        with metrics.stage("plan"):
+            # le righe di un batch riprendono il piano (scene e durata) scritto dal job di piano
+            resumed = workspace.stage("plan")
+            if resumed:
+                scene_assignments, avg_scene_duration = resumed["scenes"], resumed["scene_duration"]
+            else:
+                scene_assignments, avg_scene_duration = plan_scenes(script, sheet_keywords, real_duration)
+            num_scenes = len(scene_assignments)
         
-        for assignment in scene_assignments:
-            clip_path, clip_dur = fetch_clip_for_scene(
-                assignment["scene"], assignment["query"], avg_scene_duration
-            )
-            if clip_path and clip_dur:
-                scene_paths.append((clip_path, clip_dur))
-        
-        print(f"✅ CLIPS SCARICATE: {len(scene_paths)}/{num_scenes}", flush=True)
-        if len(scene_paths) < 5:
-            raise RuntimeError(f"Troppe poche clip: {len(scene_paths)}/{num_scenes}")
-        
-        normalized_clips = []
-        for i, (clip_path, _dur) in enumerate(scene_paths):
-            try:
-                normalized_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-                normalized_path = normalized_tmp.name
-                normalized_tmp.close()
-                subprocess.run([
-                    "ffmpeg", "-y", "-loglevel", "error", "-i", clip_path,
-                    "-vf", "scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,fps=30",
-                    "-c:v", "libx264", "-preset", "fast", "-crf", "23", "-an", normalized_path
-                ], timeout=MAX_DURATION, check=True)
-                if os.path.exists(normalized_path) and os.path.getsize(normalized_path) > 1000:
-                    normalized_clips.append(normalized_path)
-            except Exception:
-                pass
+        with metrics.stage("clips"):
+            resumed = workspace.stage("clips")
+            if resumed:
+                clips = [clip for _scene, clip in sorted(workspace.clips().items())]
+                clips_downloaded = resumed["downloaded"]
+            else:
+                clips, clips_downloaded = run_clip_pipeline(scene_assignments, avg_scene_duration, metrics,
+                                                            workspace, encoder_profile)
+                workspace.checkpoint("clips", downloaded=clips_downloaded, normalized=len(clips))
         
-        if not normalized_clips:
+        print(f"✅ CLIPS SCARICATE: {clips_downloaded}/{num_scenes}, normalizzate: {len(clips)}", flush=True)
+        if clips_downloaded < MIN_CLIPS:
+            raise RuntimeError(f"Troppe poche clip: {clips_downloaded}/{num_scenes}")
+        if not clips:
             raise RuntimeError("Nessuna clip normalizzata")
         
-        def get_duration(p):
-            out = subprocess.run([
-                "ffprobe", "-v", "error", "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1", p
-            ], stdout=subprocess.PIPE, text=True, timeout=10).stdout.strip()
-            return float(out or 4.0)
-        
-        total_clips_duration = sum(get_duration(p) for p in normalized_clips)
-        concat_list_tmp = tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".txt")
-        entries_written = 0
-        MAX_CONCAT_ENTRIES = 150
-        
-        if total_clips_duration < real_duration and len(normalized_clips) > 1:
-            loops_needed = math.ceil(real_duration / total_clips_duration)
-            for _ in range(loops_needed):
-                for norm_path in normalized_clips:
-                    if entries_written >= MAX_CONCAT_ENTRIES:
-                        break
-                    concat_list_tmp.write(f"file '{norm_path}'\n")
-                    entries_written += 1
-                if entries_written >= MAX_CONCAT_ENTRIES:
-                    break
+        resumed = workspace.stage("render")
+        if resumed:
+            final_video_path = resumed["video_file"]
+            render_mode = resumed["render_mode"]
+            render_seconds = resumed["seconds"]
+            timeline_entries = resumed["timeline_entries"]
         else:
-            for norm_path in normalized_clips:
-                concat_list_tmp.write(f"file '{norm_path}'\n")
-                entries_written += 1
-        
-        concat_list_tmp.close()
-        
-        video_looped_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-        video_looped_path = video_looped_tmp.name
-        video_looped_tmp.close()
-        
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-f", "concat", "-safe", "0", "-i", concat_list_tmp.name,
-            "-vf", "fps=30,format=yuv420p", "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-            "-t", str(real_duration), video_looped_path
-        ], timeout=MAX_DURATION, check=True)
-        os.unlink(concat_list_tmp.name)
-        
-        final_video_tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-        final_video_path = final_video_tmp.name
-        final_video_tmp.close()
-        
-        subprocess.run([
-            "ffmpeg", "-y", "-loglevel", "error",
-            "-i", video_looped_path, "-i", audiopath,
-            "-filter_complex", "[0:v]scale=1920:1080:force_original_aspect_ratio=increase,crop=1920:1080,format=yuv420p[v]",
-            "-map", "[v]", "-map", "1:a", "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-            "-c:a", "aac", "-b:a", "192k", "-shortest", final_video_path
-        ], timeout=MAX_DURATION, check=True)
-        
-        s3_client = get_s3_client()
-        today = dt.datetime.utcnow().strftime("%Y-%m-%d")
-        object_key = f"videos/{today}/{uuid.uuid4().hex}.mp4"
-        s3_client.upload_file(
-            Filename=final_video_path,
-            Bucket=R2_BUCKET_NAME,
-            Key=object_key,
-            ExtraArgs={"ContentType": "video/mp4"}
-        )
-        public_url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key}"
-        cleanup_old_videos(s3_client, object_key)
-        
-        gc = get_gspread_client()
-        print(f"🔍 DEBUG gspread client: {'OK' if gc else 'FAILED'}", flush=True)
-        if gc and row_number > 0:
+            timeline = build_timeline(clips, real_duration)
+            timeline_entries = len(timeline)
+            concat_list_path = write_concat_list(timeline, workdir)
+            render_mode = str(data.get("render_mode") or RENDER_MODE).lower()
+            render_started = time.monotonic()
             try:
-                sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
-                sheet.update_cell(row_number, 13, public_url)
-                sheet.update_cell(row_number, 2, "PRODOTTO")
-                print(f"📊 ✅ Sheet row {row_number}: M={public_url[:60]} + B=PRODOTTO (anti-loop)", flush=True)
-            except Exception as e:
-                print(f"❌ Sheets fallito row {row_number}: {str(e)}", flush=True)
+                with metrics.stage("render"):
+                    final_video_path, render_mode = render_video(concat_list_path, audiopath, real_duration, render_mode,
+                                                                 metrics, workdir, encoder_profile)
+            finally:
+                os.unlink(concat_list_path)
+            render_seconds = time.monotonic() - render_started
+            workspace.checkpoint("render", video_file=final_video_path, render_mode=render_mode,
+                                 seconds=round(render_seconds, 2), timeline_entries=timeline_entries)
+        print(f"🎬 Render {render_mode}: {render_seconds:.1f}s", flush=True)
         
-        paths_to_cleanup = [audiopath, video_looped_path, final_video_path] + normalized_clips + [p[0] for p in scene_paths]
-        for path in paths_to_cleanup:
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
+        with metrics.stage("upload"):
+            resumed = workspace.stage("upload")
+            if resumed:
+                public_url = resumed["public_url"]
+            else:
+                check_lease()
+                s3_client = get_s3_client()
+                today = dt.datetime.utcnow().strftime("%Y-%m-%d")
+                object_key = f"videos/{today}/{uuid.uuid4().hex}.mp4"
+                upload_video(s3_client, final_video_path, object_key, metrics)
+                public_url = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{object_key}"
+                retention_manifest.record(object_key, os.path.getsize(final_video_path), job_id)
+                retention_event.set()
+                workspace.checkpoint("upload", object_key=object_key, public_url=public_url)
+        
+        with metrics.stage("sheets"):
+            if sheets_writer and row_number > 0 and not workspace.stage("sheets"):
+                check_lease()
+                pending = sheets_writer.enqueue(row_number, {13: public_url, 2: "PRODOTTO"})
+                if pending.wait(SHEETS_WAIT_TIMEOUT):
+                    print(f"📊 ✅ Sheet row {row_number}: M={public_url[:60]} + B=PRODOTTO (anti-loop)", flush=True)
+                    workspace.checkpoint("sheets", row_number=row_number)
+                else:
+                    print(f"❌ Sheets fallito row {row_number}: {pending.error or 'timeout'}", flush=True)
         
         print(f"✅ ✨ VIDEO SIGNIFICATO DEI SOGNI COMPLETO: {real_duration/60:.1f}min → {public_url}", flush=True)
         
@@ -504,55 +2801,439 @@ def process_video_async(job_id, data):
             "status": "completed",
             "video_url": public_url,
             "duration": real_duration,
-            "clips_used": len(scene_paths),
-            "row_number": row_number
+            "clips_used": clips_downloaded,
+            "row_number": row_number,
+            "render_mode": render_mode,
+            "render_seconds": round(render_seconds, 2),
+            "timeline_entries": timeline_entries,
+            "encoder_profile": encoder_profile
         })
+        # la scrittura del completamento è il fence finale: il webhook parte solo se è andata a buon fine
+        save(**{k: v for k, v in job.items() if k not in ("job_id", "data")})
+        JOBS_TOTAL.inc(1, "completed")
 
-        notify_n8n_flusso2(job)
+        with metrics.stage("notify"):
+            notify_n8n_flusso2(job)
+        job_store.update(job_id, timings=metrics.snapshot())
         
+    except LeaseLost as e:
+        # il job è di un altro worker: niente stato, workspace e audio restano a lui
+        print(f"⚠️ Job {job_id} interrotto: {e}", flush=True)
+        job["status"] = "processing"
+    
     except Exception as e:
         print(f"❌ ERRORE PROCESSING: {e}", flush=True)
         job.update({"status": "failed", "error": str(e)})
+        try:
+            save(status="failed", error=str(e), timings=metrics.snapshot())
+            JOBS_TOTAL.inc(1, "failed")
+        except LeaseLost:
+            print(f"⚠️ Job {job_id}: lease perso, errore non registrato", flush=True)
+            job["status"] = "processing"
+    
+    finally:
+        # job terminato (anche fallito): via tutta la workspace; se il processo muore resta per il resume
+        if workspace and job["status"] in TERMINAL_STATUSES:
+            workspace.remove()
+        # l'audio caricato resta su disco finché il job non termina (serve a un eventuale retry)
+        if data.get("audio_path") and job["status"] in TERMINAL_STATUSES:
+            try:
+                os.unlink(data["audio_path"])
+            except OSError:
+                pass
+
+def batch_segment(avg_scene_duration):
+    """Durata scena delle righe di un batch: arrotondata per eccesso a BATCH_SEGMENT_STEP (il piano
+    poi usa meno scene, quelle che coprono l'audio, o scene più corte per arrivare a MIN_CLIPS,
+    così ogni scena pianificata finisce nella timeline)."""
+    if not CLIP_TRIM:
+        return None
+    step = max(1, BATCH_SEGMENT_STEP)
+    return math.ceil(avg_scene_duration / step) * step
+
+def process_batch_plan(batch_id, data, lease=None):
+    """Job di piano di un batch: prepara le righe insieme e le rilascia in coda.
+
+    Per ogni riga legge la durata dell'audio (ffprobe, senza decodificarlo) e pianifica le scene
+    con la durata arrotondata di batch_segment (checkpoint "plan" che la riga riprende). Le
+    scene di tutte le righe si raggruppano per query: la k-esima occorrenza di una query in
+    qualsiasi riga usa la stessa clip, scaricata una volta sola e normalizzata una volta per
+    durata segmento/profilo (norm cache); ogni riga riceve la sua copia come clip già pronta.
+    Le righe poi girano come job normali: scene mancanti, render, upload, Sheets e webhook
+    restano per riga. Le righe si rilasciano comunque, anche se il piano fallisce.
+    """
+    row_ids = data.get("rows") or []
+    job = {"job_id": batch_id, "status": "processing"}
+    save = lease.update if lease else (lambda **fields: job_store.update(batch_id, **fields))
+    metrics = JobMetrics(on_stage=lambda m: save(timings=m.snapshot()))
+    workspace = None
+    
+    def prepare_row(row_id):
+        record = job_store.get(row_id)
+        if not record or record.get("status") != "waiting":
+            return None
+        row_data = record.get("data") or {}
+        row_workspace = JobWorkspace(row_id)
+        # al piano basta la durata: ffprobe sul file caricato o sull'URL, il WAV lo decodifica la riga
+        resumed = row_workspace.stage("audio")
+        source = row_data.get("audio_path") or row_data.get("audio_url")
+        real_duration = resumed["duration"] if resumed else (probe_duration(source, metrics) if source else None)
+        if not real_duration:
+            print(f"⚠️ Batch {batch_id}: durata audio riga {row_id} ignota, la riga pianifica da sola", flush=True)
+            return None
+        script, sheet_keywords = script_and_keywords(row_data)
+        planned = row_workspace.stage("plan")
+        if planned and "segment" in planned:
+            # il segmento (None con CLIP_TRIM=0) è la chiave della norm cache: un retry deve riusarlo
+            scenes, segment = planned["scenes"], planned["segment"]
+        else:
+            segment = batch_segment(real_duration / MAX_CLIPS)
+            scenes, scene_duration = plan_scenes(script, sheet_keywords, real_duration, segment)
+            if segment:
+                segment = scene_duration  # accorciata dal piano per audio brevi
+            row_workspace.checkpoint("plan", scenes=scenes, scene_duration=scene_duration, segment=segment)
+        return {"job_id": row_id, "workspace": row_workspace, "scenes": scenes,
+                "segment": segment, "done": row_workspace.clips(),
+                "profile": resolve_encoder_profile(row_data.get("encoder_profile"))}
+    
+    try:
+        workspace = JobWorkspace(batch_id)
+        with metrics.stage("audio"):
+            with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(row_ids) or 1))) as pool:
+                rows = [row for row in pool.map(prepare_row, row_ids) if row]
+        
+        with metrics.stage("plan"):
+            slots = {}
+            for row in rows:
+                occurrences = {}
+                for scene in row["scenes"]:
+                    if scene["scene"] in row["done"]:
+                        continue
+                    k = occurrences.get(scene["query"], 0)
+                    occurrences[scene["query"]] = k + 1
+                    slots.setdefault((scene["query"], k), []).append((row, scene["scene"]))
+            scenes_total = sum(len(users) for users in slots.values())
+        print(f"📦 Batch {batch_id}: {len(rows)}/{len(row_ids)} righe, {scenes_total} scene → {len(slots)} clip uniche", flush=True)
+        
+        picker = ClipPicker()
+        ready = []
+        # sorgenti su disco limitate come nella pipeline per job
+        in_flight = BoundedSemaphore(max(1, FETCH_WORKERS + PIPELINE_QUEUE_SIZE + NORMALIZE_WORKERS))
+        
+        def normalize_slot(slot, clip_path):
+            try:
+                for row, scene_number in slots[slot]:
+                    try:
+                        path, duration = normalize_clip(clip_path, metrics, row["segment"], row["workspace"].dir, row["profile"])
+                        row["workspace"].record_clip(scene_number, path, duration)
+                        ready.append(scene_number)
+                    except Exception as e:
+                        print(f"⚠️ Batch {batch_id}: normalizzazione '{slot[0][:40]}' per riga {row['job_id']} fallita: {e}", flush=True)
+            finally:
+                media_metadata.forget(clip_path)
+                try:
+                    os.unlink(clip_path)
+                except OSError:
+                    pass
+                in_flight.release()
+        
+        def fetch_slot(slot, normalizers):
+            query, _k = slot
+            in_flight.acquire()
+            try:
+                row, scene_number = slots[slot][0]
+                clip_path, _segment = fetch_clip_for_scene(scene_number, query, row["segment"] or 0, metrics, picker, workspace.dir)
+            except Exception as e:
+                print(f"⚠️ Batch {batch_id}: '{query[:40]}': {e}", flush=True)
+                clip_path = None
+            if not clip_path:
+                in_flight.release()
+                return
+            normalizers.submit(normalize_slot, slot, clip_path)
+        
+        with metrics.stage("clips"):
+            with ThreadPoolExecutor(max_workers=max(1, NORMALIZE_WORKERS), thread_name_prefix="batch-normalize") as normalizers:
+                with ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS), thread_name_prefix="batch-fetch") as fetchers:
+                    for fut in [fetchers.submit(fetch_slot, slot, normalizers) for slot in slots]:
+                        fut.result()
+        
+        print(f"✅ Batch {batch_id}: {len(ready)}/{scenes_total} clip pronte nelle righe", flush=True)
+        job.update({"status": "completed", "rows_planned": len(rows), "scenes": scenes_total,
+                    "unique_clips": len(slots), "clips_ready": len(ready)})
+        save(**{k: v for k, v in job.items() if k != "job_id"}, timings=metrics.snapshot())
+    
+    except LeaseLost as e:
+        # il piano lo rifà (e poi rilascia le righe) il worker che ha ripreso il job
+        print(f"⚠️ Batch {batch_id} interrotto: {e}", flush=True)
+        job["status"] = "processing"
+    
+    except Exception as e:
+        print(f"❌ ERRORE BATCH {batch_id}: {e}", flush=True)
+        job.update({"status": "failed", "error": str(e)})
+        try:
+            save(status="failed", error=str(e), timings=metrics.snapshot())
+        except LeaseLost:
+            job["status"] = "processing"
     
     finally:
-        Thread(target=lambda: cleanup_job_delayed(job_id), daemon=True).start()
+        if job["status"] in TERMINAL_STATUSES:
+            released = release_batch_rows(row_ids)
+            if released:
+                print(f"🚀 Batch {batch_id}: {released} righe in coda", flush=True)
+            if workspace:
+                workspace.remove()
+
+def release_batch_rows(row_ids):
+    released = 0
+    for row_id in row_ids:
+        try:
+            released += bool(job_store.release(row_id))
+        except Exception as e:
+            print(f"⚠️ Rilascio riga {row_id} fallito: {e}", flush=True)
+    if released:
+        dispatch_event.set()
+    return released
+
+def release_orphan_batch_rows():
+    """Righe ancora waiting il cui job di piano è terminato o sparito (es. abbandonato dopo crash)."""
+    orphans = []
+    for record in job_store.waiting_jobs():
+        plan = job_store.get(record.get("batch_id") or "")
+        if plan is None or plan.get("status") in TERMINAL_STATUSES:
+            orphans.append(record["job_id"])
+    return release_batch_rows(orphans)
+
+# -------------------------------------------------
+# Worker pool: MAX_CONCURRENT thread per processo che reclamano i job dallo store condiviso
+# (anche quelli di worker crashati). Il cap MAX_CONCURRENT vale su tutti i worker gunicorn.
+# -------------------------------------------------
+dispatch_event = Event()
+shutdown_event = Event()
+active_jobs = {}
+active_jobs_lock = Lock()
+
+def run_claimed_job(record):
+    """Esegue un job reclamato rinnovando il lease finché è in corso."""
+    job_id = record["job_id"]
+    done = Event()
+    lease = JobLease(job_id, WORKER_ID)
+
+    def heartbeat():
+        while not done.wait(JOB_LEASE_SECONDS / 3):
+            if not lease.renew():
+                print(f"⚠️ Lease perso per job {job_id}", flush=True)
+                return
+
+    Thread(target=heartbeat, daemon=True).start()
+    with active_jobs_lock:
+        active_jobs[job_id] = done
+    try:
+        if record.get("attempts", 1) > 1:
+            print(f"🔁 Job {job_id} ripreso (tentativo {record['attempts']}/{JOB_MAX_ATTEMPTS})", flush=True)
+        if record.get("kind") == "batch_plan":
+            process_batch_plan(job_id, record.get("data") or {}, lease)
+        else:
+            process_video_async(job_id, record.get("data") or {}, lease)
+    finally:
+        done.set()
+        with active_jobs_lock:
+            active_jobs.pop(job_id, None)
+
+def worker_loop():
+    while not shutdown_event.is_set():
+        try:
+            record = job_store.claim(WORKER_ID, max_active=MAX_CONCURRENT)
+            if record:
+                run_claimed_job(record)
+                dispatch_event.set()
+                continue
+        except Exception as e:
+            print(f"⚠️ Worker: {e}", flush=True)
+        dispatch_event.wait(JOB_POLL_INTERVAL)
+        dispatch_event.clear()
+
+def janitor_loop():
+    while not shutdown_event.wait(60):
+        try:
+            job_store.purge_expired()
+        except Exception as e:
+            print(f"⚠️ Purge job scaduti: {e}", flush=True)
+        try:
+            removed = reap_workspaces()
+            if removed:
+                print(f"🧹 Workspace abbandonate rimosse: {removed}", flush=True)
+        except Exception as e:
+            print(f"⚠️ Pulizia workspace: {e}", flush=True)
+        try:
+            removed = reap_uploads()
+            if removed:
+                print(f"🧹 Upload audio orfani rimossi: {removed}", flush=True)
+        except Exception as e:
+            print(f"⚠️ Pulizia upload audio: {e}", flush=True)
+        try:
+            release_orphan_batch_rows()
+        except Exception as e:
+            print(f"⚠️ Rilascio righe batch: {e}", flush=True)
+
+def shutdown_workers(grace=SHUTDOWN_GRACE):
+    """Smette di reclamare job, aspetta `grace` secondi e rimette in coda quelli ancora in corso."""
+    shutdown_event.set()
+    dispatch_event.set()
+    deadline = time.monotonic() + grace
+    with active_jobs_lock:
+        running = dict(active_jobs)
+    for job_id, done in running.items():
+        done.wait(max(0.0, deadline - time.monotonic()))
+    with active_jobs_lock:
+        leftover = list(active_jobs)
+    for job_id in leftover:
+        try:
+            job_store.requeue(job_id, WORKER_ID)
+            print(f"↩️ Job {job_id} rimesso in coda per shutdown", flush=True)
+        except Exception as e:
+            print(f"⚠️ Requeue job {job_id} fallito: {e}", flush=True)
+    if sheets_writer:
+        sheets_writer.flush()
+    webhook_dispatcher.flush(max(1.0, deadline - time.monotonic()))
+
+def install_shutdown_handler():
+    """SIGTERM: drain/requeue dei job e poi l'handler precedente (quello di gunicorn se presente)."""
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            print("🛑 SIGTERM: drain dei job in corso", flush=True)
+            shutdown_workers()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
 
-def cleanup_job_delayed(job_id, delay=3600):
-    import time
-    time.sleep(delay)
-    if job_id in jobs:
-        del jobs[job_id]
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:
+        pass  # non siamo nel main thread
+
+def start_workers():
+    for i in range(max(1, MAX_CONCURRENT)):
+        Thread(target=worker_loop, name=f"job-worker-{i}", daemon=True).start()
+    Thread(target=janitor_loop, name="job-janitor", daemon=True).start()
+    if R2_BUCKET_NAME:
+        Thread(target=retention_loop, name="r2-retention", daemon=True).start()
+    webhook_dispatcher.replay()
+    install_shutdown_handler()
 
 @app.route("/generate", methods=["POST"])
 def generate():
     try:
-        data = request.get_json(force=True) or {}
+        if shutdown_event.is_set():
+            return jsonify({"success": False, "error": "Server in shutdown, riprova"}), 503
+        # le righe di batch in attesa entreranno in coda a breve: contano nel backlog
+        queue_depth = job_store.queue_depth() + job_store.waiting_count()
+        if queue_depth >= MAX_QUEUE:
+            resp = jsonify({"success": False, "error": "Coda piena, riprova più tardi", "queue_depth": queue_depth})
+            resp.headers["Retry-After"] = "60"
+            return resp, 429
         job_id = str(uuid.uuid4())
+        try:
+            data = read_generate_request(job_id)
+        except (ValueError, BadRequest) as e:  # anche binascii.Error, json.JSONDecodeError, body non JSON
+            return jsonify({"success": False, "error": f"Richiesta non valida: {e}"}), 400
+        try:
+            priority = int(data.get("priority") or 0)
+        except (TypeError, ValueError):
+            priority = 0
         
-        jobs[job_id] = {
+        job_store.create(job_id, {
             "status": "queued",
             "created_at": dt.datetime.utcnow().isoformat(),
             "data": data
-        }
-        
-        if len(jobs) > MAX_JOBS:
-            old_jobs = sorted(jobs.keys(), key=lambda k: jobs[k]["created_at"])[:len(jobs)-MAX_JOBS]
-            for oj in old_jobs:
-                del jobs[oj]
-        
-        Thread(target=process_video_async, args=(job_id, data), daemon=True).start()
+        }, priority=priority)
+        dispatch_event.set()
         
         print(f"🚀 Job {job_id} QUEUED: raw_row={data.get('row_number')}", flush=True)
         return jsonify({
             "success": True,
             "job_id": job_id,
             "status": "queued",
+            "queue_position": job_store.queue_position(job_id),
             "message": "Video generation started (check /status/<job_id>)"
         })
     
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/generate/batch", methods=["POST"])
+def generate_batch():
+    """Più righe del foglio in una richiesta: JSON `{"rows": [{...come /generate...}], ...campi comuni}`.
+
+    Ogni riga diventa un job con il suo job_id (status e webhook come /generate), in attesa
+    del job di piano `batch_id` che condivide ricerche, download e normalizzazioni tra le righe.
+    L'audio di ogni riga arriva solo da `audio_url`: decine di `audio_base64` in un unico body
+    riporterebbero tutto l'audio del batch in memoria.
+    """
+    try:
+        if shutdown_event.is_set():
+            return jsonify({"success": False, "error": "Server in shutdown, riprova"}), 503
+        if (request.content_length or 0) > BATCH_MAX_BODY_KB * 1024:
+            return jsonify({"success": False, "error": f"Body oltre {BATCH_MAX_BODY_KB}KB: usa audio_url per le righe"}), 413
+        payload = request.get_json(force=True) or {}
+        rows = payload.pop("rows", None)
+        if not isinstance(rows, list) or not rows or not all(isinstance(r, dict) for r in rows):
+            return jsonify({"success": False, "error": "rows deve essere una lista non vuota di oggetti"}), 400
+        rows = [dict(payload, **row) for row in rows]
+        if not all(row.get("audio_url") and not (row.get("audio_base64") or row.get("audiobase64")) for row in rows):
+            return jsonify({"success": False, "error": "Ogni riga del batch richiede audio_url (niente audio_base64)"}), 400
+        # il job di piano entra in coda insieme alle righe: occupa anche lui un posto
+        max_rows = min(BATCH_MAX_ROWS, MAX_QUEUE - 1)
+        if len(rows) > max_rows:
+            return jsonify({"success": False, "error": f"Massimo {max_rows} righe per batch"}), 400
+        queue_depth = job_store.queue_depth() + job_store.waiting_count()
+        if queue_depth + len(rows) + 1 > MAX_QUEUE:
+            resp = jsonify({"success": False, "error": "Coda piena, riprova più tardi", "queue_depth": queue_depth})
+            resp.headers["Retry-After"] = "60"
+            return resp, 429
+        try:
+            priority = int(payload.get("priority") or 0)
+        except (TypeError, ValueError):
+            priority = 0
+        
+        batch_id = str(uuid.uuid4())
+        created_at = dt.datetime.utcnow().isoformat()
+        jobs = []
+        for row in rows:
+            job_id = str(uuid.uuid4())
+            data = row
+            job_store.create(job_id, {
+                "status": "waiting",
+                "created_at": created_at,
+                "batch_id": batch_id,
+                "data": data
+            }, priority=priority)
+            jobs.append({"job_id": job_id, "row_number": data.get("row_number")})
+        job_store.create(batch_id, {
+            "status": "queued",
+            "created_at": created_at,
+            "kind": "batch_plan",
+            "data": {"rows": [j["job_id"] for j in jobs]}
+        }, priority=priority)
+        dispatch_event.set()
+        
+        print(f"🚀 Batch {batch_id} QUEUED: {len(jobs)} righe", flush=True)
+        return jsonify({
+            "success": True,
+            "batch_id": batch_id,
+            "status": "queued",
+            "jobs": jobs,
+            "message": "Batch started (check /status/<batch_id> and /status/<job_id>)"
+        })
+    
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+if JOB_WORKERS_ENABLED:
+    start_workers()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, threaded=True)
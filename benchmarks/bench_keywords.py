@@ -0,0 +1,174 @@
+"""Micro-benchmark del classificatore keyword: catena di `in` (prima) vs KeywordMatcher (dopo).
+
+Misura il costo di classificazione per scena: una `pick_visual_query` + `is_sogni_video_metadata`
+sui 50 risultati provider che una scena può esaminare (25 Pexels + 25 Pixabay). Le versioni
+legacy sono copiate dal codice precedente (tests/test_keywords.py verifica che diano gli stessi
+risultati del KeywordMatcher); il print per risultato va su /dev/null, quindi il "prima" conta
+la formattazione del log ma non l'I/O reale verso i log della piattaforma.
+
+    python benchmarks/bench_keywords.py [--scenes 40] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("JOB_WORKERS_ENABLED", "0")
+os.environ.setdefault("LOG_RATE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+FILLER = ("il sogno di questa notte racconta una strada sconosciuta dove la persona cammina "
+          "lentamente tra luci soffuse e voci lontane senza capire dove si trova").split()
+PROVIDER_WORDS = ("beautiful nature video footage background people city street urban slow motion "
+                  "close up aerial view drone landscape travel summer winter").split()
+
+def legacy_pick_visual_query(context: str, keywords_text: str = "") -> str:
+    """pick_visual_query prima del KeywordMatcher (catena di any(w in ctx ...))."""
+    ctx = (context or "").lower()
+    kw = (keywords_text or "").lower()
+    
+    base = "dreamlike night sky surreal clouds moonlight abstract shapes introspective person thinking"
+    
+    if any(w in ctx for w in ["ricorrent", "sempre lo stesso", "ripet", "loop"]):
+        return "repeating corridor endless hallway looping doors abstract repetition surreal pattern"
+    if any(w in ctx for w in ["ansia", "paura", "terror", "incubo", "angoscia", "panico"]):
+        return "dark corridor shadowy figure dramatic lighting person stressed surreal nightmare atmosphere"
+    if any(w in ctx for w in ["ex", "relazione", "amore", "partner", "fidanzat"]):
+        return "couple silhouette at night distant people city lights person looking old photos emotional"
+    if any(w in ctx for w in ["famiglia", "genitori", "madre", "padre", "figli", "bambin"]):
+        return "family silhouettes warm home interior parents with child soft light nostalgic atmosphere"
+    if any(w in ctx for w in ["morte", "lutto", "perdita", "funerale", "addio"]):
+        return "lonely person cemetery sunset field person sitting alone bench reflective grief mood"
+    if any(w in ctx for w in ["volare", "volo", "libertà", "libero"]):
+        return "person on mountain top arms open birds in sky clouds airplane window wide open sky"
+    if any(w in ctx for w in ["cadere", "vuoto", "precipitar", "crollo"]):
+        return "view from high building down abstract falling shapes person looking down height dramatic"
+    if any(w in ctx for w in ["inseguit", "scappare", "fuga", "scappando"]):
+        return "person running at night dark alley light at end blurred motion tense chase atmosphere"
+    if any(w in ctx for w in ["nudo", "nuda", "vergogna", "imbarazz", "esposto"]):
+        return "person covering with blanket spotlight on stage crowd blurred shame concept"
+    if any(w in ctx for w in ["mare", "acqua", "oceano", "onda", "tsunami", "pioggia"]):
+        return "ocean waves slow motion underwater light rays rain on window calm stormy sea"
+    if any(w in ctx for w in ["casa", "stanza", "porta", "corridoio", "scalinata"]):
+        return "mysterious door light behind long corridor house interior shadows stairs low light"
+    if any(w in ctx for w in ["cane", "gatto", "serpente", "animale", "leone", "ragno"]):
+        return "animal silhouette fog close up eye animal surreal environment symbolic wildlife"
+    if any(w in ctx for w in ["esame", "scuola", "università", "lavoro", "colloquio", "licenziato"]):
+        return "student classroom stressed person office desk night alarm clock papers books"
+    if any(w in ctx for w in ["sogno lucido", "lucidi", "controllo sogno", "consapevole"]):
+        return "person floating space surreal landscape glowing moon mountains abstract geometric dream world"
+    if any(w in ctx for w in ["trauma", "incident", "shock", "attacco"]):
+        return "broken glass slow motion person sitting floor dark room dramatic shadow lighting"
+    if any(w in ctx for w in ["archetipo", "jung", "ombra", "inconscio", "psiche"]):
+        return "surreal human silhouette galaxy inside split face light shadow abstract psychological art"
+    if any(w in ctx for w in ["premonit", "spiritual", "segnale", "universo", "destino"]):
+        return "starry night sky person looking stars galaxy timelapse light beams from sky"
+    
+    if kw and kw != "none":
+        return f"{kw}, dreamy night sky, surreal atmosphere, symbolic visuals, introspective person"
+    
+    return base
+
+
+LEGACY_DREAM = ["dream", "night", "sky", "clouds", "moon", "stars", "surreal", "abstract",
+                "person", "thinking", "silhouette", "shadow", "light", "emotional", "reflective",
+                "water", "ocean", "corridor", "dark", "mysterious", "spiritual", "cosmic"]
+LEGACY_BANNED = ["football", "soccer", "basketball", "tennis", "sport", "workout", "gym", "fitness",
+                 "kitchen", "cooking", "recipe", "food", "restaurant", "party", "festival", "concert",
+                 "videogame", "gaming", "esports", "business", "stock market", "money", "dollar", "finance"]
+
+def legacy_classify(text):
+    dream_count = sum(1 for kw in LEGACY_DREAM if kw in text)
+    has_banned = any(kw in text for kw in LEGACY_BANNED)
+    return dream_count, has_banned
+
+def legacy_is_sogni(text, source="pexels"):
+    """is_sogni_video_metadata prima del KeywordMatcher (liste ricostruite a ogni chiamata)."""
+    video_data = {"description": text, "tags": []}
+    dream_keywords = ["dream", "night", "sky", "clouds", "moon", "stars", "surreal", "abstract",
+                      "person", "thinking", "silhouette", "shadow", "light", "emotional", "reflective",
+                      "water", "ocean", "corridor", "dark", "mysterious", "spiritual", "cosmic"]
+    banned = ["football", "soccer", "basketball", "tennis", "sport", "workout", "gym", "fitness",
+              "kitchen", "cooking", "recipe", "food", "restaurant", "party", "festival", "concert",
+              "videogame", "gaming", "esports", "business", "stock market", "money", "dollar", "finance"]
+    text = (video_data.get("description", "") + " " + " ".join(video_data.get("tags", []))).lower()
+    dream_count = sum(1 for kw in dream_keywords if kw in text)
+    has_banned = any(kw in text for kw in banned)
+    if has_banned:
+        status = "❌ BANNED"
+    elif dream_count >= 1:
+        status = f"✅ DREAM({dream_count})"
+    else:
+        status = f"⚠️ NEUTRAL(dream:{dream_count})"
+    print(f"🔍 [{source}] '{text[:60]}...' → {status}", flush=True)
+    return not has_banned
+
+def current_is_sogni(text, source="pexels"):
+    return app.is_sogni_video_metadata({"description": text, "tags": []}, source)
+
+def build_workload(scenes, rng):
+    with open(app.KEYWORD_RULES_PATH, encoding="utf-8") as f:
+        rules = json.load(f)
+    terms = [t for rule in rules["scene_rules"] for t in rule["terms"]]
+    contexts = []
+    texts = []
+    for _ in range(scenes):
+        words = rng.sample(FILLER, 6)
+        if rng.random() < 0.7:
+            words.insert(rng.randrange(len(words)), rng.choice(terms))
+        contexts.append(" ".join(words))
+        scene_texts = []
+        for _ in range(50):
+            words = rng.sample(PROVIDER_WORDS, 8)
+            words += rng.sample(LEGACY_DREAM, rng.randint(0, 3))
+            if rng.random() < 0.15:
+                words.append(rng.choice(LEGACY_BANNED))
+            rng.shuffle(words)
+            scene_texts.append(" ".join(words).lower())
+        texts.append(scene_texts)
+    return contexts, texts
+
+def run(pick, classify, contexts, texts, keywords):
+    for ctx, scene_texts in zip(contexts, texts):
+        pick(ctx, keywords)
+        for text in scene_texts:
+            classify(text)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    contexts, texts = build_workload(args.scenes, rng)
+    keywords = "sogni ricorrenti, inconscio"
+
+    results = {}
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        for name, pick, classify in (
+            ("prima (any/in + print)", legacy_pick_visual_query, legacy_is_sogni),
+            ("dopo (KeywordMatcher)", app.pick_visual_query, current_is_sogni),
+        ):
+            best = float("inf")
+            for _ in range(args.repeat):
+                sys.stdout = devnull
+                started = time.perf_counter()
+                try:
+                    run(pick, classify, contexts, texts, keywords)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    sys.stdout = stdout
+                best = min(best, elapsed)
+            results[name] = best / args.scenes * 1e6
+            print(f"{name:24s} {results[name]:8.1f} µs/scena")
+    before, after = results.values()
+    print(f"{'speedup':24s} {before / after:8.2f}x (LOG_RATE={app.LOG_RATE})")
+
+if __name__ == "__main__":
+    main()
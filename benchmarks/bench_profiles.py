@@ -0,0 +1,102 @@
+"""Benchmark profili encoder: video/ora per profilo (draft/standard/archive) su un numero fisso di CPU.
+
+Genera clip sorgente sintetiche (lavfi testsrc2 + rumore, diverse per job e clip così la norm
+cache non aiuta), poi simula `--jobs` job concorrenti che normalizzano `--clips` clip ciascuno con
+normalize_clip (NORMALIZE_WORKERS encode paralleli per job). Il processo è vincolato a `--cpus`
+core con sched_setaffinity e FFMPEG_CPU_BUDGET = `--cpus`; con `--no-adaptive` i thread li sceglie
+ffmpeg, come prima del budget. Video/ora = clip normalizzate all'ora / MAX_CLIPS: l'encode delle
+clip è il costo CPU di un video (download e upload esclusi). Richiede ffmpeg nel PATH.
+
+    python benchmarks/bench_profiles.py [--cpus 2] [--jobs 2] [--clips 4] [--seconds 6] [--no-adaptive]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("--cpus", type=int, default=2)
+parser.add_argument("--jobs", type=int, default=2)
+parser.add_argument("--clips", type=int, default=4)
+parser.add_argument("--seconds", type=float, default=6.0)
+parser.add_argument("--profiles", default="draft,standard,archive")
+parser.add_argument("--no-adaptive", action="store_true")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="bench_profiles_")
+os.environ.setdefault("JOB_WORKERS_ENABLED", "0")
+os.environ.setdefault("LOG_RATE", "0")
+os.environ["FFMPEG_CPU_BUDGET"] = str(args.cpus)
+os.environ["FFMPEG_ADAPTIVE_THREADS"] = "0" if args.no_adaptive else "1"
+for name, filename in (("JOB_DB_PATH", "jobs.sqlite3"), ("SEARCH_CACHE_PATH", "search.sqlite3"),
+                       ("R2_MANIFEST_PATH", "r2.sqlite3"), ("NORM_CACHE_DIR", "norm_cache"),
+                       ("CLIP_CACHE_DIR", "clip_cache"), ("JOB_WORKSPACE_DIR", "workspaces")):
+    os.environ[name] = os.path.join(workdir, filename)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+def make_source(path, seconds, seed):
+    """Clip 1080p sintetica: testsrc2 con tinta e rumore diversi per `seed`."""
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={seconds}",
+        "-vf", f"hue=h={seed * 37 % 360},noise=alls=12:allf=t",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18", path
+    ], check=True)
+
+def run_job(sources, profile):
+    outputs = []
+    with ThreadPoolExecutor(max_workers=max(1, app.NORMALIZE_WORKERS)) as pool:
+        for path, _duration in pool.map(lambda src: app.normalize_clip(src, profile=profile), sources):
+            outputs.append(path)
+    size = sum(os.path.getsize(p) for p in outputs)
+    for p in outputs:
+        os.unlink(p)
+    return size
+
+def main():
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg non trovato nel PATH", file=sys.stderr)
+        shutil.rmtree(workdir, ignore_errors=True)
+        return 2
+    cpus = sorted(os.sched_getaffinity(0))[:args.cpus]
+    os.sched_setaffinity(0, cpus)
+    profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+    print(f"CPU {cpus}, {args.jobs} job × {args.clips} clip da {args.seconds:.0f}s, "
+          f"NORMALIZE_WORKERS={app.NORMALIZE_WORKERS}, thread adattivi={'no' if args.no_adaptive else 'sì'}")
+
+    for profile in profiles:
+        sources = []
+        for job in range(args.jobs):
+            job_sources = []
+            for clip in range(args.clips):
+                path = os.path.join(workdir, f"src_{profile}_{job}_{clip}.mp4")
+                make_source(path, args.seconds, seed=len(profiles) * 1000 + job * 100 + clip + profiles.index(profile))
+                job_sources.append(path)
+            sources.append(job_sources)
+
+        # i job simulati contano come attivi per il budget thread (come i worker reali)
+        for job in range(args.jobs):
+            app.active_jobs[f"bench-{job}"] = None
+        threads = app.ffmpeg_thread_count(app.NORMALIZE_WORKERS)
+        started = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                sizes = list(pool.map(lambda s: run_job(s, profile), sources))
+        finally:
+            app.active_jobs.clear()
+        elapsed = time.monotonic() - started
+        clips = args.jobs * args.clips
+        print(f"{profile:9s} {elapsed:7.1f}s  {clips / app.MAX_CLIPS / elapsed * 3600:7.1f} video/ora  "
+              f"{elapsed / clips:5.2f}s/clip  {sum(sizes) / clips / 1e6:6.2f} MB/clip  "
+              f"-threads {threads or 'auto'}")
+    shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,475 @@
+"""Benchmark end-to-end offline: process_video_async contro stand-in locali di Pexels/Pixabay/R2/Sheets/n8n.
+
+Avvia in-process:
+  * un server HTTP provider che risponde alle ricerche Pexels/Pixabay e serve clip e audio
+    generati con ffmpeg (testsrc2 + rumore, `--source-clips` sorgenti distinte);
+  * uno store S3-compatibile minimo (PutObject, multipart, HEAD, ListObjectsV2) per l'upload R2,
+    oppure un endpoint esistente con `--s3-endpoint` (es. MinIO);
+  * un endpoint n8n che conta i webhook, e un worksheet finto dietro un vero SheetsWriter.
+
+Per ogni combinazione di `--max-clips` × `--concurrency` accoda `--videos` job e li fa eseguire dallo
+scheduler reale (claim + run_claimed_job), con cache clip/normalizzate/ricerche azzerate (`--warm`
+le mantiene). Riporta tempi medi per fase, RSS di picco (processo e figli ffmpeg), disco temporaneo
+di picco e video/ora. Con `--json` salva i risultati; con `--baseline` li confronta con un run
+precedente e termina con errore se i video/ora calano oltre `--tolerance`.
+
+    python benchmarks/e2e.py [--max-clips 10,20] [--concurrency 1,2] [--videos 2] [--audio-seconds 120]
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BUCKET = "bench"
+DREAM_WORDS = "dream night sky clouds moon stars surreal abstract silhouette shadow".split()
+
+class Stubs:
+    """Stato condiviso dei server finti (media generati, oggetti S3, webhook ricevuti)."""
+
+    def __init__(self, media_dir, latency):
+        self.media_dir = media_dir
+        self.latency = latency
+        self.clips = []
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.webhooks = []
+        self.requests = {"search": 0, "download": 0}
+        self.base_url = None
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+def generate_media(stubs, source_clips, clip_seconds, audio_seconds):
+    for n in range(source_clips):
+        path = os.path.join(stubs.media_dir, f"clip{n}.mp4")
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=25:duration={clip_seconds}",
+            "-vf", f"hue=h={n * 47 % 360},noise=alls=10:allf=t",
+            "-c:v", "libx264", "-preset", "ultrafast", "-crf", "20", path
+        ], check=True)
+        stubs.clips.append(path)
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"sine=frequency=220:duration={audio_seconds}",
+        "-c:a", "aac", "-b:a", "96k", os.path.join(stubs.media_dir, "audio.m4a")
+    ], check=True)
+
+def search_results(stubs, query, clip_seconds, pixabay=False):
+    """25 risultati per query; gli ID mappano sulle sorgenti, così query diverse condividono clip."""
+    offset = int(hashlib.sha256(query.encode()).hexdigest(), 16) % len(stubs.clips)
+    results = []
+    for i in range(25):
+        clip = (offset + i) % len(stubs.clips)
+        url = f"{stubs.base_url}/media/clip{clip}.mp4"
+        tags = " ".join(DREAM_WORDS[(clip + k) % len(DREAM_WORDS)] for k in range(3))
+        if pixabay:
+            results.append({"id": clip, "duration": clip_seconds, "tags": tags.split(),
+                            "videos": {"large": {"url": url, "width": 1920}, "medium": {"url": url, "width": 1280}}})
+        else:
+            results.append({"id": clip, "duration": clip_seconds, "description": f"{tags} footage", "tags": [],
+                            "video_files": [{"width": 1920, "link": url}, {"width": 1280, "link": url}]})
+    return {"hits": results} if pixabay else {"videos": results}
+
+def make_provider_handler(stubs, clip_seconds):
+    class ProviderHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, body, content_type="application/json", status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if stubs.latency:
+                time.sleep(stubs.latency)
+            if url.path in ("/pexels/search", "/pixabay/search"):
+                stubs.count("search")
+                query = (params.get("query") or params.get("q") or [""])[0]
+                payload = search_results(stubs, query, clip_seconds, pixabay=url.path.startswith("/pixabay"))
+                return self.send_body(json.dumps(payload).encode())
+            if url.path.startswith("/media/"):
+                path = os.path.join(stubs.media_dir, os.path.basename(url.path))
+                if not os.path.exists(path):
+                    return self.send_body(b"", status=404)
+                stubs.count("download")
+                with open(path, "rb") as f:
+                    return self.send_body(f.read(), "video/mp4")
+            self.send_body(b"", status=404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/n8n":
+                with stubs.lock:
+                    stubs.webhooks.append(json.loads(body or b"{}"))
+                return self.send_body(b"{}")
+            self.send_body(b"", status=404)
+
+    return ProviderHandler
+
+def make_s3_handler(stubs):
+    """S3 path-style minimo: tiene solo le size degli oggetti, il contenuto viene scartato."""
+
+    class S3Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status=200, body=b"", headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if "Content-Length" not in (headers or {}):
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            remaining = int(self.headers.get("Content-Length") or 0)
+            digest = hashlib.md5()
+            size = 0
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                remaining -= len(chunk)
+            return size, f'"{digest.hexdigest()}"'
+
+        def target(self):
+            url = urlparse(self.path)
+            _bucket, _, key = url.path.lstrip("/").partition("/")
+            return key, parse_qs(url.query, keep_blank_values=True)
+
+        def do_PUT(self):
+            key, params = self.target()
+            size, etag = self.read_body()
+            with stubs.lock:
+                if "uploadId" in params:
+                    stubs.uploads[params["uploadId"][0]][int(params["partNumber"][0])] = size
+                elif key:
+                    stubs.objects[key] = size
+            self.reply(headers={"ETag": etag})
+
+        def do_POST(self):
+            key, params = self.target()
+            self.read_body()
+            if "uploads" in params:
+                upload_id = uuid.uuid4().hex
+                with stubs.lock:
+                    stubs.uploads[upload_id] = {}
+                body = (f"<InitiateMultipartUploadResult><Bucket>{BUCKET}</Bucket><Key>{key}</Key>"
+                        f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+                return self.reply(body=body.encode(), headers={"Content-Type": "application/xml"})
+            if "uploadId" in params:
+                with stubs.lock:
+                    parts = stubs.uploads.pop(params["uploadId"][0], {})
+                    stubs.objects[key] = sum(parts.values())
+                body = (f"<CompleteMultipartUploadResult><Bucket>{BUCKET}</Bucket><Key>{key}</Key>"
+                        f"<ETag>\"{uuid.uuid4().hex}-{len(parts)}\"</ETag></CompleteMultipartUploadResult>")
+                return self.reply(body=body.encode(), headers={"Content-Type": "application/xml"})
+            if "delete" in params:
+                return self.reply(body=b"<DeleteResult></DeleteResult>", headers={"Content-Type": "application/xml"})
+            self.reply(400)
+
+        def do_HEAD(self):
+            key, _params = self.target()
+            with stubs.lock:
+                size = stubs.objects.get(key)
+            self.reply(404 if size is None else 200, headers={"Content-Length": str(size or 0)})
+
+        def do_GET(self):
+            body = (f"<ListBucketResult><Name>{BUCKET}</Name><KeyCount>0</KeyCount>"
+                    f"<IsTruncated>false</IsTruncated></ListBucketResult>")
+            self.reply(body=body.encode(), headers={"Content-Type": "application/xml"})
+
+    return S3Handler
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FakeWorksheet:
+    def __init__(self):
+        self.cells = 0
+        self.calls = 0
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls += 1
+        self.cells += len(data)
+
+def proc_rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return 0
+    return 0
+
+def children_rss_bytes():
+    """RSS totale dei processi figli vivi (gli ffmpeg/ffprobe in corso) letto da /proc."""
+    parent = os.getpid()
+    total = 0
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == parent:
+            total += proc_rss_bytes(name)
+    return total
+
+class Sampler:
+    """Picchi di RSS del processo, RSS sommato dei figli ffmpeg e disco sotto `root`, ogni `interval` secondi."""
+
+    def __init__(self, app, root, interval=0.25):
+        self.app = app
+        self.root = root
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_child_rss = 0
+        self.peak_disk = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, proc_rss_bytes())
+            self.peak_child_rss = max(self.peak_child_rss, children_rss_bytes())
+            self.peak_disk = max(self.peak_disk, self.app.dir_size(self.root))
+            if self.stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+def reset_caches(app, state_dir):
+    for cache in (app.clip_cache, app.norm_cache):
+        shutil.rmtree(cache.directory, ignore_errors=True)
+        cache.stats = dict.fromkeys(cache.stats, 0)
+    path = os.path.join(state_dir, f"search_{uuid.uuid4().hex}.sqlite3")
+    app.search_cache = app.SearchCache(path, app.SEARCH_CACHE_TTL, app.SEARCH_CACHE_MAX_ENTRIES)
+
+def run_config(app, stubs, args, state_dir, max_clips, concurrency):
+    if not args.warm:
+        reset_caches(app, state_dir)
+    app.MAX_CLIPS = max_clips
+    job_ids = []
+    for n in range(args.videos):
+        job_id = f"bench-{max_clips}-{concurrency}-{n}-{uuid.uuid4().hex[:6]}"
+        app.job_store.create(job_id, {
+            "status": "queued",
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "data": {
+                "audio_url": f"{stubs.base_url}/media/audio.m4a",
+                "script": " ".join(["sogno ricorrente di volare sopra il mare di notte"] * 40),
+                "keywords": "sogni, inconscio",
+                "row_number": n + 2,
+                "encoder_profile": args.profile,
+            },
+        })
+        job_ids.append(job_id)
+
+    def bench_worker():
+        while True:
+            record = app.job_store.claim(app.WORKER_ID, max_active=concurrency)
+            if record:
+                app.run_claimed_job(record)
+                continue
+            if app.job_store.queue_depth() == 0:
+                return
+            time.sleep(0.2)
+
+    webhooks_before = len(stubs.webhooks)
+    started = time.monotonic()
+    with Sampler(app, state_dir) as sampler:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for fut in [pool.submit(bench_worker) for _ in range(concurrency)]:
+                fut.result()
+        wall = time.monotonic() - started
+        app.webhook_dispatcher.flush(30)
+        if app.sheets_writer:
+            app.sheets_writer.flush()
+
+    records = [app.job_store.get(job_id) for job_id in job_ids]
+    completed = [r for r in records if r and r["status"] == "completed"]
+    stages = {}
+    for record in completed:
+        for stage, seconds in (record.get("timings") or {}).get("stages", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    errors = sorted({r.get("error") for r in records if r and r["status"] == "failed"})
+    return {
+        "max_clips": max_clips,
+        "concurrency": concurrency,
+        "videos": args.videos,
+        "completed": len(completed),
+        "errors": errors,
+        "wall_seconds": round(wall, 2),
+        "videos_per_hour": round(len(completed) / wall * 3600, 1) if wall else 0.0,
+        "stages_avg": {k: round(sum(v) / len(v), 2) for k, v in sorted(stages.items())},
+        "peak_rss_mb": round(sampler.peak_rss / 1e6, 1),
+        "peak_child_rss_mb": round(sampler.peak_child_rss / 1e6, 1),
+        "peak_temp_disk_mb": round(sampler.peak_disk / 1e6, 1),
+        "webhooks": len(stubs.webhooks) - webhooks_before,
+        "clip_cache": app.clip_cache.snapshot(),
+        "norm_cache": app.norm_cache.snapshot(),
+    }
+
+def print_result(result):
+    stages = " ".join(f"{k} {v:.1f}s" for k, v in result["stages_avg"].items())
+    print(f"MAX_CLIPS={result['max_clips']:<3d} concorrenza={result['concurrency']}: "
+          f"{result['completed']}/{result['videos']} ok, {result['wall_seconds']:.1f}s, "
+          f"{result['videos_per_hour']:.1f} video/ora | RSS picco {result['peak_rss_mb']:.0f}MB "
+          f"(ffmpeg {result['peak_child_rss_mb']:.0f}MB), disco picco {result['peak_temp_disk_mb']:.0f}MB, "
+          f"webhook {result['webhooks']}", flush=True)
+    print(f"    fasi medie: {stages}", flush=True)
+    for error in result["errors"]:
+        print(f"    ❌ {error}", flush=True)
+
+def compare_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {(r["max_clips"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get((result["max_clips"], result["concurrency"]))
+        if not before or not before["videos_per_hour"]:
+            continue
+        change = result["videos_per_hour"] / before["videos_per_hour"] - 1
+        flag = "REGRESSIONE" if change < -tolerance else "ok"
+        regressions += change < -tolerance
+        print(f"  MAX_CLIPS={result['max_clips']} concorrenza={result['concurrency']}: "
+              f"{before['videos_per_hour']:.1f} → {result['videos_per_hour']:.1f} video/ora ({change:+.0%}) {flag}")
+    return regressions
+
+def int_list(text):
+    return [int(v) for v in re.split(r"[,\s]+", text.strip()) if v]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-clips", type=int_list, default=[10, 20])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2])
+    parser.add_argument("--videos", type=int, default=2, help="job per combinazione")
+    parser.add_argument("--audio-seconds", type=int, default=120)
+    parser.add_argument("--clip-seconds", type=int, default=20)
+    parser.add_argument("--source-clips", type=int, default=12)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latenza simulata per richiesta provider")
+    parser.add_argument("--profile", default="standard", help="encoder_profile dei job")
+    parser.add_argument("--s3-endpoint", help="S3 compatibile esistente (bucket già creato) invece dello stub")
+    parser.add_argument("--s3-bucket", default=BUCKET)
+    parser.add_argument("--warm", action="store_true", help="non azzerare le cache tra le combinazioni")
+    parser.add_argument("--json", help="salva i risultati in questo file")
+    parser.add_argument("--baseline", help="risultati JSON di un run precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--keep", action="store_true", help="non cancellare la directory di lavoro")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        print("ffmpeg/ffprobe non trovati nel PATH", file=sys.stderr)
+        return 2
+
+    root = tempfile.mkdtemp(prefix="bench_e2e_")
+    state_dir = os.path.join(root, "state")
+    media_dir = os.path.join(root, "media")
+    os.makedirs(state_dir)
+    os.makedirs(media_dir)
+    try:
+        stubs = Stubs(media_dir, args.latency_ms / 1000.0)
+        print(f"🎞️ Generazione media sintetici in {media_dir}...", flush=True)
+        generate_media(stubs, args.source_clips, args.clip_seconds, args.audio_seconds)
+        provider = serve(make_provider_handler(stubs, args.clip_seconds))
+        stubs.base_url = f"http://127.0.0.1:{provider.server_port}"
+        if args.s3_endpoint:
+            s3_endpoint = args.s3_endpoint
+        else:
+            s3_endpoint = f"http://127.0.0.1:{serve(make_s3_handler(stubs)).server_port}"
+
+        os.environ.update({
+            "JOB_WORKERS_ENABLED": "0",
+            "LOG_RATE": os.environ.get("LOG_RATE", "0"),
+            "JOB_DB_PATH": os.path.join(state_dir, "jobs.sqlite3"),
+            "SEARCH_CACHE_PATH": os.path.join(state_dir, "search.sqlite3"),
+            "R2_MANIFEST_PATH": os.path.join(state_dir, "r2_manifest.sqlite3"),
+            "CLIP_CACHE_DIR": os.path.join(state_dir, "clip_cache"),
+            "NORM_CACHE_DIR": os.path.join(state_dir, "norm_cache"),
+            "JOB_WORKSPACE_DIR": os.path.join(state_dir, "workspaces"),
+            "AUDIO_UPLOAD_DIR": os.path.join(state_dir, "audio_uploads"),
+            "WEBHOOK_DEAD_LETTER_PATH": os.path.join(state_dir, "webhook_dead_letter.jsonl"),
+            "PEXELS_API_KEY": "bench", "PIXABAY_API_KEY": "bench",
+            "PEXELS_API_URL": f"{stubs.base_url}/pexels/search",
+            "PIXABAY_API_URL": f"{stubs.base_url}/pixabay/search",
+            "PEXELS_RATE_PER_MIN": "0", "PIXABAY_RATE_PER_MIN": "0",
+            "N8N_WEBHOOK_URL_SIGNIFICATO_DEI_SOGNI_FLUSSO2": f"{stubs.base_url}/n8n",
+            "R2_ACCESS_KEY_ID": os.environ.get("R2_ACCESS_KEY_ID", "bench"),
+            "R2_SECRET_ACCESS_KEY": os.environ.get("R2_SECRET_ACCESS_KEY", "bench"),
+            "R2_BUCKET_NAME": args.s3_bucket,
+            "R2_PUBLIC_BASE_URL": f"{s3_endpoint}/{args.s3_bucket}",
+            "R2_ENDPOINT_URL": s3_endpoint,
+            "R2_REGION": "us-east-1",
+            "R2_ADDRESSING_STYLE": "path",
+            "GOOGLE_CREDENTIALS_JSON": "",
+        })
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        app = importlib.import_module("app")
+        worksheet = FakeWorksheet()
+        app.sheets_writer = app.SheetsWriter(lambda: worksheet, flush_interval=0.2)
+
+        print(f"▶️ {len(args.max_clips) * len(args.concurrency)} combinazioni × {args.videos} video, "
+              f"audio {args.audio_seconds}s, CPU {os.cpu_count()}", flush=True)
+        results = []
+        for max_clips in args.max_clips:
+            for concurrency in args.concurrency:
+                result = run_config(app, stubs, args, state_dir, max_clips, concurrency)
+                results.append(result)
+                print_result(result)
+        print(f"📊 Sheets finto: {worksheet.cells} celle in {worksheet.calls} batch_update; "
+              f"provider: {stubs.requests['search']} ricerche, {stubs.requests['download']} download; "
+              f"S3: {len(stubs.objects)} oggetti", flush=True)
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+                           "results": results}, f, indent=2)
+        if args.baseline:
+            return 1 if compare_baseline(results, args.baseline, args.tolerance) else 0
+        return 0 if all(r["completed"] == r["videos"] for r in results) else 1
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
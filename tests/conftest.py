@@ -0,0 +1,36 @@
+"""Configurazione comune dei test: l'app si importa con stato su file temporanei e senza worker."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+STATE_DIR = tempfile.mkdtemp(prefix="app_tests_")
+os.environ.update({
+    "JOB_WORKERS_ENABLED": "0",
+    "LOG_RATE": "0",
+    "JOB_DB_PATH": os.path.join(STATE_DIR, "jobs.sqlite3"),
+    "SEARCH_CACHE_PATH": os.path.join(STATE_DIR, "search.sqlite3"),
+    "R2_MANIFEST_PATH": os.path.join(STATE_DIR, "r2_manifest.sqlite3"),
+    "CLIP_CACHE_DIR": os.path.join(STATE_DIR, "clip_cache"),
+    "NORM_CACHE_DIR": os.path.join(STATE_DIR, "norm_cache"),
+    "JOB_WORKSPACE_DIR": os.path.join(STATE_DIR, "workspaces"),
+    "AUDIO_UPLOAD_DIR": os.path.join(STATE_DIR, "audio_uploads"),
+    "WEBHOOK_DEAD_LETTER_PATH": os.path.join(STATE_DIR, "webhook_dead_letter.jsonl"),
+    "WEBHOOK_JOURNAL_DIR": os.path.join(STATE_DIR, "webhook_journal"),
+    "GOOGLE_CREDENTIALS_JSON": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "ffmpeg: test di integrazione che richiedono ffmpeg nel PATH")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """SQLiteJobStore su file temporaneo, installato come job store globale dell'app."""
+    import app
+    job_store = app.SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(app, "job_store", job_store)
+    return job_store
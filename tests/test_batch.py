@@ -0,0 +1,105 @@
+"""/generate/batch: admission sul backlog condiviso e piano scene delle righe."""
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def small_queue(monkeypatch):
+    monkeypatch.setattr(app, "MAX_QUEUE", 5)
+
+
+def post_batch(rows, **common):
+    body = dict(common, rows=[{"row_number": r, "audio_url": f"https://audio/{r}.mp3"} for r in rows])
+    return app.app.test_client().post("/generate/batch", json=body)
+
+
+def test_batch_admission_counts_the_plan_job(store):
+    for i in range(3):
+        store.create(f"queued-{i}", {"data": {}})
+
+    assert post_batch([2, 3]).status_code == 429
+    assert store.count() == 3
+
+    resp = post_batch([2])
+
+    assert resp.status_code == 200
+    assert store.queue_depth() + store.waiting_count() == app.MAX_QUEUE
+
+
+def test_batch_larger_than_the_queue_minus_the_plan_job_is_rejected(store):
+    resp = post_batch(range(2, 2 + app.MAX_QUEUE))
+
+    assert resp.status_code == 400
+    assert f"Massimo {app.MAX_QUEUE - 1} righe" in resp.get_json()["error"]
+
+
+def test_batch_rows_require_audio_url(store):
+    client = app.app.test_client()
+
+    missing = client.post("/generate/batch", json={"rows": [{"row_number": 2}]})
+    inline = post_batch([2], audio_base64="AAAA")
+
+    assert missing.status_code == 400
+    assert inline.status_code == 400
+    assert "audio_url" in inline.get_json()["error"]
+    assert store.count() == 0
+
+
+def test_oversized_batch_body_is_rejected_before_parsing(store, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_BODY_KB", 1)
+
+    resp = post_batch([2], description="x" * 2048)
+
+    assert resp.status_code == 413
+    assert store.count() == 0
+
+
+def test_short_batch_rows_plan_the_minimum_clips_with_shorter_scenes(monkeypatch):
+    monkeypatch.setattr(app, "MAX_CLIPS", 5)
+    segment = app.batch_segment(14 / app.MAX_CLIPS)
+
+    scenes, scene_duration = app.plan_scenes("un sogno breve", "", 14, segment)
+
+    assert segment == 5
+    assert len(scenes) == app.MIN_CLIPS
+    assert scene_duration == pytest.approx(2.8)
+    # ogni scena pianificata entra nella timeline
+    clips = [(scene["scene"], scene_duration) for scene in scenes]
+    assert len(app.build_timeline(clips, 14)) == len(scenes)
+
+
+def test_long_batch_rows_keep_the_rounded_segment():
+    scenes, scene_duration = app.plan_scenes("un sogno", "", 300, 10)
+
+    assert len(scenes) == 30
+    assert scene_duration == 10
+
+
+@pytest.mark.parametrize("clip_trim", [True, False])
+def test_retried_batch_plan_reuses_the_checkpointed_segment(store, monkeypatch, tmp_path, clip_trim):
+    monkeypatch.setattr(app, "CLIP_TRIM", clip_trim)
+    monkeypatch.setattr(app, "probe_duration", lambda source, metrics=None: 120.0)
+    monkeypatch.setattr(app, "release_batch_rows", lambda row_ids: 0)
+    segments = []
+
+    def fetch(scene_number, query, avg_scene_duration, metrics=None, picker=None, workdir=None):
+        path = tmp_path / f"source-{len(segments)}-{scene_number}.mp4"
+        path.write_bytes(b"clip")
+        return str(path), None
+
+    def normalize(clip_path, metrics=None, segment=None, workdir=None, profile=None):
+        segments.append(segment)
+        return f"{workdir}/missing.mp4", 3.0  # mai su disco: il retry rifà tutte le scene
+
+    monkeypatch.setattr(app, "fetch_clip_for_scene", fetch)
+    monkeypatch.setattr(app, "normalize_clip", normalize)
+    store.create("row", {"status": "waiting", "batch_id": "batch", "data": {"audio_url": "https://audio"}})
+
+    app.process_batch_plan("batch", {"rows": ["row"]})
+    first = set(segments)
+    segments.clear()
+    app.process_batch_plan("batch", {"rows": ["row"]})
+
+    assert set(segments) == first == ({app.batch_segment(120.0 / app.MAX_CLIPS)} if clip_trim else {None})
+    app.JobWorkspace("row").remove()
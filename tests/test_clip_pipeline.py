@@ -0,0 +1,97 @@
+"""run_clip_pipeline con fetch e normalize finti: ordine, backpressure e fallimenti."""
+import random
+from threading import Lock, Thread
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Fetch/normalize finti; `state` conta le sorgenti scaricate e non ancora normalizzate."""
+    monkeypatch.setattr(app, "FETCH_WORKERS", 4)
+    monkeypatch.setattr(app, "NORMALIZE_WORKERS", 1)
+    monkeypatch.setattr(app, "PIPELINE_QUEUE_SIZE", 1)
+    state = {"outstanding": 0, "peak": 0, "fetch_fails": set(), "normalize_fails": set(),
+             "fetch_delay": 0.0, "normalize_delay": 0.0}
+    lock = Lock()
+
+    def fetch(scene_number, query, avg_scene_duration, metrics=None, picker=None, workdir=None):
+        app.time.sleep(random.uniform(0, state["fetch_delay"]))
+        if scene_number in state["fetch_fails"]:
+            raise RuntimeError("provider giù")
+        path = tmp_path / f"source-{scene_number}.mp4"
+        path.write_bytes(b"clip")
+        with lock:
+            state["outstanding"] += 1
+            state["peak"] = max(state["peak"], state["outstanding"])
+        return str(path), 4
+
+    def normalize(clip_path, metrics=None, segment=None, workdir=None, profile=None):
+        app.time.sleep(state["normalize_delay"])
+        with lock:
+            state["outstanding"] -= 1
+        scene_number = int(clip_path.rsplit("-", 1)[1].split(".")[0])
+        if scene_number in state["normalize_fails"]:
+            raise RuntimeError("ffmpeg fallito")
+        return f"normalized-{scene_number}.mp4", float(scene_number)
+
+    monkeypatch.setattr(app, "fetch_clip_for_scene", fetch)
+    monkeypatch.setattr(app, "normalize_clip", normalize)
+    return state
+
+
+def scenes(n):
+    return [{"scene": i, "query": f"q{i}"} for i in range(1, n + 1)]
+
+
+def run(assignments, workspace=None, timeout=10):
+    """Esegue la pipeline in un thread: se un normalizer si blocca il test fallisce invece di appendersi."""
+    result = {}
+    worker = Thread(target=lambda: result.update(out=app.run_clip_pipeline(assignments, 4.0, workspace=workspace)),
+                    daemon=True)
+    worker.start()
+    worker.join(timeout)
+    assert not worker.is_alive(), "pipeline bloccata"
+    return result["out"]
+
+
+def test_results_keep_scene_order_whatever_the_download_order(pipeline):
+    pipeline["fetch_delay"] = 0.02
+
+    clips, downloaded = run(scenes(12))
+
+    assert clips == [(f"normalized-{i}.mp4", float(i)) for i in range(1, 13)]
+    assert downloaded == 12
+
+
+def test_full_queue_holds_back_downloads(pipeline):
+    pipeline["normalize_delay"] = 0.02
+
+    clips, _downloaded = run(scenes(16))
+
+    assert len(clips) == 16
+    # sorgenti su disco: al massimo una per fetcher, una in coda, una in normalizzazione
+    assert pipeline["peak"] <= app.FETCH_WORKERS + app.PIPELINE_QUEUE_SIZE + app.NORMALIZE_WORKERS
+    assert pipeline["peak"] < 16
+
+
+def test_failed_downloads_and_normalizations_do_not_stall_the_pipeline(pipeline, tmp_path):
+    pipeline["fetch_fails"] = {2, 5}
+    pipeline["normalize_fails"] = {3, 8}
+
+    clips, downloaded = run(scenes(10))
+
+    assert [path for path, _duration in clips] == [f"normalized-{i}.mp4" for i in (1, 4, 6, 7, 9, 10)]
+    assert downloaded == 8
+    assert not list(tmp_path.glob("source-*.mp4"))  # anche le sorgenti fallite sono rimosse
+
+
+def test_workspace_checkpoints_every_normalized_clip(pipeline, tmp_path):
+    workspace = app.JobWorkspace("pipeline", root=str(tmp_path / "ws"))
+    pipeline["normalize_fails"] = {2}
+
+    run(scenes(3), workspace)
+
+    assert sorted(workspace.manifest["clips"]) == ["1", "3"]
@@ -0,0 +1,60 @@
+"""Scelta della rendition e segmento di ogni clip da codificare."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "clip.mp4")
+    yield path
+    app.media_metadata.forget(path)
+
+
+def test_segment_is_rounded_up_to_the_frame_not_the_second():
+    assert app.ceil_to_frame(40.02 / 10) == pytest.approx(121 / app.NORMALIZE_FPS)
+    assert app.ceil_to_frame(4.0) == 4.0
+    assert app.ceil_to_frame(0.1 * 3) == pytest.approx(0.3)
+
+
+def test_segment_is_centred_in_a_longer_source(source):
+    app.media_metadata.remember(source, 20.0, "provider")
+
+    assert app.clip_segment(source, 4.0) == ["-ss", "8.000", "-t", "4.000"]
+
+
+def test_short_source_is_used_whole(source):
+    app.media_metadata.remember(source, 3.0, "provider")
+
+    assert app.clip_segment(source, 4.0) == []
+    assert app.clip_segment(source, 3.0) == []
+
+
+def test_unknown_source_duration_starts_at_zero(source):
+    assert app.clip_segment(source, 4.0) == ["-ss", "0.000", "-t", "4.000"]
+
+
+def test_no_segment_means_whole_clip(source):
+    app.media_metadata.remember(source, 20.0, "provider")
+
+    assert app.clip_segment(source, None) == []
+
+
+FILES = [(3840, "uhd"), (1920, "fhd"), (1280, "hd"), (640, "sd")]
+
+
+def test_smallest_usable_rendition_is_picked(monkeypatch):
+    monkeypatch.setattr(app, "CLIP_RENDITION", "smallest")
+
+    assert app.pick_rendition(FILES) == "hd"
+
+
+def test_first_listed_rendition_when_not_minimising(monkeypatch):
+    monkeypatch.setattr(app, "CLIP_RENDITION", "first")
+
+    assert app.pick_rendition(FILES) == "uhd"
+
+
+def test_renditions_below_the_minimum_width_are_never_picked():
+    assert app.pick_rendition([(960, "qhd"), (640, "sd")]) is None
+    assert app.pick_rendition([]) is None
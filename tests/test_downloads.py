@@ -0,0 +1,146 @@
+"""download_file/cached_download: limiti per provider e download condivisi tra job."""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, BoundedSemaphore
+
+import pytest
+
+import app
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body, during_stream=None):
+        self.body = body
+        self.during_stream = during_stream
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=None):
+        if self.during_stream:
+            self.during_stream()
+        yield self.body
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, during_stream=None):
+        self.during_stream = during_stream
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return FakeResponse(url.encode(), self.during_stream)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    fake = FakeSession()
+    monkeypatch.setattr(app, "get_http_session", lambda: fake)
+    return fake
+
+
+def test_downloads_do_not_hold_the_search_api_slot(session, monkeypatch, tmp_path):
+    limits = app.PROVIDER_LIMITS["pexels"]
+    monkeypatch.setitem(limits, "semaphore", BoundedSemaphore(1))
+    monkeypatch.setitem(limits, "downloads", BoundedSemaphore(1))
+    seen = {}
+
+    def while_streaming():
+        seen["search_free"] = limits["semaphore"].acquire(blocking=False)
+        if seen["search_free"]:
+            limits["semaphore"].release()
+        seen["download_free"] = limits["downloads"].acquire(blocking=False)
+
+    session.during_stream = while_streaming
+
+    path = app.download_file("https://cdn.example/clip.mp4", provider="pexels", workdir=str(tmp_path))
+
+    assert open(path, "rb").read() == b"https://cdn.example/clip.mp4"
+    assert seen == {"search_free": True, "download_free": False}
+    assert limits["downloads"].acquire(blocking=False)  # rilasciato a download finito
+
+
+def test_concurrent_misses_for_the_same_clip_download_once(session, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "clip_cache", app.FileCache("clips", str(tmp_path / "cache"), 1 << 30))
+    started = Barrier(4)
+    session.during_stream = lambda: app.time.sleep(0.1)  # gli altri job arrivano a download in corso
+
+    def job(n):
+        workdir = tmp_path / f"job{n}"
+        workdir.mkdir()
+        started.wait()
+        return app.cached_download("pexels", 42, "https://cdn.example/42.mp4", workdir=str(workdir))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        paths = list(pool.map(job, range(4)))
+
+    assert session.urls == ["https://cdn.example/42.mp4"]
+    assert len(set(paths)) == 4  # ogni job ha la sua copia privata
+    assert all(open(p, "rb").read() == b"https://cdn.example/42.mp4" for p in paths)
+    assert app.clip_cache.snapshot()["hits"] == 3
+    assert app.clip_cache.inflight == {}
+
+
+class BrokenResponse(FakeResponse):
+    """Risposta 200 che si interrompe dopo il primo chunk."""
+
+    def __init__(self, body, error):
+        super().__init__(body)
+        self.error = error
+
+    def iter_content(self, chunk_size=None):
+        yield self.body[:4]
+        raise self.error
+
+
+class FlakySession(FakeSession):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = list(errors)
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        if self.errors:
+            return BrokenResponse(url.encode(), self.errors.pop(0))
+        return FakeResponse(url.encode())
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(app.time, "sleep", delays.append)
+    return delays
+
+
+@pytest.mark.parametrize("error", [
+    app.requests.exceptions.ChunkedEncodingError("connessione chiusa a metà chunk"),
+    app.requests.ConnectionError("connection reset by peer"),
+])
+def test_stream_interrupted_mid_body_is_retried(error, monkeypatch, sleeps, tmp_path):
+    session = FlakySession([error])
+    monkeypatch.setattr(app, "get_http_session", lambda: session)
+
+    path = app.download_file("https://cdn.example/clip.mp4", provider="pexels", workdir=str(tmp_path))
+
+    assert open(path, "rb").read() == b"https://cdn.example/clip.mp4"
+    assert len(session.urls) == 2
+    assert len(sleeps) == 1
+    assert [p.name for p in tmp_path.iterdir()] == [app.os.path.basename(path)]  # il parziale è rimosso
+
+
+def test_stream_failing_on_every_attempt_raises(monkeypatch, sleeps, tmp_path):
+    attempts = app.PROVIDER_MAX_RETRIES + 1
+    session = FlakySession([app.requests.exceptions.ChunkedEncodingError("troncato")] * attempts)
+    monkeypatch.setattr(app, "get_http_session", lambda: session)
+
+    with pytest.raises(app.requests.exceptions.ChunkedEncodingError):
+        app.download_file("https://cdn.example/clip.mp4", provider="pexels", workdir=str(tmp_path))
+
+    assert len(session.urls) == attempts
+    assert len(sleeps) == attempts - 1
+    assert list(tmp_path.iterdir()) == []
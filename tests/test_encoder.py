@@ -0,0 +1,70 @@
+"""Profili encoder per richiesta e budget dei thread ffmpeg tra i job attivi."""
+import pytest
+
+import app
+
+
+def test_request_profile_overrides_the_default(monkeypatch):
+    monkeypatch.setattr(app, "ENCODER_PROFILE", "standard")
+
+    assert app.resolve_encoder_profile("draft") == "draft"
+    assert app.resolve_encoder_profile("ARCHIVE") == "archive"
+    assert app.encoder_args("draft") == ["-c:v", "libx264", "-preset", "veryfast", "-crf", "28"]
+
+
+def test_unknown_profiles_fall_back_to_the_configured_one(monkeypatch):
+    monkeypatch.setattr(app, "ENCODER_PROFILE", "archive")
+
+    assert app.resolve_encoder_profile("ultra") == "archive"
+    assert app.resolve_encoder_profile(None) == "archive"
+
+
+def test_unknown_configured_profile_falls_back_to_standard(monkeypatch):
+    monkeypatch.setattr(app, "ENCODER_PROFILE", "nvenc")
+
+    assert app.resolve_encoder_profile("ultra") == "standard"
+
+
+def test_profiles_change_the_norm_cache_codec_args():
+    assert app.normalize_codec_args("draft") != app.normalize_codec_args("standard")
+    assert app.normalize_codec_args("standard")[-1] == "-an"
+
+
+@pytest.fixture
+def budget(store, monkeypatch):
+    monkeypatch.setattr(app, "FFMPEG_ADAPTIVE_THREADS", True)
+    monkeypatch.setattr(app, "FFMPEG_CPU_BUDGET", 16)
+    monkeypatch.setattr(app, "active_jobs", {})
+    return store
+
+
+def activate(store, n):
+    for i in range(n):
+        store.create(f"job-{i}", {"data": {}})
+        store.claim(f"w{i}")
+
+
+def test_an_idle_server_gives_one_job_the_whole_budget(budget):
+    assert app.ffmpeg_thread_count() == 16
+
+
+@pytest.mark.parametrize("active, parallel, threads", [(2, 1, 8), (2, 3, 2), (4, 2, 2), (5, 4, 1)])
+def test_budget_splits_across_active_jobs_and_parallel_encodes(budget, active, parallel, threads):
+    activate(budget, active)
+
+    assert app.ffmpeg_thread_count(parallel) == threads
+
+
+def test_local_jobs_count_even_before_the_store_sees_them(budget):
+    activate(budget, 1)
+    app.active_jobs.update({"a": object(), "b": object(), "c": object(), "d": object()})
+
+    assert app.ffmpeg_thread_count() == 4
+
+
+def test_budget_off_lets_ffmpeg_decide(budget, monkeypatch):
+    monkeypatch.setattr(app, "FFMPEG_ADAPTIVE_THREADS", False)
+
+    assert app.ffmpeg_thread_count() is None
+    assert app.thread_args(None) == ([], [])
+    assert app.thread_args(3, "-filter_complex_threads") == (["-filter_complex_threads", "3"], ["-threads", "3"])
@@ -0,0 +1,84 @@
+"""FileCache: il sidecar è l'unico punto di commit, un lookup concorrente non scarta entry nuove."""
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return app.FileCache("test", str(tmp_path / "cache"), 1 << 30)
+
+
+def source(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_replacing_an_entry_removes_the_old_data_file(cache, tmp_path):
+    first = cache.store("k", source(tmp_path, "a.mp4", b"old"))
+    second = cache.store("k", source(tmp_path, "b.mp4", b"newer"))
+
+    assert first != second
+    assert not os.path.exists(first)
+    assert cache.lookup("k") == second
+    assert sorted(os.listdir(cache.directory)) == sorted(["k.json", os.path.basename(second)])
+
+
+def test_lookup_with_a_stale_sidecar_keeps_the_fresh_entry(cache, tmp_path, monkeypatch):
+    cache.store("k", source(tmp_path, "a.mp4", b"old"))
+    stale = cache.read_meta("k")
+    fresh = cache.store("k", source(tmp_path, "b.mp4", b"newer"))
+    reads = []
+    read_meta = cache.read_meta
+
+    def racing_read_meta(key):  # il lookup ha letto il sidecar prima del replace dello store
+        reads.append(key)
+        return stale if len(reads) == 1 else read_meta(key)
+
+    monkeypatch.setattr(cache, "read_meta", racing_read_meta)
+
+    assert cache.lookup("k") is None
+    assert cache.lookup("k") == fresh
+    with open(fresh, "rb") as f:
+        assert f.read() == b"newer"
+
+
+def test_sidecar_written_before_tokens_is_still_served(cache, tmp_path):
+    os.makedirs(cache.directory)
+    with open(os.path.join(cache.directory, "k.mp4"), "wb") as f:
+        f.write(b"legacy")
+    with open(cache.meta_path_for("k"), "w") as f:
+        json.dump({"size": 6}, f)
+
+    assert cache.lookup("k") == os.path.join(cache.directory, "k.mp4")
+
+
+def test_truncated_data_file_is_discarded(cache, tmp_path):
+    path = cache.store("k", source(tmp_path, "a.mp4", b"complete"))
+    with open(path, "r+b") as f:
+        f.truncate(3)
+
+    assert cache.lookup("k") is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_evict_drops_least_recent_entries_and_old_orphans(cache, tmp_path):
+    cache.max_bytes = 10
+    old = cache.store("old", source(tmp_path, "a.mp4", b"x" * 6))
+    os.utime(old, (time.time() - 60, time.time() - 60))
+    orphan = os.path.join(cache.directory, "gone.deadbeef.mp4")
+    with open(orphan, "wb") as f:
+        f.write(b"crash tra link e sidecar")
+    os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+
+    recent = cache.store("recent", source(tmp_path, "b.mp4", b"y" * 6))
+
+    assert cache.lookup("old") is None
+    assert cache.lookup("recent") == recent
+    assert not os.path.exists(orphan)
+    assert cache.snapshot()["evictions"] == 1
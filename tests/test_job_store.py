@@ -0,0 +1,228 @@
+"""Job store condiviso: stessi contratti per SQLiteJobStore e RedisJobStore (fakeredis)."""
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store(request, store, monkeypatch):
+    """Il fixture SQLite di conftest, o un RedisJobStore su fakeredis come job store globale."""
+    if request.param == "sqlite":
+        return store
+    fakeredis = pytest.importorskip("fakeredis")
+    job_store = app.RedisJobStore(fakeredis.FakeRedis())
+    # le funzioni di modulo (claim abbandonato, JobLease) usano il job store globale
+    monkeypatch.setattr(app, "job_store", job_store)
+    return job_store
+
+
+def expire_lease(store, job_id):
+    """Simula il crash del worker: il lease del job è già scaduto."""
+    if isinstance(store, app.SQLiteJobStore):
+        with app.closing(store._conn()) as conn:
+            conn.execute("UPDATE jobs SET lease_expires = 0 WHERE job_id = ?", (job_id,))
+    else:
+        store.client.zadd(store.lease_key, {job_id: 0})
+
+
+def test_claim_follows_priority_then_age(store):
+    store.create("old", {"data": {}})
+    store.create("new", {"data": {}})
+    store.create("urgent", {"data": {}}, priority=5)
+
+    claimed = [store.claim("w1")["job_id"] for _ in range(3)]
+
+    assert claimed == ["urgent", "old", "new"]
+    assert store.claim("w1") is None
+
+
+def test_claim_marks_processing_and_counts_attempts(store):
+    store.create("job", {"data": {"script": "sogno"}})
+
+    record = store.claim("w1")
+
+    assert record["status"] == "processing"
+    assert record["lease_owner"] == "w1"
+    assert record["attempts"] == 1
+    assert record["data"] == {"script": "sogno"}
+    assert store.queue_depth() == 0
+    assert store.active_count() == 1
+
+
+def test_claim_respects_max_active(store):
+    store.create("a", {"data": {}})
+    store.create("b", {"data": {}})
+
+    assert store.claim("w1", max_active=1)["job_id"] == "a"
+    assert store.claim("w2", max_active=1) is None
+    assert store.queue_depth() == 1
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(store):
+    store.create("job", {"data": {}})
+    store.claim("w1")
+    expire_lease(store, "job")
+
+    record = store.claim("w2")
+
+    assert record["job_id"] == "job"
+    assert record["lease_owner"] == "w2"
+    assert record["attempts"] == 2
+    assert not store.renew("job", "w1")
+    assert store.renew("job", "w2")
+
+
+def test_update_with_worker_id_is_fenced_on_lease_owner(store):
+    store.create("job", {"data": {}})
+    store.claim("w1")
+    expire_lease(store, "job")
+    store.claim("w2")
+
+    assert store.update("job", worker_id="w1", status="completed", video_url="from-w1") is False
+    assert store.get("job")["status"] == "processing"
+    assert store.update("job", worker_id="w2", status="completed", video_url="from-w2") is True
+    assert store.get("job")["video_url"] == "from-w2"
+
+
+def test_job_lease_raises_once_taken_over(store):
+    store.create("job", {"data": {}})
+    store.claim("w1")
+    lease = app.JobLease("job", "w1")
+    lease.update(timings={"stages": {"audio": 1.0}})
+    expire_lease(store, "job")
+    store.claim("w2")
+
+    with pytest.raises(app.LeaseLost):
+        lease.check()
+    with pytest.raises(app.LeaseLost):
+        lease.update(status="completed")
+    assert lease.lost.is_set()
+
+
+def test_requeue_does_not_consume_an_attempt(store):
+    store.create("job", {"data": {}})
+    store.claim("w1")
+
+    store.requeue("job", "w1")
+
+    record = store.get("job")
+    assert record["status"] == "queued"
+    assert record["attempts"] == 0
+    assert store.queue_position("job") == 1
+    assert store.claim("w2")["attempts"] == 1
+
+
+def test_requeue_ignores_jobs_owned_by_others(store):
+    store.create("job", {"data": {}})
+    store.claim("w1")
+
+    store.requeue("job", "w2")
+
+    assert store.get("job")["status"] == "processing"
+
+
+def test_waiting_jobs_are_claimable_only_after_release(store):
+    store.create("row", {"status": "waiting", "batch_id": "batch", "data": {}})
+
+    assert store.claim("w1") is None
+    assert store.queue_depth() == 0
+    assert store.waiting_count() == 1
+    assert [r["job_id"] for r in store.waiting_jobs()] == ["row"]
+
+    assert store.release("row") is True
+    assert store.release("row") is False
+    assert store.waiting_count() == 0
+    assert store.claim("w1")["job_id"] == "row"
+
+
+def test_job_abandoned_after_max_attempts_drops_its_upload(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "JOB_MAX_ATTEMPTS", 2)
+    audio_path = tmp_path / "job.bin"
+    audio_path.write_bytes(b"audio")
+    store.create("job", {"data": {"audio_path": str(audio_path)}})
+    for worker in ("w1", "w2"):
+        assert store.claim(worker)["job_id"] == "job"
+        expire_lease(store, "job")
+
+    assert store.claim("w3") is None
+
+    record = store.get("job")
+    assert record["status"] == "failed"
+    assert "abbandonato" in record["error"]
+    assert not os.path.exists(audio_path)
+
+
+class RacingPipeline:
+    """Pipeline che, alla prima lettura sotto WATCH, lascia agire un altro processo prima di EXEC."""
+
+    def __init__(self, pipe, race):
+        self.pipe = pipe
+        self.race = race
+
+    def __enter__(self):
+        self.pipe.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.pipe.__exit__(*exc)
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if name in ("get", "zcount") and self.race is not None:
+            race, self.race = self.race, None
+
+            def read_then_race(*args, **kwargs):
+                value = attr(*args, **kwargs)
+                race()
+                return value
+            return read_then_race
+        return attr
+
+
+@pytest.fixture
+def redis_pair():
+    """Due RedisJobStore su client distinti dello stesso server, come due processi gunicorn."""
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return app.RedisJobStore(fakeredis.FakeRedis(server=server)), app.RedisJobStore(fakeredis.FakeRedis(server=server))
+
+
+def race_on_next_transaction(monkeypatch, store, race):
+    pipeline = store.client.pipeline
+    monkeypatch.setattr(store.client, "pipeline", lambda *args, **kwargs: RacingPipeline(pipeline(*args, **kwargs), race))
+
+
+def test_redis_stale_update_racing_a_reclaim_raises_lease_lost(redis_pair, monkeypatch):
+    stale, other = redis_pair
+    monkeypatch.setattr(app, "job_store", stale)
+    stale.create("job", {"data": {}})
+    stale.claim("w1")
+    expire_lease(stale, "job")
+    # w1 legge il record quando il lease è ancora suo; w2 lo reclama prima che w1 scriva
+    race_on_next_transaction(monkeypatch, stale, lambda: other.claim("w2"))
+
+    with pytest.raises(app.LeaseLost):
+        app.JobLease("job", "w1").update(status="completed", video_url="from-w1")
+
+    record = other.get("job")
+    assert record["status"] == "processing"
+    assert record["lease_owner"] == "w2"
+    assert "video_url" not in record
+
+
+def test_redis_concurrent_claims_respect_max_active(redis_pair, monkeypatch):
+    first, second = redis_pair
+    first.create("a", {"data": {}})
+    first.create("b", {"data": {}})
+    # entrambi contano 0 job attivi; il secondo claim arriva tra il conteggio e la presa del primo
+    claimed = []
+    race_on_next_transaction(monkeypatch, first, lambda: claimed.append(second.claim("w2", max_active=1)))
+
+    record = first.claim("w1", max_active=1)
+
+    assert claimed[0]["job_id"] == "a"
+    assert record is None
+    assert first.active_count() == 1
+    assert first.queue_depth() == 1
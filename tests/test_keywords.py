@@ -0,0 +1,49 @@
+"""KeywordMatcher: stessi risultati del vecchio classificatore a sottostringhe (benchmarks/bench_keywords.py)."""
+import json
+import random
+
+import pytest
+
+import app
+from benchmarks import bench_keywords as legacy
+
+with open(app.KEYWORD_RULES_PATH, encoding="utf-8") as f:
+    RULES = json.load(f)
+TERMS = [term for rule in RULES["scene_rules"] for term in rule["terms"]]
+
+
+@pytest.mark.parametrize("keywords", ["sogni ricorrenti, inconscio", "", "none", "NONE", None])
+def test_pick_visual_query_matches_the_legacy_chain(keywords):
+    contexts, _texts = legacy.build_workload(200, random.Random(42))
+    # ogni termine delle regole da solo, in mezzo a una frase e attaccato ad altre lettere
+    contexts += TERMS + [f"ieri notte {t} nel sogno" for t in TERMS] + [f"x{t}y" for t in TERMS]
+    contexts += ["", None, "Un SOGNO con la MADRE e il MARE"]
+
+    for ctx in contexts:
+        assert app.pick_visual_query(ctx, keywords) == legacy.legacy_pick_visual_query(ctx, keywords), ctx
+
+
+def test_every_legacy_rule_is_in_the_rules_file():
+    # i termini del file coprono tutte le regole della vecchia catena, nello stesso ordine di priorità
+    queries = [legacy.legacy_pick_visual_query(rule["terms"][0]) for rule in RULES["scene_rules"]]
+    assert len(set(queries)) == len(RULES["scene_rules"])
+
+
+def test_metadata_classification_matches_the_legacy_lists():
+    _contexts, texts = legacy.build_workload(100, random.Random(7))
+    samples = [text for scene in texts for text in scene]
+    samples += legacy.LEGACY_DREAM + legacy.LEGACY_BANNED + ["", "stock market crash at night", "moonlight"]
+
+    for text in samples:
+        assert app.keyword_matcher.classify(text) == legacy.legacy_classify(text), text
+
+
+def test_is_sogni_video_metadata_matches_the_legacy_filter():
+    cases = [{"description": "Football match at night", "tags": ["sport"]},
+             {"description": "Clouds over the moon", "tags": []},
+             {"tags": ["Business", "office"]},
+             {"description": "", "tags": []}]
+
+    for video in cases:
+        text = (video.get("description", "") + " " + " ".join(video.get("tags", []))).lower()
+        assert app.is_sogni_video_metadata(video, "pexels") == legacy.legacy_is_sogni(text), video
@@ -0,0 +1,141 @@
+"""Durate media senza ffprobe: `-progress` di ffmpeg, header WAV e MediaMetadata."""
+import pathlib
+import struct
+import types
+import wave
+
+import pytest
+
+import app
+
+PROGRESS = """frame=58
+fps=0.0
+out_time_us=1933333
+progress=continue
+frame=121
+fps=29.8
+out_time_us=4033333
+out_time_ms=4033333
+progress=end
+"""
+
+
+def test_progress_duration_uses_the_last_frame_count():
+    assert app.ffmpeg_progress_duration(PROGRESS, 30) == pytest.approx(121 / 30)
+
+
+def test_progress_duration_without_fps_uses_out_time():
+    assert app.ffmpeg_progress_duration(PROGRESS) == pytest.approx(4.033333)
+    assert app.ffmpeg_progress_duration("out_time_ms=2500000\nprogress=end\n") == pytest.approx(2.5)
+
+
+@pytest.mark.parametrize("text", ["", None, "frame=0\nprogress=end\n", "frame=N/A\n", "progress=end\n"])
+def test_progress_without_frames_is_unknown(text):
+    assert app.ffmpeg_progress_duration(text, 30) is None
+
+
+def write_pcm_wav(path, seconds, rate=48000):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\0\0\0\0" * int(seconds * rate))
+
+
+def write_float_wav(path, seconds, extensible, rate=48000):
+    """WAV a 32 bit float (tag 3), o WAVE_FORMAT_EXTENSIBLE con subformat float: non PCM."""
+    data = b"\0\0\0\0" * int(seconds * rate)
+    if extensible:
+        float_guid = struct.pack("<IHH8s", 3, 0x0000, 0x0010, b"\x80\x00\x00\xaa\x00\x38\x9b\x71")
+        fmt = struct.pack("<HHIIHHHHI", 0xFFFE, 1, rate, rate * 4, 4, 32, 22, 32, 0x4) + float_guid
+    else:
+        fmt = struct.pack("<HHIIHH", 3, 1, rate, rate * 4, 4, 32)
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", len(data)) + data
+    path.write_bytes(b"RIFF" + struct.pack("<I", len(body)) + body)
+
+
+def test_pcm_wav_duration_comes_from_the_header(tmp_path):
+    path = tmp_path / "voice.wav"
+    write_pcm_wav(path, 1.5)
+
+    assert app.wav_duration(str(path)) == pytest.approx(1.5)
+
+
+@pytest.mark.parametrize("extensible", [False, True])
+def test_non_pcm_wav_headers_are_not_guessed(tmp_path, extensible):
+    path = tmp_path / "voice.wav"
+    write_float_wav(path, 1.0, extensible)
+
+    assert app.wav_duration(str(path)) is None
+    assert app.wav_duration(str(tmp_path / "missing.wav")) is None
+
+
+@pytest.fixture
+def ffmpeg_calls(monkeypatch):
+    """run_ffmpeg finto: il decode audio scrive `decoded`, ffprobe risponde 12.5s."""
+    calls = []
+    decoded = {"write": write_pcm_wav}
+
+    def fake(args, step, metrics=None, **kwargs):
+        calls.append(args[0])
+        if args[0] == "ffprobe":
+            return types.SimpleNamespace(stdout="12.5\n")
+        decoded["write"](args[-1])
+        return types.SimpleNamespace(stdout="")
+
+    monkeypatch.setattr(app, "run_ffmpeg", fake)
+    return calls, decoded
+
+
+def test_pcm_audio_needs_no_ffprobe(ffmpeg_calls, tmp_path):
+    calls, decoded = ffmpeg_calls
+    decoded["write"] = lambda path: write_pcm_wav(path, 2.0)
+    source = tmp_path / "voice.mp3"
+    source.write_bytes(b"mp3")
+
+    _wav, duration = app.prepare_audio({"audio_path": str(source)}, app.JobWorkspace("pcm", root=str(tmp_path)))
+
+    assert duration == pytest.approx(2.0)
+    assert calls == ["ffmpeg"]
+
+
+@pytest.mark.parametrize("extensible", [False, True])
+def test_non_pcm_audio_falls_back_to_ffprobe(ffmpeg_calls, tmp_path, extensible):
+    calls, decoded = ffmpeg_calls
+    decoded["write"] = lambda path: write_float_wav(pathlib.Path(path), 1.0, extensible)
+    source = tmp_path / "voice.mp3"
+    source.write_bytes(b"mp3")
+
+    _wav, duration = app.prepare_audio({"audio_path": str(source)}, app.JobWorkspace("float", root=str(tmp_path)))
+
+    assert duration == 12.5
+    assert calls == ["ffmpeg", "ffprobe"]
+
+
+def test_known_durations_are_never_probed():
+    metadata = app.MediaMetadata()
+    probes = []
+
+    def probe(path, metrics=None):
+        probes.append(path)
+        return 3.0
+
+    metadata.remember("/clips/a.mp4", 4.0, "provider")
+
+    assert metadata.duration("/clips/a.mp4", probe=probe) == 4.0
+    assert metadata.duration("/clips/b.mp4", probe=probe) == 3.0
+    assert metadata.duration("/clips/b.mp4", probe=probe) == 3.0
+    assert probes == ["/clips/b.mp4"]
+
+
+def test_unusable_durations_are_not_remembered():
+    metadata = app.MediaMetadata(max_entries=2)
+    metadata.remember("/a", 0, "provider")
+    metadata.remember("/b", None, "provider")
+    for name in ("/c", "/d", "/e"):
+        metadata.remember(name, 1.0, "provider")
+
+    assert metadata.known("/a") is None
+    assert metadata.known("/b") is None
+    assert metadata.known("/c") is None  # LRU oltre max_entries
+    assert metadata.known("/e") == 1.0
@@ -0,0 +1,16 @@
+"""/metrics: le serie di processo portano l'etichetta del worker gunicorn che le ha prodotte."""
+import app
+
+
+def test_every_per_process_series_is_labelled_with_the_worker():
+    app.JOBS_TOTAL.inc(1, "completed")
+    app.UPLOAD_SECONDS.observe(1.5)
+
+    body = app.app.test_client().get("/metrics").get_data(as_text=True)
+
+    samples = [line for line in body.splitlines() if line and not line.startswith("#")]
+    shared = ("video_queue_depth ", "video_active_jobs ")
+    assert f'video_jobs_total{{worker="{app.WORKER_ID}",status="completed"}}' in body
+    assert f'video_r2_upload_seconds_count{{worker="{app.WORKER_ID}"}} 1' in body
+    assert all(f'worker="{app.WORKER_ID}"' in line for line in samples if not line.startswith(shared))
+    assert any(line.startswith(shared) for line in samples)
@@ -0,0 +1,76 @@
+"""Cache delle clip normalizzate: un'entry corrotta non si serve, si scarta e si ricodifica."""
+import types
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def encodes(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "norm_cache", app.FileCache("normalized", str(tmp_path / "norm"), 1 << 30,
+                                                         validator=app.verify_normalized_entry))
+    calls = []
+
+    def fake_ffmpeg(args, step, metrics=None, **kwargs):
+        calls.append(args)
+        app.time.sleep(0.05)  # encode in corso: gli altri job arrivano adesso
+        with open(args[-1], "wb") as f:
+            f.write(b"normalized frames " * 64)
+        return types.SimpleNamespace(stdout="frame=60\nprogress=end\n")
+
+    monkeypatch.setattr(app, "run_ffmpeg", fake_ffmpeg)
+    return calls
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.mp4"
+    path.write_bytes(b"stock clip")
+    return str(path)
+
+
+def test_intact_entry_is_served_without_encoding(encodes, source, tmp_path):
+    app.normalize_clip(source, workdir=str(tmp_path))
+
+    _path, duration = app.normalize_clip(source, workdir=str(tmp_path))
+
+    assert len(encodes) == 1
+    assert duration == pytest.approx(2.0)
+    assert app.norm_cache.snapshot()["hits"] == 1
+
+
+def test_corrupted_entry_is_evicted_and_rebuilt(encodes, source, tmp_path):
+    app.normalize_clip(source, workdir=str(tmp_path))
+    [sidecar] = (tmp_path / "norm").glob("*.json")
+    cached = app.norm_cache.data_path_for(sidecar.stem, app.norm_cache.read_meta(sidecar.stem))
+    with open(cached, "r+b") as f:  # stessa size, contenuto diverso: solo lo sha256 se ne accorge
+        f.write(b"X")
+
+    path, _duration = app.normalize_clip(source, workdir=str(tmp_path))
+
+    assert len(encodes) == 2
+    assert app.norm_cache.snapshot()["hits"] == 0
+    with open(path, "rb") as f:
+        assert f.read() == b"normalized frames " * 64
+    assert app.norm_cache.lookup(sidecar.stem) is not None
+
+
+def test_concurrent_jobs_on_the_same_clip_encode_once(encodes, source, tmp_path):
+    started = Barrier(2)
+
+    def job(n):
+        workdir = tmp_path / f"job{n}"
+        workdir.mkdir()
+        started.wait()
+        return app.normalize_clip(source, segment=None, workdir=str(workdir))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(job, range(2)))
+
+    assert len(encodes) == 1
+    assert results[0][0] != results[1][0]
+    assert results[0][1] == results[1][1] == pytest.approx(2.0)
+    assert app.norm_cache.inflight == {}
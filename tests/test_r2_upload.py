@@ -0,0 +1,71 @@
+"""upload_video contro stand-in S3: TransferConfig del multipart e metriche di throughput."""
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+from botocore.stub import ANY, Stubber
+
+import app
+
+MB = 1024 * 1024
+
+
+class FakeS3:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, **kwargs):
+        self.uploads.append(kwargs)
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "final.mp4"
+    path.write_bytes(b"\0" * (11 * MB))
+    return path
+
+
+def test_upload_uses_the_tuned_transfer_config_and_records_metrics(video, monkeypatch):
+    monkeypatch.setattr(app, "R2_BUCKET_NAME", "videos-bucket")
+    s3 = FakeS3()
+    metrics = app.JobMetrics()
+    uploaded_before = app.UPLOAD_SECONDS.series.get((), (None, [0.0, 0]))[1][1]
+
+    size = app.upload_video(s3, str(video), "videos/final.mp4", metrics)
+
+    assert size == 11 * MB
+    [upload] = s3.uploads
+    assert upload["Bucket"] == "videos-bucket"
+    assert upload["Key"] == "videos/final.mp4"
+    assert upload["ExtraArgs"] == {"ContentType": "video/mp4"}
+    config = upload["Config"]
+    assert config is app.R2_TRANSFER_CONFIG
+    assert config.multipart_threshold == app.R2_MULTIPART_THRESHOLD_MB * MB
+    assert config.multipart_chunksize == app.R2_MULTIPART_CHUNK_MB * MB
+    assert config.max_concurrency == app.R2_UPLOAD_CONCURRENCY
+    assert config.use_threads
+    [recorded] = metrics.snapshot()["uploads"]
+    assert recorded["bytes"] == size
+    assert recorded["mbytes_per_second"] > 0
+    assert app.UPLOAD_SECONDS.series[()][1][1] == uploaded_before + 1
+
+
+def test_files_above_the_threshold_go_up_in_parts(video, monkeypatch):
+    monkeypatch.setattr(app, "R2_BUCKET_NAME", "videos-bucket")
+    monkeypatch.setattr(app, "R2_TRANSFER_CONFIG", TransferConfig(
+        multipart_threshold=5 * MB, multipart_chunksize=5 * MB, max_concurrency=1, use_threads=False))
+    s3 = boto3.client("s3", region_name="auto", endpoint_url="https://r2.invalid",
+                      aws_access_key_id="test", aws_secret_access_key="test")
+    with Stubber(s3) as stub:
+        stub.add_response("create_multipart_upload", {"UploadId": "upload-1"},
+                          {"Bucket": "videos-bucket", "Key": "videos/final.mp4", "ContentType": "video/mp4"})
+        for part in (1, 2, 3):  # 11MB in parti da 5MB
+            stub.add_response("upload_part", {"ETag": f'"etag-{part}"'},
+                              {"Bucket": "videos-bucket", "Key": "videos/final.mp4", "UploadId": "upload-1",
+                               "PartNumber": part, "Body": ANY})
+        stub.add_response("complete_multipart_upload", {},
+                          {"Bucket": "videos-bucket", "Key": "videos/final.mp4", "UploadId": "upload-1",
+                           "MultipartUpload": ANY})
+
+        app.upload_video(s3, str(video), "videos/final.mp4")
+
+        stub.assert_no_pending_responses()
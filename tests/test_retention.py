@@ -0,0 +1,31 @@
+"""RetentionManifest: quali video R2 escono dalla policy."""
+import time
+
+import app
+
+
+def manifest_with(tmp_path, keys):
+    manifest = app.RetentionManifest(str(tmp_path / "manifest.sqlite3"))
+    now = time.time()
+    for age_days, key in keys:
+        manifest.record(key, uploaded_ts=now - age_days * 86400)
+    return manifest
+
+
+def test_keep_last_keeps_the_newest_uploads(tmp_path):
+    manifest = manifest_with(tmp_path, [(3, "videos/a.mp4"), (2, "videos/b.mp4"), (1, "videos/c.mp4")])
+
+    assert manifest.expired_keys(keep_last=2, max_age_days=0) == ["videos/a.mp4"]
+
+
+def test_max_age_only_drops_older_uploads(tmp_path):
+    manifest = manifest_with(tmp_path, [(10, "videos/old.mp4"), (3, "videos/a.mp4"), (1, "videos/b.mp4")])
+
+    assert manifest.expired_keys(keep_last=1, max_age_days=5) == ["videos/old.mp4"]
+
+
+def test_the_just_uploaded_video_is_never_expired(tmp_path):
+    manifest = manifest_with(tmp_path, [(2, "videos/a.mp4"), (1, "videos/b.mp4")])
+    manifest.record("videos/current.mp4")
+
+    assert manifest.expired_keys(keep_last=0, max_age_days=0) == ["videos/a.mp4", "videos/b.mp4"]
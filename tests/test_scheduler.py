@@ -0,0 +1,74 @@
+"""/generate in coda: backlog limitato, posizione in /status e requeue allo shutdown."""
+from threading import Event
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    monkeypatch.setattr(app, "MAX_QUEUE", 3)
+    monkeypatch.setattr(app, "shutdown_event", Event())
+    monkeypatch.setattr(app, "dispatch_event", Event())
+    monkeypatch.setattr(app, "active_jobs", {})
+
+
+def generate(**fields):
+    return app.app.test_client().post("/generate", json=dict({"audio_url": "https://audio/a.mp3"}, **fields))
+
+
+def test_full_queue_answers_429_with_retry_after(store):
+    for row in range(3):
+        assert generate(row_number=row).status_code == 200
+
+    resp = generate(row_number=9)
+
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "60"
+    assert resp.get_json()["queue_depth"] == 3
+    assert store.count() == 3
+
+
+def test_waiting_batch_rows_count_against_the_queue(store):
+    store.create("row-1", {"status": "waiting", "batch_id": "b", "data": {}})
+    store.create("row-2", {"status": "waiting", "batch_id": "b", "data": {}})
+    assert generate().status_code == 200
+
+    assert generate().status_code == 429
+
+
+def test_status_reports_the_queue_position(store):
+    first, second = (generate(row_number=n).get_json()["job_id"] for n in (1, 2))
+    urgent = generate(row_number=3, priority=5).get_json()
+    client = app.app.test_client()
+
+    assert urgent["queue_position"] == 1
+    status = client.get(f"/status/{second}").get_json()
+    assert status["status"] == "queued"
+    assert status["queue_position"] == 3
+    assert status["queue_depth"] == 3
+    store.claim("w1")  # prende il job urgente
+    assert client.get(f"/status/{first}").get_json()["queue_position"] == 1
+    assert "queue_position" not in client.get(f"/status/{urgent['job_id']}").get_json()
+    assert client.get("/status/missing").status_code == 404
+
+
+def test_shutdown_requeues_jobs_still_running(store):
+    store.create("slow", {"data": {}})
+    store.create("quick", {"data": {}})
+    for job_id in ("slow", "quick"):
+        assert store.claim(app.WORKER_ID)["job_id"] == job_id
+    finished = Event()
+    finished.set()
+    store.update("quick", worker_id=app.WORKER_ID, status="completed")
+    app.active_jobs.update({"slow": Event(), "quick": finished})
+
+    app.shutdown_workers(grace=0.05)
+
+    slow = store.get("slow")
+    assert slow["status"] == "queued"
+    assert slow["attempts"] == 0  # lo shutdown non consuma un tentativo
+    assert store.get("quick")["status"] == "completed"
+    assert app.shutdown_event.is_set()
+    assert generate().status_code == 503
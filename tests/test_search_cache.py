@@ -0,0 +1,121 @@
+"""SearchCache (TTL, LRU, SQLite condiviso, single-flight) e ClipPicker."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+import pytest
+
+import app
+
+FILTERS = {"orientation": "landscape", "per_page": 25}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "search.sqlite3")
+
+
+def key(query):
+    return app.SearchCache.key_for("pexels", query, 1, FILTERS)
+
+
+def test_entries_expire_after_the_ttl(cache_path):
+    cache = app.SearchCache(cache_path, ttl=0.05, max_entries=10)
+    cache.put(key("luna"), [{"id": 1}])
+    assert cache.get(key("luna")) == [{"id": 1}]
+
+    time.sleep(0.1)
+
+    assert cache.get(key("luna")) is None
+    assert app.SearchCache(cache_path, ttl=0.05, max_entries=10).get(key("luna")) is None
+
+
+def test_memory_lru_keeps_the_most_recent_entries(cache_path):
+    cache = app.SearchCache(cache_path, ttl=60, max_entries=2)
+    for query in ("luna", "mare", "volo"):
+        cache.put(key(query), [query])
+    cache.get(key("mare"))  # "mare" diventa la più recente
+    cache.put(key("nuvole"), ["nuvole"])
+
+    assert list(cache.memory) == [key("mare"), key("nuvole")]
+    # le entry uscite dalla memoria restano nella tabella SQLite
+    assert cache.get(key("luna")) == ["luna"]
+
+
+def test_results_are_shared_across_instances_through_sqlite(cache_path):
+    app.SearchCache(cache_path, ttl=60, max_entries=10).put(key("luna"), [{"id": 7}])
+    other_worker = app.SearchCache(cache_path, ttl=60, max_entries=10)
+
+    fetched = []
+    payload = other_worker.get_or_fetch("pexels", "luna", 1, FILTERS, lambda: fetched.append(1) or [])
+
+    assert payload == [{"id": 7}]
+    assert fetched == []
+    assert other_worker.snapshot()["hits"] == 1
+
+
+def test_concurrent_scenes_with_the_same_query_search_once(cache_path):
+    cache = app.SearchCache(cache_path, ttl=60, max_entries=10)
+    started = Barrier(4)
+    searches = []
+
+    def fetch():
+        searches.append(1)
+        time.sleep(0.05)
+        return [{"id": 1}]
+
+    def scene(_n):
+        started.wait()
+        return cache.get_or_fetch("pexels", "luna", 1, FILTERS, fetch)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(scene, range(4)))
+
+    assert searches == [1]
+    assert results == [[{"id": 1}]] * 4
+    assert cache.snapshot()["misses"] == 1
+    assert cache.key_locks == {}
+
+
+def test_failed_searches_are_not_cached(cache_path):
+    cache = app.SearchCache(cache_path, ttl=60, max_entries=10)
+    calls = []
+
+    assert cache.get_or_fetch("pexels", "luna", 1, FILTERS, lambda: calls.append(1)) is None
+    assert cache.get_or_fetch("pexels", "luna", 1, FILTERS, lambda: calls.append(2) or ["ok"]) == ["ok"]
+    assert calls == [1, 2]
+
+
+def test_filters_and_page_are_part_of_the_key():
+    assert key("luna") != app.SearchCache.key_for("pexels", "luna", 2, FILTERS)
+    assert key("luna") != app.SearchCache.key_for("pixabay", "luna", 1, FILTERS)
+    assert key("luna") == app.SearchCache.key_for("pexels", "luna", 1, dict(reversed(list(FILTERS.items()))))
+
+
+def test_picker_spreads_repeated_scenes_across_results():
+    picker = app.ClipPicker()
+    candidates = [{"id": i} for i in range(3)]
+
+    picked = [picker.pick("pexels", candidates)["id"] for _ in range(3)]
+
+    assert sorted(picked) == [0, 1, 2]
+    # esauriti i risultati si ripete piuttosto che restare senza clip
+    assert picker.pick("pexels", candidates)["id"] in {0, 1, 2}
+    assert picker.pick("pexels", []) is None
+
+
+def test_picker_tracks_ids_per_provider_and_keeps_order_without_randomize():
+    picker = app.ClipPicker()
+    picker.pick("pexels", [{"id": 1}])
+
+    assert picker.pick("pixabay", [{"id": 1}, {"id": 2}], randomize=False)["id"] == 1
+    assert picker.pick("pixabay", [{"id": 1}, {"id": 2}], randomize=False)["id"] == 2
+
+
+def test_picker_chooses_the_search_page_once_per_query():
+    picker = app.ClipPicker()
+
+    pages = {picker.page("pexels", "luna") for _ in range(20)}
+
+    assert len(pages) == 1
+    assert 1 <= pages.pop() <= 3
@@ -0,0 +1,131 @@
+"""SheetsWriter contro un worksheet finto: coalescenza degli update e retry."""
+import pytest
+
+import app
+
+
+class FakeWorksheet:
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.calls = []
+
+    def batch_update(self, data, value_input_option=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.calls.append((data, value_input_option))
+
+
+class QuotaError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.response = type("Response", (), {"status_code": status_code})()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: None)
+
+
+def cells(call):
+    data, _option = call
+    return {entry["range"]: entry["values"][0][0] for entry in data}
+
+
+def test_updates_of_several_jobs_coalesce_in_one_batch():
+    worksheet = FakeWorksheet()
+    writer = app.SheetsWriter(lambda: worksheet, flush_interval=60)
+    writer.thread = object()  # niente thread di flush: lo chiama il test
+    first = writer.enqueue(2, {13: "https://old", 2: "PRODOTTO"})
+    second = writer.enqueue(2, {13: "https://new"})
+    third = writer.enqueue(3, {13: "https://other"})
+
+    writer.flush()
+
+    assert len(worksheet.calls) == 1
+    assert cells(worksheet.calls[0]) == {"B2": "PRODOTTO", "M2": "https://new", "M3": "https://other"}
+    assert worksheet.calls[0][1] == "USER_ENTERED"
+    assert all(w.wait(0) for w in (first, second, third))
+
+
+def test_background_flush_writes_after_the_coalescing_window(monkeypatch):
+    monkeypatch.undo()  # serve il vero sleep per la finestra di coalescenza
+    worksheet = FakeWorksheet()
+    writer = app.SheetsWriter(lambda: worksheet, flush_interval=0.05)
+
+    waiters = [writer.enqueue(row, {13: f"https://{row}"}) for row in range(2, 6)]
+
+    assert all(w.wait(5) for w in waiters)
+    assert len(worksheet.calls) == 1
+    assert len(cells(worksheet.calls[0])) == 4
+
+
+def test_quota_errors_are_retried_on_the_same_worksheet():
+    worksheet = FakeWorksheet(failures=[QuotaError(429), QuotaError(503)])
+    opened = []
+    writer = app.SheetsWriter(lambda: opened.append(1) or worksheet, flush_interval=60, max_retries=3)
+    writer.thread = object()
+    waiter = writer.enqueue(2, {13: "https://video"})
+
+    writer.flush()
+
+    assert waiter.wait(0)
+    assert len(worksheet.calls) == 1
+    assert len(opened) == 1
+
+
+def test_other_errors_reopen_the_worksheet():
+    worksheet = FakeWorksheet(failures=[RuntimeError("token scaduto")])
+    opened = []
+    writer = app.SheetsWriter(lambda: opened.append(1) or worksheet, flush_interval=60, max_retries=3)
+    writer.thread = object()
+    waiter = writer.enqueue(2, {13: "https://video"})
+
+    writer.flush()
+
+    assert waiter.wait(0)
+    assert len(opened) == 2
+
+
+def test_waiters_see_the_error_when_retries_are_exhausted():
+    worksheet = FakeWorksheet(failures=[QuotaError(429)] * 3)
+    writer = app.SheetsWriter(lambda: worksheet, flush_interval=60, max_retries=2)
+    writer.thread = object()
+    waiter = writer.enqueue(2, {13: "https://video"})
+
+    writer.flush()
+
+    assert waiter.done.is_set()
+    assert not waiter.wait(0)
+    assert isinstance(waiter.error, QuotaError)
+    assert worksheet.calls == []
+
+
+class BadRangeWorksheet(FakeWorksheet):
+    """Rifiuta ogni batch che contiene `bad_range`, come Sheets con una riga fuori griglia."""
+
+    def __init__(self, bad_range):
+        super().__init__()
+        self.bad_range = bad_range
+        self.rejected = 0
+
+    def batch_update(self, data, value_input_option=None):
+        if any(entry["range"] == self.bad_range for entry in data):
+            self.rejected += 1
+            raise RuntimeError(f"Range non valido: {self.bad_range}")
+        super().batch_update(data, value_input_option)
+
+
+def test_a_failing_row_does_not_fail_the_other_jobs():
+    worksheet = BadRangeWorksheet("M3")
+    writer = app.SheetsWriter(lambda: worksheet, flush_interval=60, max_retries=3)
+    writer.thread = object()
+    good = writer.enqueue(2, {13: "https://video", 2: "PRODOTTO"})
+    bad = writer.enqueue(3, {13: "https://other", 2: "PRODOTTO"})
+
+    writer.flush()
+
+    assert good.wait(0)
+    assert not bad.wait(0)
+    assert isinstance(bad.error, RuntimeError)
+    assert [cells(call) for call in worksheet.calls] == [{"B2": "PRODOTTO", "M2": "https://video"}]
+    assert worksheet.rejected == 2  # batch intero + riga 3 da sola, senza retry inutili
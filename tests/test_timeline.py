@@ -0,0 +1,138 @@
+"""build_timeline/render_video: loop delle clip normalizzate, concat in stream copy e fallback legacy."""
+import shutil
+import subprocess
+
+import pytest
+
+import app
+
+FRAME = 1 / app.NORMALIZE_FPS
+
+
+def timeline_seconds(timeline, clips):
+    durations = dict(clips)
+    return sum(durations[path] if outpoint is None else outpoint for path, outpoint in timeline)
+
+
+def test_loop_covers_the_audio_and_trims_the_last_segment():
+    clips = [("a.mp4", 4.0), ("b.mp4", 3.0)]
+
+    timeline = app.build_timeline(clips, 12.5)
+
+    assert timeline == [("a.mp4", None), ("b.mp4", None), ("a.mp4", None), ("b.mp4", 1.5)]
+    assert timeline_seconds(timeline, clips) == pytest.approx(12.5)
+
+
+def test_trimmed_outpoint_rounds_up_to_the_next_frame():
+    clips = [("a.mp4", 4.0)]
+
+    timeline = app.build_timeline(clips, 5.01)
+
+    covered = timeline_seconds(timeline, clips)
+    assert timeline[-1] == ("a.mp4", pytest.approx(31 / app.NORMALIZE_FPS))
+    assert 5.01 <= covered < 5.01 + FRAME
+
+
+def test_clip_boundary_on_the_audio_end_needs_no_trim():
+    clips = [("a.mp4", 0.1)] * 3
+
+    timeline = app.build_timeline(clips, 0.3)
+
+    assert timeline == [("a.mp4", None)] * 3
+
+
+def test_single_clip_is_looped():
+    timeline = app.build_timeline([("only.mp4", 2.0)], 5.0)
+
+    assert timeline == [("only.mp4", None), ("only.mp4", None), ("only.mp4", 1.0)]
+
+
+def test_zero_length_clips_are_skipped():
+    clips = [("empty.mp4", 0.0), ("a.mp4", 2.0), ("unknown.mp4", None)]
+
+    assert app.build_timeline(clips, 3.0) == [("a.mp4", None), ("a.mp4", 1.0)]
+    assert app.build_timeline([("empty.mp4", 0.0)], 3.0) == []
+    assert app.build_timeline([], 3.0) == []
+
+
+def test_concat_list_writes_outpoints_only_where_trimmed(tmp_path):
+    path = app.write_concat_list([("/clips/a.mp4", None), ("/clips/b.mp4", 1.5)], workdir=str(tmp_path))
+
+    with open(path) as f:
+        assert f.read() == "file '/clips/a.mp4'\nfile '/clips/b.mp4'\noutpoint 1.500000\n"
+
+
+class RenderCalls:
+    def __init__(self, monkeypatch, single_error=None):
+        self.calls = []
+        monkeypatch.setattr(app, "render_video_single", self.single)
+        monkeypatch.setattr(app, "render_video_legacy", self.legacy)
+        self.single_error = single_error
+
+    def single(self, concat_list_path, audiopath, real_duration, metrics=None, workdir=None):
+        self.calls.append("single")
+        if self.single_error:
+            raise self.single_error
+        return "single.mp4"
+
+    def legacy(self, concat_list_path, audiopath, real_duration, metrics=None, workdir=None, profile=None):
+        self.calls.append(("legacy", profile))
+        return "legacy.mp4", "looped.mp4"
+
+
+def test_failed_single_encode_falls_back_to_legacy(monkeypatch):
+    calls = RenderCalls(monkeypatch, subprocess.CalledProcessError(1, ["ffmpeg"]))
+
+    result = app.render_video("list.txt", "audio.mp3", 12.0, "single", profile="cpu")
+
+    assert result == ("legacy.mp4", "legacy")
+    assert calls.calls == ["single", ("legacy", "cpu")]
+
+
+def test_successful_single_encode_skips_legacy(monkeypatch):
+    calls = RenderCalls(monkeypatch)
+
+    assert app.render_video("list.txt", "audio.mp3", 12.0, "single") == ("single.mp4", "single")
+    assert calls.calls == ["single"]
+
+
+def test_legacy_mode_never_tries_single(monkeypatch):
+    calls = RenderCalls(monkeypatch)
+
+    assert app.render_video("list.txt", "audio.mp3", 12.0, "legacy") == ("legacy.mp4", "legacy")
+    assert calls.calls == [("legacy", None)]
+
+
+def test_unexpected_single_errors_are_not_swallowed(monkeypatch):
+    calls = RenderCalls(monkeypatch, OSError("disco pieno"))
+
+    with pytest.raises(OSError):
+        app.render_video("list.txt", "audio.mp3", 12.0, "single")
+    assert calls.calls == ["single"]
+
+
+def ffmpeg(*args):
+    return subprocess.run(["ffmpeg", "-y", "-loglevel", "error", *args],
+                          stdout=subprocess.PIPE, text=True, check=True).stdout
+
+
+@pytest.mark.ffmpeg
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg non disponibile")
+def test_stream_copy_concat_of_normalized_segments_is_playable(tmp_path):
+    sources = []
+    for name, seconds, size in (("a", 2.5, "640x360"), ("b", 1.7, "1280x720")):
+        source = tmp_path / f"{name}.mp4"
+        ffmpeg("-f", "lavfi", "-i", f"testsrc=duration={seconds}:size={size}:rate=25",
+               "-c:v", "libx264", "-pix_fmt", "yuv420p", str(source))
+        sources.append(str(source))
+    audio = tmp_path / "audio.wav"
+    ffmpeg("-f", "lavfi", "-i", "sine=frequency=440:duration=8", str(audio))
+    clips = [app.normalize_clip(source, workdir=str(tmp_path)) for source in sources]
+    real_duration = 7.0
+
+    concat_list = app.write_concat_list(app.build_timeline(clips, real_duration), workdir=str(tmp_path))
+    final = app.render_video_single(concat_list, str(audio), real_duration, workdir=str(tmp_path))
+
+    # decodifica completa: il file è riproducibile e la durata video è quella dell'audio
+    progress = ffmpeg("-i", final, "-map", "0:v", "-f", "null", "-nostats", "-progress", "pipe:1", "-")
+    assert app.ffmpeg_progress_duration(progress, app.NORMALIZE_FPS) == pytest.approx(real_duration, abs=FRAME)
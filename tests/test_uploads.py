@@ -0,0 +1,81 @@
+"""/generate: le tre modalità di upload audio finiscono su disco, l'input malformato è un 400."""
+import base64
+import io
+import os
+
+import pytest
+
+import app
+
+AUDIO = bytes(range(256)) * 64
+
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "AUDIO_UPLOAD_DIR", str(tmp_path / "uploads"))
+    return tmp_path / "uploads"
+
+
+def queued_audio(store, resp):
+    assert resp.status_code == 200, resp.get_json()
+    data = store.get(resp.get_json()["job_id"])["data"]
+    with open(data["audio_path"], "rb") as f:
+        return data, f.read()
+
+
+def test_multipart_upload_streams_the_file_and_merges_metadata(store):
+    resp = app.app.test_client().post("/generate", content_type="multipart/form-data", data={
+        "audio": (io.BytesIO(AUDIO), "voce.mp3"),
+        "title": "Sognare il mare",
+        "metadata": '{"row_number": 7}',
+    })
+
+    data, audio = queued_audio(store, resp)
+    assert audio == AUDIO
+    assert data["audio_path"].endswith(".mp3")
+    assert data["title"] == "Sognare il mare"
+    assert data["row_number"] == 7
+
+
+def test_raw_binary_body_takes_parameters_from_the_query_string(store):
+    resp = app.app.test_client().post("/generate?row_number=3&title=Volare", data=AUDIO,
+                                      content_type="audio/mpeg")
+
+    data, audio = queued_audio(store, resp)
+    assert audio == AUDIO
+    assert data["row_number"] == "3"
+    assert data["title"] == "Volare"
+
+
+def test_base64_with_line_breaks_is_decoded_to_disk(store):
+    encoded = base64.encodebytes(AUDIO).decode()  # a capo ogni 76 caratteri
+    assert "\n" in encoded
+
+    resp = app.app.test_client().post("/generate", json={"audio_base64": encoded, "row_number": 4})
+
+    data, audio = queued_audio(store, resp)
+    assert audio == AUDIO
+    assert "audio_base64" not in data
+
+
+def test_plain_base64_is_decoded_in_chunks(store, monkeypatch):
+    monkeypatch.setattr(app, "UPLOAD_CHUNK_SIZE", 16)  # più blocchi anche per un audio piccolo
+
+    resp = app.app.test_client().post("/generate", json={"audio_base64": base64.b64encode(AUDIO).decode()})
+
+    assert queued_audio(store, resp)[1] == AUDIO
+
+
+@pytest.mark.parametrize("body", [
+    {"json": {"audio_base64": "QUJD" * 10 + "QQ"}},  # padding mancante
+    {"json": {"audio_base64": "QUJD\nQQ"}},
+    {"data": "{non json", "content_type": "application/json"},
+    {"data": {"audio": (io.BytesIO(AUDIO), "a.mp3"), "metadata": "{rotto"}, "content_type": "multipart/form-data"},
+])
+def test_malformed_input_is_a_400_and_leaves_no_file(store, upload_dir, body):
+    resp = app.app.test_client().post("/generate", **body)
+
+    assert resp.status_code == 400
+    assert resp.get_json()["success"] is False
+    assert store.count() == 0
+    assert not upload_dir.exists() or os.listdir(upload_dir) == []
@@ -0,0 +1,177 @@
+"""WebhookDispatcher contro un server HTTP locale: retry, dead-letter, journal e consegna in background."""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+
+class StubEndpoint:
+    """Endpoint webhook che risponde con gli status di `responses` (poi 200) e registra i body."""
+
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.received = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                endpoint.received.append(json.loads(body))
+                status = endpoint.responses.pop(0) if endpoint.responses else 200
+                self.send_response(status)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def endpoint_factory():
+    endpoints = []
+
+    def make(responses=()):
+        endpoints.append(StubEndpoint(responses))
+        return endpoints[-1]
+
+    yield make
+    for endpoint in endpoints:
+        endpoint.close()
+
+
+@pytest.fixture
+def dead_letter_path(tmp_path):
+    return tmp_path / "dead_letter.jsonl"
+
+
+def dead_letters(path):
+    return [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+
+
+def test_retryable_errors_are_retried_until_delivered(endpoint_factory, dead_letter_path):
+    endpoint = endpoint_factory([503, 429])
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=3, timeout=5)
+
+    assert dispatcher.deliver({"name": "n8n", "url": endpoint.url, "payload": {"job_id": "j1"}})
+
+    assert endpoint.received == [{"job_id": "j1"}] * 3
+    assert dispatcher.snapshot()["delivered"] == 1
+    assert dispatcher.snapshot()["retries"] == 2
+    assert dead_letters(dead_letter_path) == []
+
+
+def test_exhausted_retries_end_in_the_dead_letter_file(endpoint_factory, dead_letter_path):
+    endpoint = endpoint_factory([500] * 10)
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=2, timeout=5)
+
+    assert not dispatcher.deliver({"name": "n8n", "url": endpoint.url, "payload": {"job_id": "j1"}})
+
+    assert len(endpoint.received) == 3
+    [line] = dead_letters(dead_letter_path)
+    assert line["payload"] == {"job_id": "j1"}
+    assert line["url"] == endpoint.url
+    assert line["attempts"] == 3
+    assert line["error"] == "HTTP 500"
+    assert dispatcher.snapshot()["dead_lettered"] == 1
+
+
+def test_client_errors_are_not_retried(endpoint_factory, dead_letter_path):
+    endpoint = endpoint_factory([400])
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=3, timeout=5)
+
+    assert not dispatcher.deliver({"name": "n8n", "url": endpoint.url, "payload": {"job_id": "j1"}})
+
+    assert len(endpoint.received) == 1
+    assert dead_letters(dead_letter_path)[0]["attempts"] == 1
+
+
+def test_connection_errors_are_dead_lettered(dead_letter_path):
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=0, timeout=1)
+
+    assert not dispatcher.deliver({"name": "n8n", "url": "http://127.0.0.1:9/hook", "payload": {}})
+
+    assert dead_letters(dead_letter_path)[0]["attempts"] == 1
+
+
+def test_enqueue_delivers_in_background(endpoint_factory, dead_letter_path):
+    endpoint = endpoint_factory([503])
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=2, timeout=5)
+
+    for n in range(3):
+        dispatcher.enqueue("n8n", endpoint.url, {"job_id": f"j{n}"})
+
+    assert dispatcher.flush(10)
+    assert sorted(body["job_id"] for body in endpoint.received) == ["j0", "j0", "j1", "j2"]
+    assert dispatcher.snapshot() == {"delivered": 3, "retries": 1, "dead_lettered": 0, "queued": 0}
+
+
+def test_journal_entry_lives_until_delivery(endpoint_factory, dead_letter_path, tmp_path):
+    endpoint = endpoint_factory([503])
+    journal_dir = tmp_path / "journal"
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=2, timeout=5, journal_dir=str(journal_dir))
+    delivering = threading.Event()
+    release = threading.Event()
+    deliver = dispatcher.deliver
+
+    def slow_deliver(item):
+        delivering.set()
+        release.wait(5)
+        return deliver(item)
+
+    dispatcher.deliver = slow_deliver
+    dispatcher.enqueue("n8n", endpoint.url, {"job_id": "j1"})
+
+    assert delivering.wait(5)
+    [entry] = journal_dir.iterdir()
+    assert json.loads(entry.read_text())["payload"] == {"job_id": "j1"}
+    release.set()
+    assert dispatcher.flush(10)
+    assert list(journal_dir.iterdir()) == []
+
+
+def test_dead_lettered_webhooks_leave_the_journal(endpoint_factory, dead_letter_path, tmp_path):
+    endpoint = endpoint_factory([400])
+    journal_dir = tmp_path / "journal"
+    dispatcher = app.WebhookDispatcher(str(dead_letter_path), max_retries=0, timeout=5, journal_dir=str(journal_dir))
+
+    dispatcher.enqueue("n8n", endpoint.url, {"job_id": "j1"})
+
+    assert dispatcher.flush(10)
+    assert len(dead_letters(dead_letter_path)) == 1
+    assert list(journal_dir.iterdir()) == []
+
+
+def test_replay_delivers_webhooks_left_by_a_dead_process(endpoint_factory, dead_letter_path, tmp_path):
+    endpoint = endpoint_factory()
+    journal_dir = tmp_path / "journal"
+    crashed = app.WebhookDispatcher(str(dead_letter_path), journal_dir=str(journal_dir))
+    crashed.journal({"id": "a1", "name": "n8n", "url": endpoint.url, "payload": {"job_id": "j1"}})
+    alive = os.getppid()  # un worker ancora vivo consegna da sé i suoi webhook
+    (journal_dir / f"{alive}-b2.json").write_text(json.dumps({"name": "n8n", "url": endpoint.url, "payload": {}}))
+
+    restarted = app.WebhookDispatcher(str(dead_letter_path), max_retries=0, timeout=5, journal_dir=str(journal_dir))
+    assert restarted.replay() == 1
+    assert restarted.flush(10)
+
+    assert endpoint.received == [{"job_id": "j1"}]
+    assert [p.name for p in journal_dir.iterdir()] == [f"{alive}-b2.json"]
+
+
+def test_replay_without_journal_is_a_noop(dead_letter_path):
+    assert app.WebhookDispatcher(str(dead_letter_path)).replay() == 0
@@ -0,0 +1,96 @@
+"""Workspace dei job: reaper TTL/budget e ripresa dai checkpoint."""
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def workspace_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "JOB_WORKSPACE_DIR", str(tmp_path / "workspaces"))
+    monkeypatch.setattr(app, "active_jobs", {})
+
+
+def workspace(job_id, size=16):
+    ws = app.JobWorkspace(job_id, root=app.JOB_WORKSPACE_DIR)
+    with open(ws.path("clip.mp4"), "wb") as f:
+        f.write(b"\0" * size)
+    ws.checkpoint("audio", wav_file=ws.path("clip.mp4"), duration=1.0)
+    return ws
+
+
+def workspaces():
+    return sorted(os.listdir(app.JOB_WORKSPACE_DIR))
+
+
+def test_orphaned_and_finished_workspaces_are_removed(store):
+    store.create("done", {"data": {}})
+    store.claim("w1")
+    store.update("done", status="completed")
+    store.create("queued", {"data": {}})
+    for job_id in ("orphan", "done", "queued"):
+        workspace(job_id)
+
+    assert app.reap_workspaces() == 2
+    assert workspaces() == ["queued"]
+
+
+def test_old_workspaces_expire_unless_the_job_is_live(store):
+    store.create("leased", {"data": {}})
+    store.claim("other-process")
+    store.create("running", {"data": {}})
+    store.create("stale", {"data": {}})
+    for job_id in ("leased", "running", "stale"):
+        workspace(job_id)
+    app.active_jobs["running"] = object()
+
+    removed = app.reap_workspaces(now=time.time() + app.JOB_WORKSPACE_MAX_AGE + 60)
+
+    assert removed == 1
+    assert workspaces() == ["leased", "running"]
+
+
+def test_over_budget_drops_the_oldest_idle_workspaces(store, monkeypatch):
+    monkeypatch.setattr(app, "JOB_WORKSPACE_MAX_MB", 1)
+    for job_id in ("old", "new", "leased"):
+        store.create(job_id, {"data": {}}, priority=1 if job_id == "leased" else 0)
+    store.claim("w1")  # "leased" ha priorità: è l'unico in processing
+    workspace("leased", 600 * 1024)
+    workspace("old", 600 * 1024)
+    time.sleep(0.01)
+    workspace("new", 100 * 1024)
+
+    assert app.reap_workspaces() == 1
+    assert workspaces() == ["leased", "new"]
+
+
+def test_resumed_job_skips_completed_steps(store, monkeypatch):
+    first = workspace("job")
+    first.record_clip(1, first.path("clip.mp4"), 4.0)
+
+    def must_not_run(*args, **kwargs):
+        raise AssertionError("passo già completato rifatto")
+
+    fetched = []
+
+    def fetch(scene_number, query, avg_scene_duration, metrics=None, picker=None, workdir=None):
+        fetched.append(scene_number)
+        path = f"{workdir}/source-{scene_number}.mp4"
+        open(path, "wb").close()
+        return path, None
+
+    monkeypatch.setattr(app, "run_ffmpeg", must_not_run)
+    monkeypatch.setattr(app, "fetch_clip_for_scene", fetch)
+    monkeypatch.setattr(app, "normalize_clip", lambda path, *args: (path + ".norm", 3.0))
+    resumed = app.JobWorkspace("job", root=app.JOB_WORKSPACE_DIR)  # retry: manifest riletto da disco
+
+    wav, duration = app.prepare_audio({}, resumed)
+    clips, downloaded = app.run_clip_pipeline([{"scene": 1, "query": "a"}, {"scene": 2, "query": "b"}], 4.0,
+                                              workspace=resumed)
+
+    assert (wav, duration) == (resumed.path("clip.mp4"), 1.0)
+    assert fetched == [2]
+    assert clips[0] == (resumed.path("clip.mp4"), 4.0)
+    assert downloaded == 2